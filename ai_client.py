@@ -0,0 +1,144 @@
+"""
+Общий асинхронный клиент модели.
+
+Поставщик (OpenAI или локальная замена, см. ai_providers) создается один раз при
+запуске API и переиспользует HTTP-соединения (keep-alive), поэтому запросы к
+модели не блокируют event loop и не открывают новое соединение на каждую строку
+файла. Все запросы проходят через общий ограничитель частоты (квота OpenAI),
+повторяются с задержкой при 429 и временных ошибках и учитываются в ai_usage
+(токены, время, ошибки). Повторы - только здесь: клиент OpenAI создается без
+собственных повторов, иначе они обходили бы квоту и учет.
+"""
+import asyncio
+import random
+import time
+from typing import Optional
+
+import openai
+
+from ai_providers import LLMProvider, create_provider, estimate_tokens
+from ai_usage import ai_budget, record_ai_call, record_ai_error, record_ai_failure
+from config import Config
+
+class TokenBucket:
+    """Ограничитель частоты: rate токенов в секунду, не больше capacity подряд"""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self, amount: float = 1.0):
+        """Ждет, пока в корзине наберется amount токенов, и забирает их"""
+        amount = min(amount, self.capacity)
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= amount:
+                    self._tokens -= amount
+                    return
+                await asyncio.sleep((amount - self._tokens) / self.rate)
+
+_provider: Optional[LLMProvider] = None
+
+# Квота запросов в минуту (корзина на минуту запросов: допускается всплеск до квоты)
+_request_bucket: Optional[TokenBucket] = None
+if Config.OPENAI_REQUESTS_PER_MINUTE > 0:
+    _request_bucket = TokenBucket(Config.OPENAI_REQUESTS_PER_MINUTE / 60, Config.OPENAI_REQUESTS_PER_MINUTE)
+
+def init_ai_client() -> Optional[LLMProvider]:
+    """Создает общего поставщика ответов модели (AI_PROVIDER; для OpenAI - если задан OPENAI_API_KEY)"""
+    global _provider
+    if _provider is None:
+        _provider = create_provider()
+    return _provider
+
+def get_ai_client() -> Optional[LLMProvider]:
+    """Общий поставщик; None - если AI не настроен"""
+    return _provider if _provider is not None else init_ai_client()
+
+def set_ai_client(provider: Optional[LLMProvider]):
+    """Подменяет общего поставщика (замеры, отладка)"""
+    global _provider
+    _provider = provider
+
+def ai_enabled() -> bool:
+    """Настроен ли AI-поиск"""
+    return get_ai_client() is not None
+
+async def close_ai_client():
+    """Закрывает соединения поставщика (при остановке API)"""
+    global _provider
+    if _provider is not None:
+        await _provider.close()
+        _provider = None
+
+def _is_transient(error: Exception) -> bool:
+    """Временная ошибка, после которой запрос повторяется: сеть, таймаут, 408, 409, 5xx"""
+    if isinstance(error, openai.APIConnectionError):
+        return True
+    if isinstance(error, openai.APIStatusError):
+        return error.status_code in (408, 409) or error.status_code >= 500
+    return False
+
+def _retry_delay(error: openai.APIError, attempt: int) -> float:
+    """Задержка перед повтором: Retry-After из ответа или экспоненциальная с джиттером"""
+    response = getattr(error, "response", None)
+    retry_after = response.headers.get("retry-after") if response is not None else None
+    try:
+        if retry_after is not None:
+            return float(retry_after)
+    except ValueError:
+        pass
+    return Config.OPENAI_RETRY_BASE_DELAY * 2 ** attempt * (0.5 + random.random())
+
+async def create_chat_completion(kind: str, **kwargs):
+    """chat.completions.create через общего поставщика: с учетом квоты и повтором при 429 (rate limit)
+    и временных ошибках.
+
+    kind - вид запроса для учета расходов (match, excel_structure). Если файл
+    израсходовал AI_FILE_TOKEN_BUDGET, запрос не отправляется (AIBudgetExceeded).
+    """
+    provider = get_ai_client()
+    estimated = sum(estimate_tokens(message["content"]) for message in kwargs.get("messages", []))
+    with ai_budget(estimated + kwargs.get("max_tokens", 0)):
+        return await _complete_with_retries(provider, kind, kwargs)
+
+async def _complete_with_retries(provider: LLMProvider, kind: str, kwargs):
+    """Каждая попытка проходит через квоту и учитывается: 429 - до OPENAI_RATE_LIMIT_RETRIES
+    повторов, временные ошибки - до OPENAI_MAX_RETRIES. Неудачным запрос считается, только
+    если ответа нет и после повторов"""
+    attempt = 0
+    errors = 0
+    while True:
+        if _request_bucket is not None:
+            await _request_bucket.acquire()
+        started = time.perf_counter()
+        try:
+            response = await provider.complete(**kwargs)
+        except openai.RateLimitError as e:
+            record_ai_error(kind, rate_limited=True)
+            if attempt >= Config.OPENAI_RATE_LIMIT_RETRIES:
+                record_ai_failure(kind)
+                raise
+            delay = _retry_delay(e, attempt)
+            attempt += 1
+            print(f"OpenAI rate limit, повтор {attempt} через {delay:.1f} с")
+            await asyncio.sleep(delay)
+            continue
+        except Exception as e:
+            record_ai_error(kind)
+            if not _is_transient(e) or errors >= Config.OPENAI_MAX_RETRIES:
+                record_ai_failure(kind)
+                raise
+            delay = _retry_delay(e, errors)
+            errors += 1
+            print(f"Ошибка OpenAI ({e}), повтор {errors} через {delay:.1f} с")
+            await asyncio.sleep(delay)
+            continue
+        record_ai_call(kind, kwargs.get("model", ""), response, started)
+        return response
@@ -0,0 +1,181 @@
+"""
+Поставщики ответов модели для AI-поиска (выбираются настройкой AI_PROVIDER).
+
+openai - запросы к OpenAI через асинхронный клиент с пулом соединений.
+fake - локальная детерминированная замена без сети: для замеров и отладки
+AI-пути загрузки. Задержка, доля ошибок и ответов 429 задаются настройками
+AI_FAKE_*; ответ строится по самому промпту (выбирается одна из записей-
+кандидатов), так что одинаковый промпт всегда дает одинаковый ответ.
+"""
+import asyncio
+import hashlib
+import json
+import random
+import re
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from typing import Dict, List, Optional
+
+import httpx
+import openai
+from openai.types.chat import ChatCompletion
+
+from config import Config
+
+def estimate_tokens(text: str) -> int:
+    """Приблизительное число токенов текста (для русского текста ~3 символа на токен)"""
+    return len(text) // 3 + 1
+
+class LLMProvider(ABC):
+    """Интерфейс поставщика: chat.completions в формате OpenAI"""
+
+    name = ""
+
+    @abstractmethod
+    async def complete(self, **kwargs) -> ChatCompletion:
+        """Ответ модели на запрос (параметры - как у chat.completions.create)"""
+
+    async def close(self):
+        """Освобождает соединения (при остановке API)"""
+
+class OpenAIProvider(LLMProvider):
+    """Запросы к OpenAI"""
+
+    name = "openai"
+
+    def __init__(self, client: openai.AsyncOpenAI):
+        self.client = client
+
+    @classmethod
+    def from_config(cls) -> Optional['OpenAIProvider']:
+        """Клиент с таймаутами и пулом соединений из настроек (None - если не задан OPENAI_API_KEY)"""
+        if not Config.OPENAI_API_KEY:
+            return None
+        return cls(openai.AsyncOpenAI(
+            api_key=Config.OPENAI_API_KEY,
+            timeout=httpx.Timeout(Config.OPENAI_TIMEOUT, connect=Config.OPENAI_CONNECT_TIMEOUT),
+            # Повторы (429 и временные ошибки) - в ai_client, через квоту и учет запросов
+            max_retries=0,
+            http_client=httpx.AsyncClient(
+                limits=httpx.Limits(
+                    max_connections=Config.OPENAI_MAX_CONNECTIONS,
+                    max_keepalive_connections=Config.OPENAI_MAX_CONNECTIONS,
+                    keepalive_expiry=Config.OPENAI_KEEPALIVE_EXPIRY,
+                ),
+            ),
+        ))
+
+    async def complete(self, **kwargs) -> ChatCompletion:
+        return await self.client.chat.completions.create(**kwargs)
+
+    async def close(self):
+        await self.client.close()
+
+# Разбор промптов подбора (см. build_match_prompt и build_batch_prompt в api.py)
+_SINGLE_QUERY_RE = re.compile(r'^Мне пришел запрос на: "(.*)"$', re.M)
+_BATCH_QUERIES_RE = re.compile(r'^Мне пришли запросы \(список строк\):\n(\[.*?\n?\])', re.S)
+_CANDIDATE_ID_RE = re.compile(r'"id": (\d+)')
+
+# Сколько последних промптов помнит замена модели (для номеров попыток)
+FAKE_ATTEMPTS_LIMIT = 10000
+
+def _seeded_random(*parts) -> random.Random:
+    """Генератор случайных чисел, зависящий только от parts (не от порядка вызовов)"""
+    digest = hashlib.sha256("\0".join(str(part) for part in parts).encode("utf-8")).digest()
+    return random.Random(int.from_bytes(digest[:8], "big"))
+
+class FakeLLMProvider(LLMProvider):
+    """Детерминированная замена модели: задержка, ошибки и 429 - по настройкам, без сети"""
+
+    name = "fake"
+
+    def __init__(self, latency: float = 0.8, error_rate: float = 0.0, rate_limit_rate: float = 0.0, seed: int = 0):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.seed = seed
+        # Номер попытки для недавних промптов: повтор после ошибки получает другой результат броска
+        self._attempts: "OrderedDict[str, int]" = OrderedDict()
+
+    @classmethod
+    def from_config(cls) -> 'FakeLLMProvider':
+        return cls(
+            latency=Config.AI_FAKE_LATENCY_MS / 1000,
+            error_rate=Config.AI_FAKE_ERROR_RATE,
+            rate_limit_rate=Config.AI_FAKE_RATE_LIMIT_RATE,
+            seed=Config.AI_FAKE_SEED,
+        )
+
+    async def complete(self, model: str, messages: List[Dict], **kwargs) -> ChatCompletion:
+        prompt = "\n".join(message["content"] for message in messages)
+        prompt_key = hashlib.sha256(prompt.encode("utf-8")).hexdigest()
+        attempt = self._attempts.pop(prompt_key, 0)
+        self._attempts[prompt_key] = attempt + 1
+        if len(self._attempts) > FAKE_ATTEMPTS_LIMIT:
+            # Повторы идут сразу после ошибки - давние промпты можно забыть
+            self._attempts.popitem(last=False)
+        rng = _seeded_random(self.seed, prompt_key, attempt)
+
+        # Задержка от половины до полуторной настроенной
+        await asyncio.sleep(self.latency * (0.5 + rng.random()))
+
+        roll = rng.random()
+        if roll < self.rate_limit_rate:
+            raise openai.RateLimitError("Rate limit reached (fake)", response=self._error_response(429), body=None)
+        if roll < self.rate_limit_rate + self.error_rate:
+            raise openai.InternalServerError("Server error (fake)", response=self._error_response(500), body=None)
+
+        content = json.dumps(self._answer(messages[-1]["content"]), ensure_ascii=False)
+        prompt_tokens = estimate_tokens(prompt)
+        completion_tokens = estimate_tokens(content)
+        return ChatCompletion.model_validate({
+            "id": f"fake-{prompt_key[:12]}-{attempt}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": model,
+            "choices": [{
+                "index": 0,
+                "finish_reason": "stop",
+                "message": {"role": "assistant", "content": content},
+            }],
+            "usage": {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
+                "total_tokens": prompt_tokens + completion_tokens,
+            },
+        })
+
+    @staticmethod
+    def _error_response(status_code: int) -> httpx.Response:
+        return httpx.Response(
+            status_code,
+            request=httpx.Request("POST", "https://fake.local/v1/chat/completions"),
+        )
+
+    def _answer(self, prompt: str):
+        """Ответ по промпту: для подбора - одна из записей-кандидатов, структура таблицы - не определена"""
+        candidate_ids = [int(mapping_id) for mapping_id in _CANDIDATE_ID_RE.findall(prompt)]
+
+        batch = _BATCH_QUERIES_RE.search(prompt)
+        if batch:
+            return [self._match(text, candidate_ids) | {"input": text} for text in json.loads(batch.group(1))]
+
+        single = _SINGLE_QUERY_RE.search(prompt)
+        if single:
+            return self._match(single.group(1), candidate_ids) | {"reasoning": "fake"}
+
+        # Структуру таблицы определяет локальный поиск по заголовкам
+        return {"article_column": None, "nomenclature_column": None, "header_row": None, "reasoning": "fake"}
+
+    def _match(self, text: str, candidate_ids: List[int]) -> Dict:
+        rng = _seeded_random(self.seed, text)
+        if not candidate_ids:
+            return {"mapping_id": None, "confidence": 0}
+        return {"mapping_id": rng.choice(candidate_ids[:3]), "confidence": rng.randint(30, 100)}
+
+def create_provider() -> Optional[LLMProvider]:
+    """Поставщик по настройке AI_PROVIDER (None - если AI не настроен)"""
+    if Config.AI_PROVIDER == "fake":
+        return FakeLLMProvider.from_config()
+    return OpenAIProvider.from_config()
@@ -0,0 +1,181 @@
+"""
+Учет запросов к модели: токены, стоимость, время и исход.
+
+Каждый запрос учитывается в общих счетчиках процесса (/api/metrics) и в
+счетчиках текущей загрузки файла (ответ /api/mappings/upload). Счетчики
+загрузки хранятся в contextvar: задачи asyncio, запущенные при обработке
+файла, наследуют их, поэтому параллельные запросы складываются в один итог.
+"""
+import time
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, Optional
+
+from config import Config
+
+class AIBudgetExceeded(Exception):
+    """Исчерпан лимит токенов на один файл (AI_FILE_TOKEN_BUDGET)"""
+
+# Исходы, при которых строка осталась без ответа модели (его можно получить повторным запросом)
+FAILED_OUTCOMES = ("parse_error", "missing", "budget_exceeded")
+
+class UsageCounters:
+    """Счетчики запросов одного вида"""
+
+    def __init__(self):
+        self.calls = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.latency = 0.0
+        self.max_latency = 0.0
+        # Неудачные попытки (в том числе повторенные) и запросы, оставшиеся без ответа после всех повторов
+        self.errors = 0
+        self.rate_limited = 0
+        self.failed = 0
+        self.outcomes: Counter = Counter()
+
+    @property
+    def total_tokens(self) -> int:
+        return self.prompt_tokens + self.completion_tokens
+
+    @property
+    def cost(self) -> float:
+        """Стоимость запросов по ценам из настроек, USD"""
+        return (self.prompt_tokens * Config.OPENAI_PROMPT_PRICE_PER_1K
+                + self.completion_tokens * Config.OPENAI_COMPLETION_PRICE_PER_1K) / 1000
+
+    @property
+    def failures(self) -> int:
+        """Запросы без ответа модели: ошибки после всех повторов, неразобранные ответы, пропущенные строки, лимит токенов"""
+        return self.failed + sum(self.outcomes[outcome] for outcome in FAILED_OUTCOMES)
+
+    def add_call(self, prompt_tokens: int, completion_tokens: int, latency: float):
+        self.calls += 1
+        self.prompt_tokens += prompt_tokens
+        self.completion_tokens += completion_tokens
+        self.latency += latency
+        self.max_latency = max(self.max_latency, latency)
+
+    def as_dict(self) -> Dict:
+        return {
+            "calls": self.calls,
+            "prompt_tokens": self.prompt_tokens,
+            "completion_tokens": self.completion_tokens,
+            "total_tokens": self.total_tokens,
+            "cost_usd": round(self.cost, 6),
+            "latency_ms": round(self.latency * 1000, 1),
+            "avg_latency_ms": round(self.latency / self.calls * 1000, 1) if self.calls else 0.0,
+            "max_latency_ms": round(self.max_latency * 1000, 1),
+            "errors": self.errors,
+            "rate_limited": self.rate_limited,
+            "failed": self.failed,
+            "outcomes": dict(self.outcomes),
+        }
+
+class AIUsage:
+    """Итог по всем запросам и по видам запросов (match, excel_structure)"""
+
+    def __init__(self):
+        self.total = UsageCounters()
+        self.kinds: Dict[str, UsageCounters] = {}
+        self.models: Counter = Counter()
+        # Оценка токенов промптов, отправленных и еще не получивших ответ (для лимита на файл)
+        self.reserved_tokens = 0
+
+    def _counters(self, kind: str):
+        if kind not in self.kinds:
+            self.kinds[kind] = UsageCounters()
+        return self.total, self.kinds[kind]
+
+    def add_call(self, kind: str, model: str, prompt_tokens: int, completion_tokens: int, latency: float):
+        for counters in self._counters(kind):
+            counters.add_call(prompt_tokens, completion_tokens, latency)
+        self.models[model] += 1
+
+    def add_error(self, kind: str, rate_limited: bool = False):
+        for counters in self._counters(kind):
+            if rate_limited:
+                counters.rate_limited += 1
+            else:
+                counters.errors += 1
+
+    def add_failure(self, kind: str):
+        for counters in self._counters(kind):
+            counters.failed += 1
+
+    def add_outcome(self, kind: str, outcome: str, count: int = 1):
+        for counters in self._counters(kind):
+            counters.outcomes[outcome] += count
+
+    def as_dict(self) -> Dict:
+        return {
+            **self.total.as_dict(),
+            "models": dict(self.models),
+            "by_kind": {kind: counters.as_dict() for kind, counters in self.kinds.items()},
+        }
+
+# Итог с момента запуска процесса
+total_ai_usage = AIUsage()
+
+_current_usage: ContextVar[Optional[AIUsage]] = ContextVar("ai_usage", default=None)
+
+def start_ai_usage() -> AIUsage:
+    """Начинает учет запросов текущей обработки файла (в текущем контексте и его задачах)"""
+    usage = AIUsage()
+    _current_usage.set(usage)
+    return usage
+
+def current_ai_usage() -> Optional[AIUsage]:
+    """Счетчики текущей обработки файла (None - вне обработки файла)"""
+    return _current_usage.get()
+
+def _targets():
+    usage = _current_usage.get()
+    return (total_ai_usage,) if usage is None else (total_ai_usage, usage)
+
+@contextmanager
+def ai_budget(estimated_tokens: int):
+    """Резервирует оценку токенов запроса в лимите текущего файла на время запроса.
+
+    AIBudgetExceeded - если израсходованные и зарезервированные параллельными
+    запросами токены вместе с этим запросом превышают AI_FILE_TOKEN_BUDGET.
+    """
+    usage = _current_usage.get()
+    if Config.AI_FILE_TOKEN_BUDGET <= 0 or usage is None:
+        yield
+        return
+    spent = usage.total.total_tokens + usage.reserved_tokens
+    if spent + estimated_tokens > Config.AI_FILE_TOKEN_BUDGET:
+        raise AIBudgetExceeded(f"Лимит токенов на файл исчерпан: {spent} из {Config.AI_FILE_TOKEN_BUDGET}")
+    usage.reserved_tokens += estimated_tokens
+    try:
+        yield
+    finally:
+        usage.reserved_tokens -= estimated_tokens
+
+def record_ai_call(kind: str, model: str, response, started: float):
+    """Учитывает успешный запрос (response - ответ chat.completions, started - time.perf_counter() до запроса)"""
+    latency = time.perf_counter() - started
+    usage = getattr(response, "usage", None)
+    prompt_tokens = usage.prompt_tokens if usage else 0
+    completion_tokens = usage.completion_tokens if usage else 0
+    for target in _targets():
+        target.add_call(kind, model, prompt_tokens, completion_tokens, latency)
+
+def record_ai_error(kind: str, rate_limited: bool = False):
+    """Учитывает неудачную попытку запроса (429 - отдельно), в том числе после которой запрос повторяется"""
+    for target in _targets():
+        target.add_error(kind, rate_limited)
+
+def record_ai_failure(kind: str):
+    """Учитывает запрос, оставшийся без ответа: ошибка без повтора или повторы исчерпаны"""
+    for target in _targets():
+        target.add_failure(kind)
+
+def record_ai_outcome(kind: str, outcome: str, count: int = 1):
+    """Учитывает исход: hit, rejected (уверенность ниже 50% или нет записи), parse_error, missing, cached..."""
+    if count <= 0:
+        return
+    for target in _targets():
+        target.add_outcome(kind, outcome, count)
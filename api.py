@@ -3,21 +3,34 @@ from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import JSONResponse, FileResponse, StreamingResponse
 from sqlalchemy import select, func
 from sqlalchemy.ext.asyncio import AsyncSession
-from typing import List, Optional, Dict
+from typing import Callable, List, Optional, Dict, Tuple
 from pydantic import BaseModel
 from datetime import datetime
 import json
+import asyncio
 import openpyxl
 from io import BytesIO
 import tempfile
 import os
+import time
 import uuid
 
-from database import get_db, Article, ProcessedFile, MatchedArticle, ProductMapping, ConfirmedMapping, init_db
+from database import get_db, async_session_maker, Article, ProcessedFile, MatchedArticle, ProductMapping, ConfirmedMapping, init_db
 from file_processor import FileProcessor
+from catalog import MappingCatalog, MappingRecord
+from confirmed import ConfirmedMappingIndex, normalize_confirmed_text
+from fts_search import init_fts, fts_candidates, fts_enabled
+from matching import MatchingEngine, MatchingPool, TopMatches, rank_search_matches, search_matched_fields
+from article_keys import ensure_article_keys, replace_mapping_keys, delete_mapping_keys, lookup_article_key
 from config import Config
-from difflib import SequenceMatcher
-import openai
+from ai_client import init_ai_client, close_ai_client, ai_enabled, create_chat_completion, estimate_tokens
+from data_version import init_data_version, get_catalog_version
+from excel_layouts import ExcelLayoutCache
+from excel_reader import SheetRows, open_workbook, iter_sheets
+from ai_usage import AIBudgetExceeded, current_ai_usage, record_ai_outcome, start_ai_usage, total_ai_usage
+from upload_jobs import UploadJob, UploadJobQueue, UploadQueueFull
+from llm_cache import get_cached_response, get_cached_responses, store_response, store_responses, template_hash, llm_cache_stats
+from match_cache import get_cached_matches, store_matches, match_cache_enabled, match_cache_stats
 
 app = FastAPI(title="Article Matcher API", version="1.0.0")
 
@@ -31,6 +44,43 @@ app.add_middleware(
 )
 
 file_processor = FileProcessor()
+# Снимок таблицы соответствий в памяти: поиск и загрузка файлов не читают product_mappings из БД
+mapping_catalog = MappingCatalog()
+# Подтвержденные сопоставления в памяти: проверка строки - поиск по словарю
+confirmed_index = ConfirmedMappingIndex(mapping_catalog)
+# Пул процессов для сопоставления больших файлов (процессы запускаются при первом использовании)
+matching_pool = MatchingPool(Config.MATCH_PROCESSES)
+# Структуры Excel-шаблонов, уже определенные AI (по отпечатку строки заголовков)
+excel_layouts = ExcelLayoutCache()
+# Снимки перезагружает один запрос, остальные ждут его
+catalog_reload_lock = asyncio.Lock()
+
+async def refresh_catalog(db: AsyncSession):
+    """Загружает снимки таблицы соответствий и подтверждений или перезагружает их, если база
+    изменилась после загрузки (скрипт импорта, другой uvicorn worker).
+    
+    Версия данных (data_version, ведется триггерами) сравнивается с версией, по которой
+    построен снимок, - один короткий запрос к БД. Версия читается до загрузки: запись,
+    сделанная во время загрузки, приведет к еще одной перезагрузке, а не потеряется.
+    """
+    if mapping_catalog.loaded and mapping_catalog.data_version == await get_catalog_version(db):
+        return
+    async with catalog_reload_lock:
+        version = await get_catalog_version(db)
+        if mapping_catalog.loaded and mapping_catalog.data_version == version:
+            return
+        await mapping_catalog.load(db)
+        await confirmed_index.load(db)
+        mapping_catalog.data_version = version
+
+async def catalog_written(db: AsyncSession, version_before: Optional[str], writes: int = 1):
+    """После записи через API (снимки уже обновлены на месте): если кроме этих writes строк база
+    не менялась - версия данных выросла ровно на writes, - снимок не перезагружается"""
+    if version_before is None or mapping_catalog.data_version != version_before:
+        return
+    version = await get_catalog_version(db)
+    if version_before.isdigit() and version == str(int(version_before) + writes):
+        mapping_catalog.data_version = version
 
 # Pydantic модели
 class ArticleCreate(BaseModel):
@@ -82,6 +132,36 @@ class ProcessedFileResponse(BaseModel):
 async def startup_event():
     """Инициализация при запуске"""
     await init_db()
+    # Версия базы соответствий и подтверждений для кэшей (ведется триггерами)
+    await init_data_version()
+    
+    # Заполняем ключи артикулов для точного поиска (если таблица еще пуста)
+    async with async_session_maker() as session:
+        await ensure_article_keys(session)
+    
+    if fts_enabled():
+        # Индекс на диске, синхронизируется триггерами
+        await init_fts()
+    
+    async with async_session_maker() as session:
+        # Снимок таблицы соответствий (вместе с поисковым индексом). В режиме FTS5 поиск
+        # читает записи из БД, и снимок загружается только при первой загрузке файла
+        if not fts_enabled():
+            await refresh_catalog(session)
+        await excel_layouts.load(session)
+    
+    # Общий поставщик ответов модели (OpenAI - если задан ключ)
+    init_ai_client()
+    
+    # Обработчики фоновых загрузок файлов
+    upload_jobs.start()
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    """Остановка фоновых загрузок, процессов сопоставления и закрытие соединений с OpenAI"""
+    await upload_jobs.stop()
+    matching_pool.shutdown()
+    await close_ai_client()
 
 @app.get("/")
 async def root():
@@ -188,13 +268,18 @@ async def upload_file(
         # Извлечение текста
         extracted_text = await file_processor.process_file(file_path, file.content_type)
         
-        # Получение артикулов из базы
-        result = await db.execute(select(Article))
-        articles = result.scalars().all()
-        article_numbers = [article.article_number for article in articles]
+        # Автомат поиска артикулов перестраивается только при изменении таблицы articles
+        articles_version = tuple((await db.execute(
+            select(func.count(Article.id), func.max(Article.updated_at))
+        )).one())
+        if file_processor.articles_version != articles_version:
+            result = await db.execute(select(Article))
+            articles = result.scalars().all()
+            article_numbers = [article.article_number for article in articles]
+            file_processor.set_articles(article_numbers, version=articles_version)
         
-        # Поиск совпадений
-        matches = file_processor.extract_article_numbers(extracted_text, article_numbers)
+        # Поиск совпадений (один проход по тексту)
+        matches = file_processor.extract_article_numbers(extracted_text)
         
         # Обновление записи
         processed_file.extracted_text = extracted_text[:10000]
@@ -334,7 +419,19 @@ async def get_stats(db: AsyncSession = Depends(get_db)):
     return {
         "articles_count": articles_count,
         "files_count": files_count,
-        "matches_count": matches_count
+        "matches_count": matches_count,
+        "llm_cache": llm_cache_stats()
+    }
+
+@app.get("/api/metrics")
+async def get_metrics():
+    """Счетчики запросов к модели с момента запуска API: токены, стоимость, время, исходы по видам запросов"""
+    return {
+        "ai": total_ai_usage.as_dict(),
+        "ai_file_token_budget": Config.AI_FILE_TOKEN_BUDGET,
+        "upload_jobs": upload_jobs.stats(),
+        "llm_cache": llm_cache_stats(),
+        "match_cache": match_cache_stats()
     }
 
 # ========== API для работы с таблицей сопоставления ==========
@@ -399,30 +496,21 @@ class ProductMappingSearchResponse(BaseModel):
     match_score: float
     matched_fields: List[str]
 
-async def ai_analyze_excel_structure(file_path: str) -> Optional[Dict]:
-    """Использует AI для анализа структуры Excel файла и определения столбцов"""
-    if not Config.OPENAI_API_KEY:
-        return None
-    
-    try:
-        workbook = openpyxl.load_workbook(file_path, data_only=True)
-        if not workbook.sheetnames:
-            return None
-        
-        # Берем первый лист
-        sheet = workbook[workbook.sheetnames[0]]
-        
-        # Собираем первые 10 строк для анализа
-        sample_data = []
-        for row_idx, row in enumerate(sheet.iter_rows(max_row=10, values_only=True), start=1):
-            row_data = [str(cell) if cell is not None else '' for cell in row]
-            sample_data.append({
-                'row': row_idx,
-                'values': row_data[:20]  # Первые 20 столбцов
-            })
-        
-        # Формируем промпт для AI
-        prompt = f"""Ты помощник для анализа структуры Excel таблицы.
+# Системный промпт для подбора вариантов из базы
+AI_MATCH_SYSTEM_PROMPT = "Ты помощник для поиска соответствий в базе данных товаров. Твоя задача - подобрать ОДИН максимально подходящий вариант из базы данных для каждого запроса. Отвечай только в формате JSON."
+# Оценка токенов ответа на одну строку пакета и запас на служебную часть ответа
+AI_BATCH_TOKENS_PER_ROW = 40
+AI_BATCH_RESPONSE_RESERVE = 100
+
+# Системный промпт для анализа структуры таблиц
+AI_STRUCTURE_SYSTEM_PROMPT = "Ты помощник для анализа структуры таблиц. Отвечай только в формате JSON."
+# Виды запросов в кэше ответов AI
+AI_MATCH_CACHE_KIND = "match"
+AI_STRUCTURE_CACHE_KIND = "excel_structure"
+
+def build_structure_prompt(sample_data: List[Dict]) -> str:
+    """Промпт для определения столбцов таблицы по первым строкам"""
+    return f"""Ты помощник для анализа структуры Excel таблицы.
 
 Данные из файла (первые 10 строк):
 {json.dumps(sample_data, ensure_ascii=False, indent=2)}
@@ -444,19 +532,44 @@ async def ai_analyze_excel_structure(file_path: str) -> Optional[Dict]:
     "reasoning": "<краткое объяснение>"
 }}"""
 
-        # Вызываем OpenAI API
-        try:
-            client = openai.OpenAI(api_key=Config.OPENAI_API_KEY)
-        except TypeError:
-            # Для старых версий openai библиотеки
-            import openai as openai_module
-            client = openai_module.OpenAI(api_key=Config.OPENAI_API_KEY)
+def structure_template_hash() -> str:
+    """Хэш промпта анализа структуры (ответ не зависит от базы соответствий)"""
+    return template_hash(Config.AI_PROVIDER, Config.OPENAI_MODEL, AI_STRUCTURE_SYSTEM_PROMPT, build_structure_prompt([]))
+
+async def ai_analyze_excel_structure(sample_data: List[Dict]) -> Optional[Dict]:
+    """Использует AI для анализа структуры Excel файла и определения столбцов.
+    
+    sample_data - первые строки первого листа (SheetRows.sample_data: первые 20 столбцов
+    первых 10 строк). Структура файла известного шаблона (строка заголовков уже
+    встречалась) определяется без AI.
+    """
+    if not ai_enabled() and not excel_layouts:
+        return None
+    
+    try:
+        # Известный шаблон - структура по отпечатку строки заголовков
+        structure = excel_layouts.lookup(sample_data)
+        if structure:
+            record_ai_outcome(AI_STRUCTURE_CACHE_KIND, 'layout')
+            return structure
+        if not ai_enabled():
+            return None
         
-        response = client.chat.completions.create(
+        # Тот же фрагмент таблицы уже разбирался - берем ответ из кэша
+        cache_text = json.dumps(sample_data, ensure_ascii=False)
+        template = structure_template_hash()
+        cached = await get_cached_response(AI_STRUCTURE_CACHE_KIND, cache_text, template, "")
+        if cached is not None:
+            record_ai_outcome(AI_STRUCTURE_CACHE_KIND, 'cached')
+            return cached
+        
+        # Вызываем OpenAI API (общий асинхронный клиент с пулом соединений и учетом квоты)
+        response = await create_chat_completion(
+            AI_STRUCTURE_CACHE_KIND,
             model=Config.OPENAI_MODEL,
             messages=[
-                {"role": "system", "content": "Ты помощник для анализа структуры таблиц. Отвечай только в формате JSON."},
-                {"role": "user", "content": prompt}
+                {"role": "system", "content": AI_STRUCTURE_SYSTEM_PROMPT},
+                {"role": "user", "content": build_structure_prompt(sample_data)}
             ],
             temperature=0.2,
             max_tokens=300
@@ -466,101 +579,85 @@ async def ai_analyze_excel_structure(file_path: str) -> Optional[Dict]:
         
         # Парсим ответ AI
         try:
-            if ai_response.startswith("```"):
-                ai_response = ai_response.split("```")[1]
-                if ai_response.startswith("json"):
-                    ai_response = ai_response[4:]
-            ai_response = ai_response.strip()
-            
-            ai_result = json.loads(ai_response)
-            return ai_result
+            structure = parse_ai_json(ai_response)
         except json.JSONDecodeError:
+            record_ai_outcome(AI_STRUCTURE_CACHE_KIND, 'parse_error')
             return None
+        if isinstance(structure, dict):
+            found = structure.get('article_column') is not None or structure.get('nomenclature_column') is not None
+            record_ai_outcome(AI_STRUCTURE_CACHE_KIND, 'hit' if found else 'rejected')
+            await store_response(AI_STRUCTURE_CACHE_KIND, cache_text, template, "", structure)
+            await excel_layouts.remember(sample_data, structure)
+        else:
+            record_ai_outcome(AI_STRUCTURE_CACHE_KIND, 'parse_error')
+        return structure
+    except AIBudgetExceeded as e:
+        record_ai_outcome(AI_STRUCTURE_CACHE_KIND, 'budget_exceeded')
+        print(f"AI-анализ структуры пропущен: {e}")
+        return None
     except Exception as e:
         print(f"Ошибка AI-анализа структуры: {e}")
         return None
 
-async def ai_interpret_text(recognized_text: str, available_mappings: List[ProductMapping], db: AsyncSession) -> Optional[Dict]:
-    """Использует AI для интерпретации распознанного текста и поиска в БД с дообучением на подтвержденных примерах"""
-    if not Config.OPENAI_API_KEY:
-        return None  # Если нет API ключа, возвращаем None
+def find_confirmed_match(recognized_text: str) -> Optional[Dict]:
+    """Точное совпадение с подтвержденным сопоставлением (первый этап сопоставления)"""
+    confirmed = confirmed_index.lookup(recognized_text)
+    if confirmed:
+        mapping = mapping_catalog.get(confirmed.mapping_id)
+        if mapping:
+            return {
+                'mapping_id': mapping.id,
+                'match_score': 100.0,  # Подтвержденные сопоставления имеют 100%
+                'is_confirmed': True,
+                'mapping': mapping
+            }
+    return None
+
+def mapping_prompt_entry(m: MappingRecord) -> Dict:
+    """Запись базы в формате для промпта"""
+    return {
+        'id': m.id,
+        'артикул_АГБ': m.article_agb or '',
+        'артикул_BL': m.article_bl or '',
+        'номенклатура_АГБ': m.nomenclature_agb or '',
+        'код': m.code or '',
+        'вариант_1': m.variant_1 or '',
+        'вариант_2': m.variant_2 or '',
+        'вариант_3': m.variant_3 or '',
+    }
+
+def prompt_mappings(recognized_text: str, available_mappings: List[MappingRecord]) -> List[MappingRecord]:
+    """Записи базы для промпта: короткий список похожих на запрос (по локальному индексу).
+    Если похожих нет - первые 50 записей, с приоритетом записям с артикулом АГБ"""
+    shortlist = mapping_catalog.shortlist(recognized_text, Config.AI_SHORTLIST_SIZE)
+    if shortlist:
+        return shortlist
     
-    try:
-        # Проверяем точное совпадение с подтвержденными сопоставлениями (быстрая проверка)
-        confirmed_result = await db.execute(
-            select(ConfirmedMapping).where(
-                ConfirmedMapping.recognized_text.ilike(f"%{recognized_text}%")
-            ).order_by(ConfirmedMapping.user_confirmed.desc(), ConfirmedMapping.updated_at.desc()).limit(1)
-        )
-        confirmed = confirmed_result.scalar_one_or_none()
-        if confirmed:
-            # Находим mapping по ID
-            mapping_result = await db.execute(
-                select(ProductMapping).where(ProductMapping.id == confirmed.mapping_id)
-            )
-            mapping = mapping_result.scalar_one_or_none()
-            if mapping:
-                # Если есть точное совпадение, возвращаем сразу
-                if recognized_text.strip().lower() == confirmed.recognized_text.strip().lower():
-                    return {
-                        'mapping_id': mapping.id,
-                        'match_score': 100.0,  # Подтвержденные сопоставления имеют 100%
-                        'is_confirmed': True,
-                        'mapping': mapping
-                    }
-        
-        # Получаем примеры подтвержденных сопоставлений для дообучения (few-shot learning)
-        confirmed_examples_result = await db.execute(
-            select(ConfirmedMapping, ProductMapping)
-            .join(ProductMapping, ConfirmedMapping.mapping_id == ProductMapping.id)
-            .order_by(ConfirmedMapping.user_confirmed.desc(), ConfirmedMapping.updated_at.desc())
-            .limit(5)  # Берем 5 последних подтвержденных примеров
-        )
-        confirmed_examples = confirmed_examples_result.all()
-        
-        # Подготавливаем примеры для промпта
-        learning_examples = []
-        for confirmed_mapping, product_mapping in confirmed_examples:
-            learning_examples.append({
-                'запрос': confirmed_mapping.recognized_text,
-                'результат': {
-                    'id': product_mapping.id,
-                    'артикул_АГБ': product_mapping.article_agb or '',
-                    'номенклатура_АГБ': product_mapping.nomenclature_agb or '',
-                    'артикул_BL': product_mapping.article_bl or '',
-                    'код': product_mapping.code or '',
-                }
-            })
-        
-        # Подготавливаем данные базы для поиска (увеличиваем до 50 записей для лучшего поиска)
-        # Приоритет записям с артикулом АГБ
-        mappings_with_agb = [m for m in available_mappings if m.article_agb][:50]
-        if not mappings_with_agb:
-            mappings_with_agb = available_mappings[:50]
-        
-        sample_data = []
-        for m in mappings_with_agb:
-            sample_data.append({
-                'id': m.id,
-                'артикул_АГБ': m.article_agb or '',
-                'артикул_BL': m.article_bl or '',
-                'номенклатура_АГБ': m.nomenclature_agb or '',
-                'код': m.code or '',
-                'вариант_1': m.variant_1 or '',
-                'вариант_2': m.variant_2 or '',
-                'вариант_3': m.variant_3 or '',
-            })
-        
-        # Формируем промпт для AI с новым форматом
-        examples_text = ""
-        if learning_examples:
-            examples_text = f"\n\nПримеры правильных сопоставлений (используй их как образец):\n{json.dumps(learning_examples, ensure_ascii=False, indent=2)}"
-        
-        prompt = f"""Мне пришел запрос на: "{recognized_text}"
+    mappings_with_agb = [m for m in available_mappings if m.article_agb][:50]
+    if not mappings_with_agb:
+        mappings_with_agb = available_mappings[:50]
+    return mappings_with_agb
 
-Подбери из нашей базы данных максимально подходящий вариант. База данных содержит {len(available_mappings)} записей.
+def parse_ai_json(ai_response: str):
+    """Разбирает JSON из ответа AI (убирает markdown код блоки, если есть)"""
+    ai_response = ai_response.strip()
+    if ai_response.startswith("```"):
+        ai_response = ai_response.split("```")[1]
+        if ai_response.startswith("json"):
+            ai_response = ai_response[4:]
+    return json.loads(ai_response.strip())
 
-Доступные варианты в базе данных:
+def build_match_prompt(recognized_text: str, sample_data: List[Dict], learning_examples: List[Dict], total_mappings: int) -> str:
+    """Промпт для одной строки: записи-кандидаты, примеры и запрос"""
+    examples_text = ""
+    if learning_examples:
+        examples_text = f"\n\nПримеры правильных сопоставлений (используй их как образец):\n{json.dumps(learning_examples, ensure_ascii=False, indent=2)}"
+    
+    return f"""Мне пришел запрос на: "{recognized_text}"
+
+Подбери из нашей базы данных максимально подходящий вариант. База данных содержит {total_mappings} записей.
+
+Наиболее похожие варианты из базы данных (предварительный отбор):
 {json.dumps(sample_data, ensure_ascii=False, indent=2)}{examples_text}
 
 Задача: найди ОДИН наиболее подходящий вариант из базы данных для запроса "{recognized_text}".
@@ -579,55 +676,90 @@ async def ai_interpret_text(recognized_text: str, available_mappings: List[Produ
     "reasoning": "<краткое объяснение почему выбран именно этот вариант>"
 }}"""
 
-        # Вызываем OpenAI API
-        try:
-            client = openai.OpenAI(api_key=Config.OPENAI_API_KEY)
-        except TypeError:
-            # Для старых версий openai библиотеки
-            import openai as openai_module
-            client = openai_module.OpenAI(api_key=Config.OPENAI_API_KEY)
-        
-        response = client.chat.completions.create(
-            model=Config.OPENAI_MODEL,
-            messages=[
-                {"role": "system", "content": "Ты помощник для поиска соответствий в базе данных товаров. Твоя задача - подобрать ОДИН максимально подходящий вариант из базы данных для каждого запроса. Отвечай только в формате JSON."},
-                {"role": "user", "content": prompt}
-            ],
-            temperature=0.2,  # Низкая температура для более точных и стабильных результатов
-            max_tokens=300
-        )
-        
-        ai_response = response.choices[0].message.content.strip()
+def match_template_hash() -> str:
+    """Хэш промптов подбора и настроек отбора кандидатов (общий для режима по строкам и пакетного)"""
+    return template_hash(
+        Config.AI_PROVIDER,
+        Config.OPENAI_MODEL,
+        Config.AI_SHORTLIST_SIZE,
+        AI_MATCH_SYSTEM_PROMPT,
+        build_match_prompt("", [], [], 0),
+        build_batch_prompt([], [], [], 0),
+    )
+
+async def ai_interpret_text(recognized_text: str, available_mappings: List[MappingRecord], db: AsyncSession) -> Optional[Dict]:
+    """Использует AI для интерпретации распознанного текста и поиска в БД с дообучением на подтвержденных примерах"""
+    if not ai_enabled():
+        return None  # Если AI не настроен (нет API ключа), возвращаем None
+    
+    try:
+        # Эта строка уже отправлялась в AI при той же версии базы - берем ответ из кэша
+        template = match_template_hash()
+        version = await get_catalog_version(db)
+        ai_result = await get_cached_response(AI_MATCH_CACHE_KIND, recognized_text, template, version)
         
-        # Парсим ответ AI
-        try:
-            # Убираем markdown код блоки если есть
-            if ai_response.startswith("```"):
-                ai_response = ai_response.split("```")[1]
-                if ai_response.startswith("json"):
-                    ai_response = ai_response[4:]
-            ai_response = ai_response.strip()
+        if ai_result is not None:
+            record_ai_outcome(AI_MATCH_CACHE_KIND, 'cached')
+        else:
+            # Получаем примеры подтвержденных сопоставлений для дообучения (few-shot learning)
+            learning_examples = confirmed_index.learning_examples()
             
-            ai_result = json.loads(ai_response)
+            # Подготавливаем данные базы для поиска: только записи, похожие на запрос
+            sample_data = [mapping_prompt_entry(m) for m in prompt_mappings(recognized_text, available_mappings)]
             
-            if ai_result.get('mapping_id') and ai_result.get('confidence', 0) >= 50:
-                # Находим mapping по ID
-                mapping_result = await db.execute(
-                    select(ProductMapping).where(ProductMapping.id == ai_result['mapping_id'])
-                )
-                mapping = mapping_result.scalar_one_or_none()
-                if mapping:
-                    return {
-                        'mapping_id': mapping.id,
-                        'match_score': float(ai_result.get('confidence', 0)),
-                        'is_ai_match': True,
-                        'reasoning': ai_result.get('reasoning', ''),
-                        'mapping': mapping
-                    }
-        except json.JSONDecodeError as e:
-            print(f"Ошибка парсинга ответа AI: {e}, ответ: {ai_response}")
-            pass  # Если не удалось распарсить, возвращаем None
+            # Вызываем OpenAI API (общий асинхронный клиент с пулом соединений и учетом квоты)
+            response = await create_chat_completion(
+                AI_MATCH_CACHE_KIND,
+                model=Config.OPENAI_MODEL,
+                messages=[
+                    {"role": "system", "content": AI_MATCH_SYSTEM_PROMPT},
+                    {"role": "user", "content": build_match_prompt(recognized_text, sample_data, learning_examples, len(available_mappings))}
+                ],
+                temperature=0.2,  # Низкая температура для более точных и стабильных результатов
+                max_tokens=300
+            )
+            
+            ai_response = response.choices[0].message.content.strip()
+            
+            # Парсим ответ AI
+            try:
+                ai_result = parse_ai_json(ai_response)
+            except json.JSONDecodeError as e:
+                print(f"Ошибка парсинга ответа AI: {e}, ответ: {ai_response}")
+                record_ai_outcome(AI_MATCH_CACHE_KIND, 'parse_error')
+                return None  # Если не удалось распарсить, возвращаем None
+            
+            if not isinstance(ai_result, dict):
+                record_ai_outcome(AI_MATCH_CACHE_KIND, 'parse_error')
+                return None
+            # Сохраняем и ответ "не найдено": повторный запрос дал бы тот же результат
+            await store_response(AI_MATCH_CACHE_KIND, recognized_text, template, version, {
+                'mapping_id': ai_result.get('mapping_id'),
+                'confidence': ai_result.get('confidence', 0),
+                'reasoning': ai_result.get('reasoning', ''),
+            })
+        
+        if ai_result.get('mapping_id') and ai_result.get('confidence', 0) >= 50:
+            # Находим mapping по ID (в снимке, как и записи-кандидаты промпта)
+            try:
+                mapping = mapping_catalog.get(int(ai_result['mapping_id']))
+            except (TypeError, ValueError):
+                mapping = None
+            if mapping:
+                record_ai_outcome(AI_MATCH_CACHE_KIND, 'hit')
+                return {
+                    'mapping_id': mapping.id,
+                    'match_score': float(ai_result.get('confidence', 0)),
+                    'is_ai_match': True,
+                    'reasoning': ai_result.get('reasoning', ''),
+                    'mapping': mapping
+                }
         
+        record_ai_outcome(AI_MATCH_CACHE_KIND, 'rejected')
+        return None
+    except AIBudgetExceeded as e:
+        record_ai_outcome(AI_MATCH_CACHE_KIND, 'budget_exceeded')
+        print(f"AI-поиск пропущен: {e}")
         return None
     except Exception as e:
         print(f"Ошибка AI-поиска: {e}")
@@ -635,46 +767,144 @@ async def ai_interpret_text(recognized_text: str, available_mappings: List[Produ
         traceback.print_exc()
         return None  # В случае ошибки возвращаем None, будет использован обычный поиск
 
-def calculate_similarity(text1: str, text2: str) -> float:
-    """Вычисляет процент совпадения между двумя строками на основе совпадения слов"""
-    if not text1 or not text2:
-        return 0.0
-    
-    # Нормализуем тексты: приводим к нижнему регистру и разбиваем на слова
-    import re
-    words1 = set(re.findall(r'\w+', text1.lower()))
-    words2 = set(re.findall(r'\w+', text2.lower()))
-    
-    if not words1 or not words2:
-        return 0.0
-    
-    # Находим точные совпадения слов
-    exact_matches = words1.intersection(words2)
-    
-    # Если есть точные совпадения, считаем процент на их основе
-    if exact_matches:
-        # Процент = (количество совпавших слов / количество слов в запросе) * 100
-        # Но также учитываем, сколько слов из текста совпало
-        match_ratio = len(exact_matches) / len(words1)
-        # Дополнительный бонус, если все слова запроса найдены
-        if len(exact_matches) == len(words1):
-            match_ratio = 1.0
-        return match_ratio * 100
-    
-    # Если нет точных совпадений, используем частичное совпадение
-    # Проверяем, содержит ли текст2 слова из text1 (частичное совпадение)
-    partial_score = 0.0
-    for word1 in words1:
-        for word2 in words2:
-            if word1 in word2 or word2 in word1:
-                partial_score += 0.5  # Частичное совпадение дает 50% от полного
-                break
-    
-    if partial_score > 0:
-        return (partial_score / len(words1)) * 100
-    
-    # Если нет даже частичных совпадений, используем SequenceMatcher как fallback
-    return SequenceMatcher(None, text1.lower(), text2.lower()).ratio() * 100
+def split_ai_batches(texts: List[str], fixed_prompt: str, candidate_tokens: Dict[str, int]) -> List[List[str]]:
+    """Делит строки на пакеты для одного промпта: не больше AI_BATCH_SIZE строк,
+    и промпт (вместе с записями-кандидатами строк) и ответ должны помещаться в контекстное окно модели"""
+    budget = Config.AI_CONTEXT_TOKENS - estimate_tokens(fixed_prompt) - AI_BATCH_RESPONSE_RESERVE
+    batches = []
+    batch = []
+    batch_tokens = 0
+    for text in texts:
+        # Строка в запросе, ее записи-кандидаты и ее элемент в ответе
+        text_tokens = 2 * estimate_tokens(json.dumps(text, ensure_ascii=False)) + candidate_tokens[text] + AI_BATCH_TOKENS_PER_ROW
+        if batch and (len(batch) >= Config.AI_BATCH_SIZE or batch_tokens + text_tokens > budget):
+            batches.append(batch)
+            batch = []
+            batch_tokens = 0
+        batch.append(text)
+        batch_tokens += text_tokens
+    if batch:
+        batches.append(batch)
+    return batches
+
+def build_batch_prompt(texts: List[str], sample_data: List[Dict], learning_examples: List[Dict], total_mappings: int) -> str:
+    """Промпт для пакета строк: один раз база и примеры, затем список запросов"""
+    examples_text = ""
+    if learning_examples:
+        examples_text = f"\n\nПримеры правильных сопоставлений (используй их как образец):\n{json.dumps(learning_examples, ensure_ascii=False, indent=2)}"
+    
+    return f"""Мне пришли запросы (список строк):
+{json.dumps(texts, ensure_ascii=False, indent=2)}
+
+Подбери для каждого запроса из нашей базы данных максимально подходящий вариант. База данных содержит {total_mappings} записей.
+
+Наиболее похожие на запросы варианты из базы данных (предварительный отбор):
+{json.dumps(sample_data, ensure_ascii=False, indent=2)}{examples_text}
+
+Задача: для КАЖДОГО запроса найди ОДИН наиболее подходящий вариант из базы данных.
+Учитывай возможные опечатки, сокращения, вариации написания и синонимы.
+Ищи совпадения по артикулам, кодам, номенклатуре и вариантам подбора.
+
+ВАЖНО: 
+- Верни по ОДНОМУ результату на каждый запрос, "input" - запрос без изменений
+- Если уверенность менее 50%, верни mapping_id: null
+- Используй примеры правильных сопоставлений выше как образец для понимания логики
+
+Ответь ТОЛЬКО в формате JSON-массива:
+[
+    {{"input": "<запрос>", "mapping_id": <id записи из базы или null>, "confidence": <0-100, процент уверенности>}}
+]"""
+
+def split_batch_response(ai_result, texts: List[str]) -> Dict[str, Dict]:
+    """Проверяет ответ AI на пакет и раскладывает его по запросам: {запрос: {mapping_id, confidence}}"""
+    if isinstance(ai_result, dict):
+        # Модель могла обернуть массив в объект: {"results": [...]}
+        ai_result = next((value for value in ai_result.values() if isinstance(value, list)), [])
+    if not isinstance(ai_result, list):
+        return {}
+    
+    expected = set(texts)
+    results = {}
+    for entry in ai_result:
+        if not isinstance(entry, dict):
+            continue
+        text = entry.get('input')
+        if text not in expected or text in results:
+            continue
+        try:
+            mapping_id = int(entry['mapping_id']) if entry.get('mapping_id') is not None else None
+            confidence = float(entry.get('confidence', 0))
+        except (TypeError, ValueError):
+            continue
+        results[text] = {'mapping_id': mapping_id, 'confidence': confidence}
+    return results
+
+def batch_match_result(entry: Dict, mappings_by_id: Dict[int, MappingRecord]) -> Optional[Dict]:
+    """Результат AI-поиска по ответу на один запрос пакета (None - если вариант не найден или уверенность ниже 50%)"""
+    try:
+        mapping_id = int(entry['mapping_id'])
+        confidence = float(entry.get('confidence', 0))
+    except (TypeError, ValueError):
+        return None
+    mapping = mappings_by_id.get(mapping_id)
+    if mapping and 50 <= confidence <= 100:
+        return {
+            'mapping_id': mapping.id,
+            'match_score': confidence,
+            'is_ai_match': True,
+            'reasoning': '',
+            'mapping': mapping
+        }
+    return None
+
+async def ai_interpret_batch(texts: List[str], available_mappings: List[MappingRecord],
+                             candidates: Dict[str, List[MappingRecord]], learning_examples: List[Dict],
+                             version: str) -> List[Optional[Dict]]:
+    """AI-поиск для пакета строк одним запросом к модели (результаты - в порядке строк).
+    
+    В промпт попадают записи-кандидаты всех строк пакета (без повторов). Ответы
+    сохраняются в кэш с версией базы version.
+    """
+    results: Dict[str, Optional[Dict]] = {}
+    try:
+        pending = list(dict.fromkeys(texts))
+        if pending:
+            sample_mappings = {m.id: m for text in pending for m in candidates[text]}
+            sample_data = [mapping_prompt_entry(m) for m in sample_mappings.values()]
+            response = await create_chat_completion(
+                AI_MATCH_CACHE_KIND,
+                model=Config.OPENAI_MODEL,
+                messages=[
+                    {"role": "system", "content": AI_MATCH_SYSTEM_PROMPT},
+                    {"role": "user", "content": build_batch_prompt(pending, sample_data, learning_examples, len(available_mappings))}
+                ],
+                temperature=0.2,
+                max_tokens=AI_BATCH_TOKENS_PER_ROW * len(pending) + AI_BATCH_RESPONSE_RESERVE
+            )
+            ai_response = response.choices[0].message.content.strip()
+            mappings_by_id = {m.id: m for m in available_mappings}
+            try:
+                entries = split_batch_response(parse_ai_json(ai_response), pending)
+            except json.JSONDecodeError as e:
+                print(f"Ошибка парсинга ответа AI на пакет: {e}, ответ: {ai_response}")
+                record_ai_outcome(AI_MATCH_CACHE_KIND, 'parse_error', len(pending))
+                entries = None
+            if entries is not None:
+                for text, entry in entries.items():
+                    results[text] = batch_match_result(entry, mappings_by_id)
+                # Строки, которых нет в ответе (или ответ не массив), - missing
+                record_ai_outcome(AI_MATCH_CACHE_KIND, 'hit', sum(1 for text in entries if results[text]))
+                record_ai_outcome(AI_MATCH_CACHE_KIND, 'rejected', sum(1 for text in entries if not results[text]))
+                record_ai_outcome(AI_MATCH_CACHE_KIND, 'missing', len(pending) - len(entries))
+                await store_responses(AI_MATCH_CACHE_KIND, entries, match_template_hash(), version)
+    except AIBudgetExceeded as e:
+        record_ai_outcome(AI_MATCH_CACHE_KIND, 'budget_exceeded', len(set(texts)))
+        print(f"Пакетный AI-поиск пропущен: {e}")
+    except Exception as e:
+        print(f"Ошибка пакетного AI-поиска: {e}")
+        import traceback
+        traceback.print_exc()
+    return [results.get(text) for text in texts]
 
 def normalize_field(value: Optional[str]) -> Optional[str]:
     """Нормализует поле: пустые значения и "-" становятся None"""
@@ -682,6 +912,46 @@ def normalize_field(value: Optional[str]) -> Optional[str]:
         return None
     return value.strip()
 
+def mapping_result_dict(mapping: ProductMapping) -> Dict:
+    """Поля записи таблицы соответствий для результата распознавания"""
+    return {
+        'id': mapping.id,
+        'article_bl': mapping.article_bl,
+        'article_agb': mapping.article_agb,
+        'variant_1': mapping.variant_1,
+        'variant_2': mapping.variant_2,
+        'variant_3': mapping.variant_3,
+        'variant_4': mapping.variant_4,
+        'variant_5': mapping.variant_5,
+        'variant_6': mapping.variant_6,
+        'variant_7': mapping.variant_7,
+        'variant_8': mapping.variant_8,
+        'unit': mapping.unit,
+        'code': mapping.code,
+        'nomenclature_agb': mapping.nomenclature_agb,
+        'packaging': mapping.packaging,
+    }
+
+def exact_key_match(recognized_text: str) -> Optional[Dict]:
+    """Точное совпадение по нормализованному ключу артикула (без AI и нечеткого поиска)"""
+    for mapping_id, field_name in mapping_catalog.lookup_key(recognized_text):
+        mapping = mapping_catalog.get(mapping_id)
+        if not mapping:
+            continue
+        if hasattr(mapping, field_name):
+            matched_value = getattr(mapping, field_name)
+        else:
+            matched_value = (mapping.competitors or {}).get(field_name)
+        return {
+            'recognized_text': recognized_text,
+            'mapping_id': mapping.id,
+            'match_score': 100.0,
+            'matched_field': field_name,
+            'matched_value': matched_value,
+            'mapping': mapping_result_dict(mapping)
+        }
+    return None
+
 @app.post("/api/mappings", response_model=ProductMappingResponse)
 async def create_mapping(mapping: ProductMappingCreate, db: AsyncSession = Depends(get_db)):
     """Создание новой строки в таблице сопоставления"""
@@ -709,8 +979,14 @@ async def create_mapping(mapping: ProductMappingCreate, db: AsyncSession = Depen
         packaging=normalize_field(mapping.packaging)
     )
     db.add(db_mapping)
+    version_before = mapping_catalog.data_version
+    # ID записи нужен для ключей артикулов - запись и ключи сохраняются одним коммитом
+    await db.flush()
+    await replace_mapping_keys(db, db_mapping)
     await db.commit()
     await db.refresh(db_mapping)
+    mapping_catalog.add(db_mapping)
+    await catalog_written(db, version_before)
     return db_mapping
 
 @app.get("/api/mappings")
@@ -752,75 +1028,74 @@ async def search_mappings(
     limit: int = Query(20, description="Максимальное количество результатов"),
     db: AsyncSession = Depends(get_db)
 ):
-    """Поиск строк с процентом совпадения на основе совпадения слов"""
+    """Поиск строк с процентом совпадения на основе совпадения слов.
+    
+    Оцениваются записи с общим словом, словом-подстрокой или словом с опечаткой; записи,
+    похожие на запрос только целой строкой (SequenceMatcher), - только если таких нет.
+    """
     try:
         if not query or not query.strip():
             return []
         
-        result = await db.execute(select(ProductMapping))
-        all_mappings = result.scalars().all()
+        if fts_enabled():
+            # Ключи артикулов, кандидаты и сами записи - из БД, снимок в памяти не нужен
+            key_matches = await lookup_article_key(db, query)
+        else:
+            await refresh_catalog(db)
+            key_matches = mapping_catalog.lookup_key(query)
+        
+        # Точное совпадение по нормализованному ключу артикула - 100% без нечеткого поиска
+        exact_results = {}
+        for mapping_id, _ in key_matches:
+            exact_results.setdefault(mapping_id, {
+                'mapping_id': mapping_id,
+                'match_score': 100.0,
+                'matched_fields': []
+            })
         
-        search_results = []
+        if len(exact_results) >= limit:
+            candidate_ids = []
+        elif fts_enabled():
+            # Короткий список кандидатов из FTS5 (bm25), окончательная оценка - calculate_similarity
+            candidate_ids = sorted(await fts_candidates(db, query, Config.FTS_CANDIDATE_LIMIT))
+        else:
+            # Кандидаты берутся из индекса: оцениваются только записи, у которых есть
+            # общее слово с запросом, слово-подстрока или слово с опечаткой
+            candidate_ids = mapping_catalog.index.candidates(query)
+            if not candidate_ids:
+                # Похожих по словам записей нет - оцениваются все записи, как при полном переборе:
+                # совпасть они могут только целой строкой (SequenceMatcher)
+                candidate_ids = [record.id for record in mapping_catalog.all()]
+        
+        if fts_enabled():
+            records = await mapping_catalog.load_by_ids(db, list(exact_results) + candidate_ids)
+        else:
+            records = mapping_catalog.records
         
-        for mapping in all_mappings:
-            scores = []
-            matched_fields = []
-            
-            # Проверяем все поля (старые и новые)
-            fields_to_check = {
-                'code_1c': mapping.code_1c,
-                'bortlanger': mapping.bortlanger,
-                'epiroc': mapping.epiroc,
-                'almazgeobur': mapping.almazgeobur,
-                # Новые базовые поля
-                'article_bl': mapping.article_bl,
-                'article_agb': mapping.article_agb,
-                'variant_1': mapping.variant_1,
-                'variant_2': mapping.variant_2,
-                'variant_3': mapping.variant_3,
-                'variant_4': mapping.variant_4,
-                'variant_5': mapping.variant_5,
-                'variant_6': mapping.variant_6,
-                'variant_7': mapping.variant_7,
-                'variant_8': mapping.variant_8,
-                'unit': mapping.unit,
-                'code': mapping.code,
-                'nomenclature_agb': mapping.nomenclature_agb,
-                'packaging': mapping.packaging,
-            }
-            
-            # Проверяем конкурентов
-            if mapping.competitors:
-                for comp_name, comp_value in mapping.competitors.items():
-                    if comp_value:
-                        fields_to_check[comp_name] = comp_value
-            
-            for field_name, field_value in fields_to_check.items():
-                if field_value:
-                    score = calculate_similarity(query, str(field_value))
-                    if score > 0:
-                        scores.append(score)
-                        if score >= min_score:
-                            matched_fields.append(field_name)
-            
-            if scores:
-                max_score = max(scores)
-                if max_score >= min_score:
-                    search_results.append({
-                        'mapping': mapping,
-                        'match_score': round(max_score, 2),
-                        'matched_fields': matched_fields
-                    })
-    
-        # Сортируем по проценту совпадения (по убыванию)
-        search_results.sort(key=lambda x: x['match_score'], reverse=True)
+        # Совпавшие поля записей, найденных по ключу, - как при оценке остальных записей
+        for mapping_id, item in exact_results.items():
+            if mapping_id in records:
+                item['matched_fields'] = search_matched_fields(query, records[mapping_id], min_score)
+        
+        # Отбираем limit лучших результатов; точные совпадения идут первыми
+        top_matches = TopMatches(limit)
+        for position, item in enumerate(exact_results.values()):
+            top_matches.push(item['match_score'], position, item)
+        
+        # Записи-кандидаты оцениваются по убыванию верхней оценки, пока они могут попасть в выдачу
+        # (например, перебор прекращается, когда выдача заполнена совпадениями на 100%)
+        rank_search_matches(query, (
+            (position, records[mapping_id])
+            for position, mapping_id in enumerate(candidate_ids, start=len(exact_results))
+            if mapping_id in records and mapping_id not in exact_results
+        ), min_score, top_matches)
         
-        # Ограничиваем количество результатов
-        search_results = search_results[:limit]
+        # Результаты по убыванию процента совпадения (записи - из снимка или прочитанные из БД)
+        search_results = [item for item in top_matches.items() if item['mapping_id'] in records]
         
         return [
             ProductMappingSearchResponse(
-                mapping=ProductMappingResponse.model_validate(item['mapping']),
+                mapping=ProductMappingResponse.model_validate(records[item['mapping_id']]),
                 match_score=item['match_score'],
                 matched_fields=item['matched_fields']
             )
@@ -875,9 +1150,13 @@ async def update_mapping(
     db_mapping.code = normalize_field(mapping.code)
     db_mapping.nomenclature_agb = normalize_field(mapping.nomenclature_agb)
     db_mapping.packaging = normalize_field(mapping.packaging)
+    await replace_mapping_keys(db, db_mapping)
     
+    version_before = mapping_catalog.data_version
     await db.commit()
     await db.refresh(db_mapping)
+    mapping_catalog.add(db_mapping)
+    await catalog_written(db, version_before)
     return db_mapping
 
 @app.delete("/api/mappings/{mapping_id}")
@@ -888,45 +1167,406 @@ async def delete_mapping(mapping_id: int, db: AsyncSession = Depends(get_db)):
     if not mapping:
         raise HTTPException(status_code=404, detail="Mapping not found")
     await db.delete(mapping)
+    await delete_mapping_keys(db, mapping_id)
+    version_before = mapping_catalog.data_version
     await db.commit()
+    mapping_catalog.remove(mapping_id)
+    await catalog_written(db, version_before)
     return {"message": "Mapping deleted"}
 
-@app.post("/api/mappings/upload")
-async def upload_mapping_file(
-    file: UploadFile = File(...),
-    db: AsyncSession = Depends(get_db)
-):
-    """Загрузка файла с интеллектуальным распознаванием и сопоставлением с таблицей соответствий"""
-    try:
-        # Сохраняем файл
-        file_bytes = await file.read()
-        file_path = await file_processor.save_file(file_bytes, file.filename)
-        
-        # Получаем все записи из таблицы соответствий
-        result = await db.execute(select(ProductMapping))
-        all_mappings = result.scalars().all()
-        
-        # Результаты распознавания и сопоставления
-        # Включаем все обработанные строки, даже если ничего не найдено
-        recognition_results = []
-        all_processed_items = []  # Все обработанные элементы для отчета
-        lines = None  # Инициализируем переменную для не-Excel файлов
-        
-        # Если это Excel файл - используем интеллектуальный анализ структуры
-        if file.content_type in [
-            'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
-            'application/vnd.ms-excel',
-            'application/octet-stream'
-        ] or (file.filename and file.filename.lower().endswith(('.xlsx', '.xls', '.csv'))):
-            try:
-                workbook = openpyxl.load_workbook(file_path, data_only=True)
-                
-                # Анализируем структуру файла с помощью AI
-                structure = await ai_analyze_excel_structure(file_path)
-                
-                # Обрабатываем каждый лист
-                for sheet_name in workbook.sheetnames:
-                    sheet = workbook[sheet_name]
+async def ai_interpret_rows(
+    texts: List[str],
+    available_mappings: List[MappingRecord],
+    on_results: Optional[Callable[[Dict[str, Optional[Dict]]], None]] = None
+) -> List[Optional[Dict]]:
+    """AI-поиск для нескольких строк параллельно (не больше AI_CONCURRENCY запросов одновременно).
+    
+    При AI_BATCH_SIZE > 1 строки отправляются пакетами (несколько строк в одном промпте),
+    иначе - по одной (у каждого запроса своя сессия БД: одну AsyncSession нельзя
+    использовать конкурентно). Результаты возвращаются в порядке входного списка;
+    on_results получает их раньше - по мере ответов модели: {строка: результат или None}.
+    """
+    if not ai_enabled() or not texts:
+        return [None for _ in texts]
+    
+    semaphore = asyncio.Semaphore(max(Config.AI_CONCURRENCY, 1))
+    
+    if Config.AI_BATCH_SIZE <= 1:
+        async def interpret(text: str) -> Optional[Dict]:
+            async with semaphore:
+                async with async_session_maker() as session:
+                    result = await ai_interpret_text(text, available_mappings, session)
+            if on_results:
+                on_results({text: result})
+            return result
+        
+        return list(await asyncio.gather(*(interpret(text) for text in texts)))
+    
+    # Строки, уже отправлявшиеся в AI при той же версии базы, берем из кэша
+    unique_texts = list(dict.fromkeys(texts))
+    async with async_session_maker() as session:
+        version = await get_catalog_version(session)
+    mappings_by_id = {m.id: m for m in available_mappings}
+    cached = await get_cached_responses(AI_MATCH_CACHE_KIND, unique_texts, match_template_hash(), version)
+    results = {text: batch_match_result(entry, mappings_by_id) for text, entry in cached.items()}
+    record_ai_outcome(AI_MATCH_CACHE_KIND, 'cached', len(cached))
+    if on_results and results:
+        on_results(dict(results))
+    pending = [text for text in unique_texts if text not in cached]
+    if not pending:
+        return [results[text] for text in texts]
+    
+    # Примеры одинаковы для всех пакетов; записи-кандидаты - свои у каждой строки
+    learning_examples = confirmed_index.learning_examples()
+    candidates = {text: prompt_mappings(text, available_mappings) for text in pending}
+    candidate_tokens = {
+        text: estimate_tokens(json.dumps([mapping_prompt_entry(m) for m in mappings], ensure_ascii=False, indent=2))
+        for text, mappings in candidates.items()
+    }
+    fixed_prompt = build_batch_prompt([], [], learning_examples, len(available_mappings))
+    batches = split_ai_batches(pending, fixed_prompt, candidate_tokens)
+    
+    async def interpret_batch(batch: List[str]) -> List[Optional[Dict]]:
+        async with semaphore:
+            batch_results = await ai_interpret_batch(batch, available_mappings, candidates, learning_examples, version)
+        if on_results:
+            on_results(dict(zip(batch, batch_results)))
+        return batch_results
+    
+    for batch, batch_results in zip(batches, await asyncio.gather(*(interpret_batch(batch) for batch in batches))):
+        results.update(zip(batch, batch_results))
+    return [results[text] for text in texts]
+
+# Этапы сопоставления строк файла, от дешевых к дорогим
+MATCH_STAGE_NAMES = ('confirmed', 'key', 'fuzzy', 'ai')
+
+def enabled_match_stages() -> List[str]:
+    """Этапы сопоставления из MATCH_STAGES (в заданном порядке, неизвестные пропускаются)"""
+    stages = [name.strip() for name in Config.MATCH_STAGES.split(',')]
+    return [name for name in dict.fromkeys(stages) if name in MATCH_STAGE_NAMES]
+
+def stage_match(recognized_text: str, mapping, match_score: float, matched_field: str, matched_value,
+                is_ai_match: bool = False, is_confirmed: bool = False) -> Dict:
+    """Результат этапа сопоставления для строки файла"""
+    return {
+        'recognized_text': recognized_text,
+        'mapping_id': mapping.id,
+        'match_score': round(match_score, 2),
+        'matched_field': matched_field,
+        'matched_value': matched_value,
+        'is_ai_match': is_ai_match,
+        'is_confirmed': is_confirmed,
+        'mapping': mapping_result_dict(mapping)
+    }
+
+async def match_confirmed_stage(texts: List[str]) -> Dict[str, Dict]:
+    """Этап 1: строки, уже подтвержденные пользователями"""
+    matches = {}
+    for text in texts:
+        confirmed = find_confirmed_match(text)
+        if confirmed:
+            # Поля ответа - как у подтверждения, найденного через AI-поиск раньше (matched_field
+            # 'ai_match', is_ai_match): клиенты и выгрузка в Excel отличают его по is_confirmed
+            matches[text] = stage_match(text, confirmed['mapping'], confirmed['match_score'], 'ai_match', text,
+                                        is_ai_match=True, is_confirmed=True)
+    return matches
+
+async def match_key_stage(texts: List[str]) -> Dict[str, Dict]:
+    """Этап 2: точное совпадение по нормализованному ключу артикула"""
+    matches = {}
+    for text in texts:
+        key_match = exact_key_match(text)
+        if key_match:
+            key_match.update({'is_ai_match': False, 'is_confirmed': False})
+            matches[text] = key_match
+    return matches
+
+# Строк нечеткого поиска между передачами управления event loop (без пула процессов)
+FUZZY_STAGE_CHUNK_ROWS = 16
+
+def fuzzy_stage_match(text: str, fuzzy_match: Optional[Dict]) -> Optional[Dict]:
+    if not fuzzy_match:
+        return None
+    return stage_match(text, fuzzy_match['mapping'], fuzzy_match['match_score'],
+                       fuzzy_match['matched_field'], fuzzy_match['matched_value'])
+
+async def match_fuzzy_stage(
+    texts: List[str],
+    all_mappings: List[MappingRecord],
+    on_matches: Optional[Callable[[Dict[str, Optional[Dict]]], None]] = None
+) -> Dict[str, Dict]:
+    """Этап 3: нечеткий поиск по индексу; большие файлы - в пуле процессов, не блокируя event loop.
+    
+    on_matches получает результаты по мере готовности (без совпадения - None).
+    """
+    if matching_pool.enabled and len(texts) >= Config.MATCH_PARALLEL_MIN_ROWS:
+        fuzzy_results = await matching_pool.match_all(mapping_catalog, texts)
+    else:
+        # В процессе API - частями, отдавая управление event loop между ними
+        # (опрос фоновых задач и потоковая выдача результатов не ждут весь этап)
+        engine = MatchingEngine(all_mappings, mapping_catalog.index)
+        fuzzy_results = []
+        for start in range(0, len(texts), FUZZY_STAGE_CHUNK_ROWS):
+            chunk = texts[start:start + FUZZY_STAGE_CHUNK_ROWS]
+            chunk_results = engine.match_all(chunk)
+            fuzzy_results.extend(chunk_results)
+            if on_matches:
+                on_matches({text: fuzzy_stage_match(text, match) for text, match in zip(chunk, chunk_results)})
+            await asyncio.sleep(0)
+    
+    matches = {}
+    for text, fuzzy_match in zip(texts, fuzzy_results):
+        if fuzzy_match:
+            matches[text] = fuzzy_stage_match(text, fuzzy_match)
+    return matches
+
+def ai_stage_match(text: str, ai_match: Optional[Dict]) -> Optional[Dict]:
+    if not ai_match:
+        return None
+    return stage_match(text, ai_match['mapping'], ai_match.get('match_score', 0), 'ai_match', text, is_ai_match=True)
+
+async def match_ai_stage(
+    texts: List[str],
+    all_mappings: List[MappingRecord],
+    on_matches: Optional[Callable[[Dict[str, Optional[Dict]]], None]] = None
+) -> Dict[str, Dict]:
+    """Этап 4: AI-поиск (дообучение на подтвержденных примерах) - только для строк, не решенных раньше.
+    
+    on_matches получает результаты по мере ответов модели (без совпадения - None).
+    """
+    on_results = None
+    if on_matches:
+        def on_results(results: Dict[str, Optional[Dict]]):
+            on_matches({text: ai_stage_match(text, ai_match) for text, ai_match in results.items()})
+    
+    matches = {}
+    for text, ai_match in zip(texts, await ai_interpret_rows(texts, all_mappings, on_results)):
+        if ai_match:
+            matches[text] = ai_stage_match(text, ai_match)
+    return matches
+
+def normalize_search_value(text: str) -> str:
+    """Нормализованная строка файла: без регистра и лишних пробелов (повторы сопоставляются один раз).
+
+    Совпадает с нормализацией подтверждений: группа повторов и подтверждение любого ее написания
+    дают один ключ.
+    """
+    return normalize_confirmed_text(text)
+
+def match_settings_hash(fuzzy_stop_score: float) -> str:
+    """Хэш настроек, от которых зависит результат сопоставления строки (ключ кэша результатов)"""
+    stages = enabled_match_stages()
+    return template_hash(
+        stages,
+        fuzzy_stop_score,
+        Config.MATCH_AI_STOP_SCORE,
+        Config.SEARCH_BACKEND,
+        (ai_enabled() and match_template_hash()) if 'ai' in stages else None,
+    )
+
+def ai_match_failed() -> bool:
+    """Остались ли строки текущего файла без ответа модели (ошибка, лимит токенов); вне обработки файла - True"""
+    usage = current_ai_usage()
+    if usage is None:
+        return True
+    counters = usage.kinds.get(AI_MATCH_CACHE_KIND)
+    return bool(counters and counters.failures)
+
+def processed_item(recognized_text: str, best_match: Optional[Dict]) -> Dict:
+    """Обработанная строка файла для ответа загрузки (в том числе ненайденная).
+    
+    best_match может быть найден для другого написания той же строки - recognized_text
+    остается как в файле.
+    """
+    # Сохраняем что искали
+    item = {
+        'recognized_text': recognized_text,
+        'mapping_id': None,
+        'match_score': None,
+        'matched_field': None,
+        'matched_value': None,
+        'mapping': None,
+        'is_ai_match': False,
+        'is_confirmed': False
+    }
+    if best_match:
+        item.update(best_match)
+        item['recognized_text'] = recognized_text
+    else:
+        # Если ничего не найдено, все равно добавляем в список
+        item['matched_value'] = 'Не найдено'
+    return item
+
+async def match_recognized_rows(
+    rows: List[str],
+    fuzzy_stop_score: float,
+    all_mappings: List[MappingRecord],
+    on_resolved: Optional[Callable[[Dict[str, Dict]], None]] = None
+) -> Tuple[List[Dict], List[Dict]]:
+    """Сопоставление всех распознанных строк файла с таблицей соответствий.
+    
+    Строки проходят этапы MATCH_STAGES: подтвержденные сопоставления, ключ артикула,
+    нечеткий поиск, AI. Строка выходит из каскада, как только результат этапа набирает
+    его порог (точные этапы - любое совпадение, нечеткий - fuzzy_stop_score, AI -
+    MATCH_AI_STOP_SCORE); иначе остается лучший результат (при равной оценке - более
+    позднего этапа). Строки, совпадающие после нормализации (регистр, пробелы),
+    проверяются один раз - по первому вхождению, результат получают все вхождения.
+    Строки, уже сопоставленные при прошлых загрузках с той же версией базы и теми же
+    настройками, берутся из кэша результатов (match_cache) без прохода по этапам;
+    окончательные результаты новых строк сохраняются в него.
+    
+    Возвращает все обработанные строки (включая ненайденные) и статистику этапов
+    (rows этапа - уникальные строки). on_resolved получает окончательные результаты
+    строк, вышедших из каскада: {строка файла: обработанная строка} - после каждого
+    этапа, а на этапах нечеткого поиска и AI - по мере готовности.
+    """
+    stop_scores = {
+        'confirmed': 0.0,
+        'key': 0.0,
+        'fuzzy': fuzzy_stop_score,
+        'ai': Config.MATCH_AI_STOP_SCORE,
+    }
+    
+    # Нормализованная строка -> первое вхождение (сопоставляется) и все написания в файле
+    unique_rows: Dict[str, str] = {}
+    spellings: Dict[str, List[str]] = {}
+    row_keys = [normalize_search_value(text) for text in rows]
+    for text, key in zip(rows, row_keys):
+        if key not in unique_rows:
+            unique_rows[key] = text
+            spellings[text] = []
+        if text not in spellings[unique_rows[key]]:
+            spellings[unique_rows[key]].append(text)
+    
+    best_matches: Dict[str, Dict] = {}
+    # Строки, окончательный результат которых уже передан в on_resolved
+    reported = set()
+    
+    def report(texts):
+        if not on_resolved:
+            return
+        items = {
+            spelling: processed_item(spelling, best_matches.get(text))
+            for text in texts if text not in reported
+            for spelling in spellings[text]
+        }
+        reported.update(texts)
+        if items:
+            on_resolved(items)
+    
+    def add_match(stage: str, text: str, match: Dict) -> bool:
+        """Запоминает лучший результат строки; True - строка выходит из каскада"""
+        current = best_matches.get(text)
+        if current is None or match['match_score'] >= current['match_score']:
+            best_matches[text] = match
+        return match['match_score'] >= stop_scores[stage]
+    
+    stages = enabled_match_stages()
+    pending = list(unique_rows.values())
+    stage_stats = []
+    # Строки, не найденные в кэше результатов, - сохраняются в него после сопоставления
+    uncached: List[str] = []
+    
+    if match_cache_enabled() and pending:
+        started = time.perf_counter()
+        settings = match_settings_hash(fuzzy_stop_score)
+        async with async_session_maker() as session:
+            version = await get_catalog_version(session)
+        cached = await get_cached_matches(pending, settings, version)
+        for text, match in cached.items():
+            if match:
+                best_matches[text] = match
+        stage_stats.append({
+            'stage': 'cache',
+            'rows': len(pending),
+            'matched': sum(1 for match in cached.values() if match),
+            'resolved': len(cached),
+            'hit_rate': round(len(cached) / len(pending) * 100, 2),
+            'time_ms': round((time.perf_counter() - started) * 1000, 1),
+        })
+        report(list(cached))
+        pending = [text for text in pending if text not in cached]
+        uncached = list(pending)
+    
+    for stage in stages:
+        started = time.perf_counter()
+        last_stage = stage == stages[-1]
+        
+        def on_matches(partial: Dict[str, Optional[Dict]]):
+            """Часть результатов долгого этапа (нечеткий поиск, AI): решенные строки сообщаются сразу"""
+            report([text for text, match in partial.items() if (match and add_match(stage, text, match)) or last_stage])
+        
+        if not pending:
+            matches = {}
+        elif stage == 'confirmed':
+            matches = await match_confirmed_stage(pending)
+        elif stage == 'key':
+            matches = await match_key_stage(pending)
+        elif stage == 'fuzzy':
+            matches = await match_fuzzy_stage(pending, all_mappings, on_matches if on_resolved else None)
+        else:
+            matches = await match_ai_stage(pending, all_mappings, on_matches if on_resolved else None)
+        
+        resolved = set()
+        for text, match in matches.items():
+            if add_match(stage, text, match):
+                resolved.add(text)
+        
+        stage_stats.append({
+            'stage': stage,
+            'rows': len(pending),
+            'matched': len(matches),
+            'resolved': len(resolved),
+            'hit_rate': round(len(resolved) / len(pending) * 100, 2) if pending else 0.0,
+            'time_ms': round((time.perf_counter() - started) * 1000, 1),
+        })
+        report([text for text in pending if text in resolved])
+        pending = [text for text in pending if text not in resolved]
+    
+    # Строки, не решенные ни одним этапом, - с лучшим найденным результатом
+    report(pending)
+    
+    if uncached:
+        # Нерешенные строки сохраняются, только если модель ответила на все запросы:
+        # иначе при повторной загрузке AI может найти для них соответствие
+        unresolved = set(pending) if 'ai' in stages and ai_match_failed() else set()
+        results = {text: best_matches.get(text) for text in uncached if text not in unresolved}
+        await store_matches(results, settings, version)
+    
+    processed_items = [processed_item(text, best_matches.get(unique_rows[key])) for text, key in zip(rows, row_keys)]
+    return processed_items, stage_stats
+
+EXCEL_CONTENT_TYPES = [
+    'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+    'application/vnd.ms-excel',
+    'application/octet-stream'
+]
+
+def is_excel_upload(filename: Optional[str], content_type: Optional[str]) -> bool:
+    """Обрабатывается ли загруженный файл как таблица Excel"""
+    return content_type in EXCEL_CONTENT_TYPES or bool(filename and filename.lower().endswith(('.xlsx', '.xls', '.csv')))
+
+# Строк Excel между передачами управления event loop при чтении файла
+EXCEL_YIELD_ROWS = 1000
+
+async def extract_upload_rows(file_path: str, filename: Optional[str], content_type: Optional[str]) -> Tuple[List[str], float]:
+    """Распознанные строки загруженного файла (артикулы/названия) и порог нечеткого поиска для них"""
+    # Распознанные строки файла (артикулы/названия) - сопоставляются единым пакетом
+    rows = []
+    # Нечеткий поиск с такой оценкой завершает сопоставление строки без AI
+    fuzzy_stop_score = Config.MATCH_FUZZY_STOP_SCORE_EXCEL
+    lines = None  # Инициализируем переменную для не-Excel файлов
+    
+    # Если это Excel файл - используем интеллектуальный анализ структуры
+    if is_excel_upload(filename, content_type):
+        try:
+            # Книга читается потоково, за один проход: структура определяется по первым строкам
+            with open_workbook(file_path) as workbook:
+                structure = None
+                for sheet_index, sheet_rows in enumerate(iter_sheets(workbook)):
+                    if sheet_index == 0:
+                        # Анализируем структуру файла с помощью AI (по первому листу)
+                        structure = await ai_analyze_excel_structure(sheet_rows.sample_data())
                     
                     # Определяем столбцы для поиска
                     article_col = None
@@ -941,10 +1581,9 @@ async def upload_mapping_file(
                     # Если AI не определил, пробуем найти по заголовкам
                     if not article_col and not nomenclature_col:
                         # Ищем заголовки в первых строках
-                        for row_idx in range(1, min(5, sheet.max_row + 1)):
-                            row = sheet[row_idx]
-                            for col_idx, cell in enumerate(row, start=1):
-                                cell_value = str(cell.value).lower() if cell.value else ''
+                        for row_idx, row in enumerate(sheet_rows.head[:4], start=1):
+                            for col_idx, value in enumerate(row, start=1):
+                                cell_value = str(value).lower() if value else ''
                                 if any(keyword in cell_value for keyword in ['артикул', 'номер', 'код', 'article', 'number']):
                                     article_col = col_idx
                                 elif any(keyword in cell_value for keyword in ['номенклатура', 'название', 'наименование', 'name', 'nomenclature']):
@@ -954,7 +1593,13 @@ async def upload_mapping_file(
                                 break
                     
                     # Обрабатываем строки данных
-                    for row_idx, row in enumerate(sheet.iter_rows(min_row=header_row + 1, values_only=True), start=header_row + 1):
+                    for row_idx, row in sheet_rows:
+                        if row_idx <= header_row:
+                            continue
+                        if row_idx % EXCEL_YIELD_ROWS == 0:
+                            # Большой файл не должен надолго занимать event loop
+                            await asyncio.sleep(0)
+                        
                         # Извлекаем значение из нужного столбца
                         search_value = None
                         
@@ -971,280 +1616,219 @@ async def upload_mapping_file(
                         if not search_value or len(search_value) < 2:
                             continue
                         
-                        # Сохраняем что искали
-                        processed_item = {
-                            'recognized_text': search_value,
-                            'mapping_id': None,
-                            'match_score': None,
-                            'matched_field': None,
-                            'matched_value': None,
-                            'mapping': None,
-                            'is_ai_match': False,
-                            'is_confirmed': False
-                        }
-                        
-                        # Ищем совпадения
-                        best_match = None
-                        best_score = 0.0
-                        
-                        # Сначала пробуем AI-поиск
-                        ai_match = await ai_interpret_text(search_value, all_mappings, db)
-                        if ai_match and ai_match.get('match_score', 0) > best_score:
-                            best_score = ai_match['match_score']
-                            mapping = ai_match['mapping']
-                            best_match = {
-                                'recognized_text': search_value,
-                                'mapping_id': mapping.id,
-                                'match_score': round(best_score, 2),
-                                'matched_field': 'ai_match',
-                                'matched_value': search_value,
-                                'is_ai_match': True,
-                                'is_confirmed': ai_match.get('is_confirmed', False),
-                                'mapping': {
-                                    'id': mapping.id,
-                                    'article_bl': mapping.article_bl,
-                                    'article_agb': mapping.article_agb,
-                                    'variant_1': mapping.variant_1,
-                                    'variant_2': mapping.variant_2,
-                                    'variant_3': mapping.variant_3,
-                                    'variant_4': mapping.variant_4,
-                                    'variant_5': mapping.variant_5,
-                                    'variant_6': mapping.variant_6,
-                                    'variant_7': mapping.variant_7,
-                                    'variant_8': mapping.variant_8,
-                                    'unit': mapping.unit,
-                                    'code': mapping.code,
-                                    'nomenclature_agb': mapping.nomenclature_agb,
-                                    'packaging': mapping.packaging,
-                                }
-                            }
-                        
-                        # Если AI не нашел или результат слабый, используем обычный поиск
-                        if not best_match or best_score < 80:
-                            for mapping in all_mappings:
-                                fields_to_check = [
-                                    ('article_bl', mapping.article_bl),
-                                    ('article_agb', mapping.article_agb),
-                                    ('variant_1', mapping.variant_1),
-                                    ('variant_2', mapping.variant_2),
-                                    ('variant_3', mapping.variant_3),
-                                    ('variant_4', mapping.variant_4),
-                                    ('variant_5', mapping.variant_5),
-                                    ('variant_6', mapping.variant_6),
-                                    ('variant_7', mapping.variant_7),
-                                    ('variant_8', mapping.variant_8),
-                                    ('code', mapping.code),
-                                    ('nomenclature_agb', mapping.nomenclature_agb),
-                                ]
-                                
-                                for field_name, field_value in fields_to_check:
-                                    if field_value:
-                                        score = calculate_similarity(search_value, str(field_value))
-                                        if score > best_score:
-                                            best_score = score
-                                            best_match = {
-                                                'recognized_text': search_value,
-                                                'mapping_id': mapping.id,
-                                                'match_score': round(score, 2),
-                                                'matched_field': field_name,
-                                                'matched_value': field_value,
-                                                'mapping': {
-                                                    'id': mapping.id,
-                                                    'article_bl': mapping.article_bl,
-                                                    'article_agb': mapping.article_agb,
-                                                    'variant_1': mapping.variant_1,
-                                                    'variant_2': mapping.variant_2,
-                                                    'variant_3': mapping.variant_3,
-                                                    'variant_4': mapping.variant_4,
-                                                    'variant_5': mapping.variant_5,
-                                                    'variant_6': mapping.variant_6,
-                                                    'variant_7': mapping.variant_7,
-                                                    'variant_8': mapping.variant_8,
-                                                    'unit': mapping.unit,
-                                                    'code': mapping.code,
-                                                    'nomenclature_agb': mapping.nomenclature_agb,
-                                                    'packaging': mapping.packaging,
-                                                }
-                                            }
-                        
-                        # Обновляем processed_item с результатом поиска
-                        if best_match:
-                            processed_item.update(best_match)
-                            recognition_results.append(best_match)
-                        else:
-                            # Если ничего не найдено, все равно добавляем в список
-                            processed_item['matched_value'] = 'Не найдено'
-                        
-                        # Добавляем в общий список всех обработанных элементов
-                        all_processed_items.append(processed_item)
-                
-            except Exception as e:
-                print(f"Ошибка при обработке Excel: {e}")
-                import traceback
-                traceback.print_exc()
-                # Fallback на обычную обработку
-                extracted_text = await file_processor.process_file(file_path, file.content_type)
-                if not extracted_text or not extracted_text.strip():
-                    raise HTTPException(status_code=400, detail="Не удалось извлечь текст из файла")
-                
-                lines = [line.strip() for line in extracted_text.split('\n') if line.strip()]
-        else:
-            # Для других типов файлов используем обычную обработку
-            extracted_text = await file_processor.process_file(file_path, file.content_type)
+                        rows.append(search_value)
             
+        except Exception as e:
+            print(f"Ошибка при обработке Excel: {e}")
+            import traceback
+            traceback.print_exc()
+            # Fallback на обычную обработку
+            extracted_text = await file_processor.process_file(file_path, content_type)
             if not extracted_text or not extracted_text.strip():
                 raise HTTPException(status_code=400, detail="Не удалось извлечь текст из файла")
             
-            # Разбиваем текст на строки (артикулы/названия)
             lines = [line.strip() for line in extracted_text.split('\n') if line.strip()]
+    else:
+        # Для других типов файлов используем обычную обработку
+        extracted_text = await file_processor.process_file(file_path, content_type)
         
-        # Для не-Excel файлов обрабатываем построчно
-        # Проверяем, были ли обработаны строки из Excel
-        excel_processed = len(all_processed_items) > 0
-        
-        if not excel_processed and lines:
-            for line in lines:
-                if not line or len(line) < 2:
-                    continue
-                
-                # Сохраняем что искали
-                processed_item = {
-                    'recognized_text': line,
-                    'mapping_id': None,
-                    'match_score': None,
-                    'matched_field': None,
-                    'matched_value': None,
-                    'mapping': None,
-                    'is_ai_match': False,
-                    'is_confirmed': False
-                }
-                
-                best_match = None
-                best_score = 0.0
-                
-                # ВСЕГДА пробуем AI-поиск для каждой строки (дообучение в процессе работы)
-                ai_match = await ai_interpret_text(line, all_mappings, db)
-                if ai_match and ai_match.get('match_score', 0) > best_score:
-                    best_score = ai_match['match_score']
-                    mapping = ai_match['mapping']
-                    best_match = {
-                        'recognized_text': line,
-                        'mapping_id': mapping.id,
-                        'match_score': round(best_score, 2),
-                        'matched_field': 'ai_match',
-                        'matched_value': line,
-                        'is_ai_match': True,
-                        'is_confirmed': ai_match.get('is_confirmed', False),
-                        'mapping': {
-                            'id': mapping.id,
-                            'article_bl': mapping.article_bl,
-                            'article_agb': mapping.article_agb,
-                            'variant_1': mapping.variant_1,
-                            'variant_2': mapping.variant_2,
-                            'variant_3': mapping.variant_3,
-                            'variant_4': mapping.variant_4,
-                            'variant_5': mapping.variant_5,
-                            'variant_6': mapping.variant_6,
-                            'variant_7': mapping.variant_7,
-                            'variant_8': mapping.variant_8,
-                            'unit': mapping.unit,
-                            'code': mapping.code,
-                            'nomenclature_agb': mapping.nomenclature_agb,
-                            'packaging': mapping.packaging,
-                        }
-                    }
-                
-                # Если AI не нашел или результат слабый (менее 50%), используем обычный поиск как fallback
-                if not best_match or best_score < 50:
-                    # Ищем совпадения во всех полях таблицы
-                    for mapping in all_mappings:
-                        # Проверяем все поля
-                        fields_to_check = [
-                            ('article_bl', mapping.article_bl),
-                            ('article_agb', mapping.article_agb),
-                            ('variant_1', mapping.variant_1),
-                            ('variant_2', mapping.variant_2),
-                            ('variant_3', mapping.variant_3),
-                            ('variant_4', mapping.variant_4),
-                            ('variant_5', mapping.variant_5),
-                            ('variant_6', mapping.variant_6),
-                            ('variant_7', mapping.variant_7),
-                            ('variant_8', mapping.variant_8),
-                            ('code', mapping.code),
-                            ('nomenclature_agb', mapping.nomenclature_agb),
-                        ]
-                        
-                        for field_name, field_value in fields_to_check:
-                            if field_value:
-                                score = calculate_similarity(line, str(field_value))
-                                if score > best_score:
-                                    best_score = score
-                                    best_match = {
-                                        'recognized_text': line,
-                                        'mapping_id': mapping.id,
-                                        'match_score': round(score, 2),
-                                        'matched_field': field_name,
-                                        'matched_value': field_value,
-                                        'mapping': {
-                                            'id': mapping.id,
-                                            'article_bl': mapping.article_bl,
-                                            'article_agb': mapping.article_agb,
-                                            'variant_1': mapping.variant_1,
-                                            'variant_2': mapping.variant_2,
-                                            'variant_3': mapping.variant_3,
-                                            'variant_4': mapping.variant_4,
-                                            'variant_5': mapping.variant_5,
-                                            'variant_6': mapping.variant_6,
-                                            'variant_7': mapping.variant_7,
-                                            'variant_8': mapping.variant_8,
-                                            'unit': mapping.unit,
-                                            'code': mapping.code,
-                                            'nomenclature_agb': mapping.nomenclature_agb,
-                                            'packaging': mapping.packaging,
-                                        }
-                                    }
-                
-                # Обновляем processed_item с результатом поиска
-                if best_match:
-                    processed_item.update(best_match)
-                    recognition_results.append(best_match)
-                else:
-                    # Если ничего не найдено, все равно добавляем в список
-                    processed_item['matched_value'] = 'Не найдено'
-                
-                # Добавляем в общий список всех обработанных элементов
-                all_processed_items.append(processed_item)
-        
-        # Сохраняем результаты в сессию (можно использовать Redis или БД)
-        # Пока сохраняем в файл временно
-        recognized_count = len(all_processed_items)
-        
-        if recognized_count == 0:
-            raise HTTPException(status_code=400, detail="Не удалось обработать файл. Убедитесь, что файл содержит данные.")
+        if not extracted_text or not extracted_text.strip():
+            raise HTTPException(status_code=400, detail="Не удалось извлечь текст из файла")
         
-        session_id = str(uuid.uuid4())
-        results_file = os.path.join(Config.TEMP_DIR, f"results_{session_id}.json")
-        os.makedirs(Config.TEMP_DIR, exist_ok=True)
-        try:
-            with open(results_file, 'w', encoding='utf-8') as f:
-                json.dump(all_processed_items, f, ensure_ascii=False, indent=2)
-        except Exception as e:
-            print(f"Ошибка при сохранении результатов: {e}")
-            # Продолжаем работу даже если не удалось сохранить в файл
-        
-        return {
-            "message": f"Обработано {recognized_count} строк, найдено {len(recognition_results)} совпадений",
-            "recognized_count": recognized_count,
-            "matches_count": len(recognition_results),
-            "results": all_processed_items,  # Возвращаем все результаты, включая "не найдено"
-            "session_id": session_id
-        }
+        # Разбиваем текст на строки (артикулы/названия)
+        lines = [line.strip() for line in extracted_text.split('\n') if line.strip()]
+    
+    # Для не-Excel файлов (или если из Excel ничего не извлечено) обрабатываем построчно
+    if not rows and lines:
+        rows = [line for line in lines if len(line) >= 2]
+        fuzzy_stop_score = Config.MATCH_FUZZY_STOP_SCORE_TEXT
+    
+    return rows, fuzzy_stop_score
+
+def save_upload_results(processed_items: List[Dict]) -> str:
+    """Сохраняет результаты загрузки во временный файл (для выгрузки и повторного получения); возвращает session_id"""
+    # Сохраняем результаты в сессию (можно использовать Redis или БД)
+    # Пока сохраняем в файл временно
+    session_id = str(uuid.uuid4())
+    results_file = os.path.join(Config.TEMP_DIR, f"results_{session_id}.json")
+    os.makedirs(Config.TEMP_DIR, exist_ok=True)
+    try:
+        with open(results_file, 'w', encoding='utf-8') as f:
+            json.dump(processed_items, f, ensure_ascii=False, indent=2)
+    except Exception as e:
+        print(f"Ошибка при сохранении результатов: {e}")
+        # Продолжаем работу даже если не удалось сохранить в файл
+    return session_id
+
+def upload_results_response(session_id: str, processed_items: List[Dict]) -> Dict:
+    """Ответ с результатами загрузки"""
+    recognized_count = len(processed_items)
+    matches_count = sum(1 for item in processed_items if item['mapping_id'] is not None)
+    return {
+        "message": f"Обработано {recognized_count} строк, найдено {matches_count} совпадений",
+        "recognized_count": recognized_count,
+        "matches_count": matches_count,
+        "results": processed_items,  # Возвращаем все результаты, включая "не найдено"
+        "session_id": session_id
+    }
+
+async def process_mapping_upload(
+    file_path: str,
+    filename: Optional[str],
+    content_type: Optional[str],
+    on_rows: Optional[Callable[[List[str]], None]] = None,
+    on_resolved: Optional[Callable[[Dict[str, Dict]], None]] = None
+) -> Dict:
+    """Распознавание и сопоставление сохраненного файла с таблицей соответствий.
+    
+    on_rows получает распознанные строки до начала сопоставления, on_resolved - см.
+    match_recognized_rows. Используется запросом загрузки и фоновыми задачами.
+    """
+    # Запросы к модели при обработке этого файла (токены, стоимость, время) - для ответа
+    ai_usage = start_ai_usage()
+    
+    # Все записи таблицы соответствий - из снимка в памяти (перезагружается, если база изменилась)
+    async with async_session_maker() as session:
+        await refresh_catalog(session)
+    all_mappings = mapping_catalog.all()
+    
+    rows, fuzzy_stop_score = await extract_upload_rows(file_path, filename, content_type)
+    if on_rows:
+        on_rows(rows)
+    
+    # Сопоставляем все строки файла
+    all_processed_items, match_stages = await match_recognized_rows(rows, fuzzy_stop_score, all_mappings, on_resolved)
+    
+    if not all_processed_items:
+        raise HTTPException(status_code=400, detail="Не удалось обработать файл. Убедитесь, что файл содержит данные.")
+    
+    session_id = save_upload_results(all_processed_items)
+    return {
+        **upload_results_response(session_id, all_processed_items),
+        "unique_count": len({normalize_search_value(text) for text in rows}),  # Сколько строк сопоставлялось (без повторов)
+        "match_stages": match_stages,  # Сколько строк решено на каждом этапе и за какое время
+        "ai_usage": ai_usage.as_dict(),  # Запросы к модели: токены, стоимость, время, исходы
+    }
+
+@app.post("/api/mappings/upload")
+async def upload_mapping_file(
+    file: UploadFile = File(...)
+):
+    """Загрузка файла с интеллектуальным распознаванием и сопоставлением с таблицей соответствий"""
+    try:
+        # Сохраняем файл
+        file_bytes = await file.read()
+        file_path = await file_processor.save_file(file_bytes, file.filename)
+        return await process_mapping_upload(file_path, file.filename, file.content_type)
         
     except Exception as e:
         import traceback
         traceback.print_exc()
         raise HTTPException(status_code=500, detail=f"Ошибка при обработке файла: {str(e)}")
 
+@app.post("/api/mappings/upload/stream")
+async def upload_mapping_file_stream(
+    file: UploadFile = File(...)
+):
+    """Загрузка файла с потоковой выдачей результатов (NDJSON: одно событие JSON на строку ответа).
+    
+    События: {"event": "rows", "total"} - сколько строк распознано; {"event": "item", "index",
+    "item"} - результат строки файла, как только он окончательный (порядок - по готовности);
+    {"event": "summary", ...} - итог, как в ответе /api/mappings/upload, но без results;
+    {"event": "error", "detail"} - ошибка обработки.
+    """
+    file_bytes = await file.read()
+    file_path = await file_processor.save_file(file_bytes, file.filename)
+    events: asyncio.Queue = asyncio.Queue()
+    row_indexes: Dict[str, List[int]] = {}
+    
+    def on_rows(rows: List[str]):
+        for index, text in enumerate(rows):
+            row_indexes.setdefault(text, []).append(index)
+        events.put_nowait({"event": "rows", "total": len(rows)})
+    
+    def on_resolved(items: Dict[str, Dict]):
+        for text, item in items.items():
+            for index in row_indexes.get(text, []):
+                events.put_nowait({"event": "item", "index": index, "item": item})
+    
+    async def process():
+        try:
+            result = await process_mapping_upload(file_path, file.filename, file.content_type, on_rows, on_resolved)
+            summary = {key: value for key, value in result.items() if key != "results"}
+            events.put_nowait({"event": "summary", **summary})
+        except HTTPException as e:
+            events.put_nowait({"event": "error", "detail": str(e.detail)})
+        except Exception as e:
+            import traceback
+            traceback.print_exc()
+            events.put_nowait({"event": "error", "detail": f"Ошибка при обработке файла: {str(e)}"})
+        finally:
+            events.put_nowait(None)
+    
+    async def stream():
+        task = asyncio.create_task(process())
+        try:
+            while True:
+                event = await events.get()
+                if event is None:
+                    break
+                yield json.dumps(event, ensure_ascii=False) + "\n"
+        finally:
+            # Клиент отключился - обработка больше не нужна
+            if not task.done():
+                task.cancel()
+    
+    return StreamingResponse(stream(), media_type="application/x-ndjson")
+
+async def run_upload_job(job: UploadJob) -> Dict:
+    """Обработка файла фоновой задачей: число распознанных и обработанных строк - в задаче"""
+    return await process_mapping_upload(
+        job.file_path, job.filename, job.content_type,
+        on_rows=job.set_rows, on_resolved=job.add_resolved
+    )
+
+# Очередь фоновой обработки загруженных файлов (не больше UPLOAD_JOB_WORKERS файлов одновременно)
+upload_jobs = UploadJobQueue(
+    run_upload_job,
+    workers=Config.UPLOAD_JOB_WORKERS,
+    max_queued=Config.UPLOAD_JOB_QUEUE_SIZE,
+    keep_finished=Config.UPLOAD_JOB_KEEP_FINISHED
+)
+
+@app.post("/api/mappings/upload/jobs", status_code=202)
+async def create_upload_job(
+    file: UploadFile = File(...)
+):
+    """Загрузка файла для фоновой обработки: сразу возвращает id задачи (прогресс - GET /api/mappings/upload/jobs/{job_id})"""
+    file_bytes = await file.read()
+    # Файл ждет в очереди - имя уникальное, чтобы его не перезаписала загрузка с тем же именем
+    file_path = await file_processor.save_file(file_bytes, f"{uuid.uuid4().hex}_{file.filename}")
+    try:
+        job = await upload_jobs.submit(file_path, file.filename, file.content_type)
+    except UploadQueueFull as e:
+        os.remove(file_path)
+        raise HTTPException(status_code=503, detail=f"Сервер занят, попробуйте позже ({e})")
+    return job.as_dict()
+
+@app.get("/api/mappings/upload/jobs/{job_id}")
+async def get_upload_job(job_id: str):
+    """Состояние фоновой обработки файла: статус, обработано строк из total, session_id результата"""
+    job = await upload_jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Задача не найдена")
+    return job
+
+@app.get("/api/mappings/upload/results/{session_id}")
+async def get_upload_results(session_id: str):
+    """Результаты обработки файла по session_id (как в ответе загрузки)"""
+    results_file = os.path.join(Config.TEMP_DIR, f"results_{session_id}.json")
+    if not os.path.exists(results_file):
+        raise HTTPException(status_code=404, detail="Результаты не найдены")
+    with open(results_file, 'r', encoding='utf-8') as f:
+        processed_items = json.load(f)
+    return upload_results_response(session_id, processed_items)
+
 @app.post("/api/mappings/confirm")
 async def confirm_mapping(
     recognized_text: str = Query(..., description="Распознанный текст"),
@@ -1278,8 +1862,11 @@ async def confirm_mapping(
             )
             db.add(confirmed)
         
+        version_before = mapping_catalog.data_version
         await db.commit()
         await db.refresh(confirmed)
+        confirmed_index.update(confirmed)
+        await catalog_written(db, version_before)
         
         return {
             "message": "Сопоставление подтверждено",
@@ -1435,102 +2022,112 @@ async def upload_confirmations_file(
         file_bytes = await file.read()
         file_path = await file_processor.save_file(file_bytes, file.filename)
         
-        # Загружаем Excel файл
-        workbook = openpyxl.load_workbook(file_path, data_only=True)
-        sheet = workbook.active
-        
-        # Ищем заголовки
-        header_row = 1
-        headers = {}
-        for col_idx, cell in enumerate(sheet[header_row], start=1):
-            cell_value = str(cell.value).lower() if cell.value else ''
-            if 'распознанный' in cell_value or 'текст' in cell_value or 'что искалось' in cell_value:
-                headers['recognized_text'] = col_idx
-            elif 'id' in cell_value and 'соответствия' in cell_value or 'mapping_id' in cell_value:
-                headers['mapping_id'] = col_idx
-            elif 'совпадение' in cell_value or 'процент' in cell_value or 'match_score' in cell_value:
-                headers['match_score'] = col_idx
-        
-        if 'recognized_text' not in headers or 'mapping_id' not in headers:
-            raise HTTPException(
-                status_code=400, 
-                detail="Файл должен содержать колонки: 'Распознанный текст' (или 'Что искалось') и 'ID соответствия'"
-            )
-        
-        # Обрабатываем строки
-        confirmed_count = 0
-        errors = []
-        
-        for row_idx, row in enumerate(sheet.iter_rows(min_row=header_row + 1, values_only=True), start=header_row + 1):
-            try:
-                # Получаем значения из нужных колонок
-                recognized_text_col = headers['recognized_text'] - 1
-                mapping_id_col = headers['mapping_id'] - 1
-                match_score_col = headers.get('match_score', 0) - 1 if 'match_score' in headers else None
-                
-                if recognized_text_col >= len(row) or mapping_id_col >= len(row):
+        # Загружаем Excel файл (потоково: строки читаются по мере обработки)
+        with open_workbook(file_path) as workbook:
+            sheet_rows = SheetRows(workbook.active, sample_rows=1)
+            
+            # Ищем заголовки
+            header_row = 1
+            headers = {}
+            for col_idx, value in enumerate(sheet_rows.head[0] if sheet_rows.head else (), start=1):
+                cell_value = str(value).lower() if value else ''
+                if 'распознанный' in cell_value or 'текст' in cell_value or 'что искалось' in cell_value:
+                    headers['recognized_text'] = col_idx
+                elif 'id' in cell_value and 'соответствия' in cell_value or 'mapping_id' in cell_value:
+                    headers['mapping_id'] = col_idx
+                elif 'совпадение' in cell_value or 'процент' in cell_value or 'match_score' in cell_value:
+                    headers['match_score'] = col_idx
+            
+            if 'recognized_text' not in headers or 'mapping_id' not in headers:
+                raise HTTPException(
+                    status_code=400, 
+                    detail="Файл должен содержать колонки: 'Распознанный текст' (или 'Что искалось') и 'ID соответствия'"
+                )
+            
+            # Обрабатываем строки
+            confirmed_count = 0
+            errors = []
+            confirmed_rows = []
+            
+            for row_idx, row in sheet_rows:
+                if row_idx <= header_row:
                     continue
-                
-                recognized_text = str(row[recognized_text_col]).strip() if row[recognized_text_col] else None
-                mapping_id_str = str(row[mapping_id_col]).strip() if row[mapping_id_col] else None
-                match_score = None
-                
-                if match_score_col is not None and match_score_col >= 0 and match_score_col < len(row):
+                try:
+                    # Получаем значения из нужных колонок
+                    recognized_text_col = headers['recognized_text'] - 1
+                    mapping_id_col = headers['mapping_id'] - 1
+                    match_score_col = headers.get('match_score', 0) - 1 if 'match_score' in headers else None
+                    
+                    if recognized_text_col >= len(row) or mapping_id_col >= len(row):
+                        continue
+                    
+                    recognized_text = str(row[recognized_text_col]).strip() if row[recognized_text_col] else None
+                    mapping_id_str = str(row[mapping_id_col]).strip() if row[mapping_id_col] else None
+                    match_score = None
+                    
+                    if match_score_col is not None and match_score_col >= 0 and match_score_col < len(row):
+                        try:
+                            match_score = float(row[match_score_col]) if row[match_score_col] else None
+                        except (ValueError, TypeError):
+                            match_score = None
+                    
+                    if not recognized_text or not mapping_id_str:
+                        continue
+                    
+                    # Парсим mapping_id
                     try:
-                        match_score = float(row[match_score_col]) if row[match_score_col] else None
+                        mapping_id = int(float(mapping_id_str))
                     except (ValueError, TypeError):
-                        match_score = None
-                
-                if not recognized_text or not mapping_id_str:
-                    continue
-                
-                # Парсим mapping_id
-                try:
-                    mapping_id = int(float(mapping_id_str))
-                except (ValueError, TypeError):
-                    errors.append(f"Строка {row_idx}: неверный ID соответствия '{mapping_id_str}'")
-                    continue
-                
-                # Проверяем, существует ли mapping
-                mapping_result = await db.execute(
-                    select(ProductMapping).where(ProductMapping.id == mapping_id)
-                )
-                mapping = mapping_result.scalar_one_or_none()
-                
-                if not mapping:
-                    errors.append(f"Строка {row_idx}: сопоставление с ID {mapping_id} не найдено")
-                    continue
-                
-                # Создаем или обновляем подтверждение
-                existing = await db.execute(
-                    select(ConfirmedMapping).where(
-                        ConfirmedMapping.recognized_text == recognized_text,
-                        ConfirmedMapping.mapping_id == mapping_id
+                        errors.append(f"Строка {row_idx}: неверный ID соответствия '{mapping_id_str}'")
+                        continue
+                    
+                    # Проверяем, существует ли mapping
+                    mapping_result = await db.execute(
+                        select(ProductMapping).where(ProductMapping.id == mapping_id)
                     )
-                )
-                confirmed = existing.scalar_one_or_none()
-                
-                if confirmed:
-                    confirmed.user_confirmed += 1
-                    if match_score is not None:
-                        confirmed.match_score = match_score
-                    confirmed.updated_at = datetime.utcnow()
-                else:
-                    confirmed = ConfirmedMapping(
-                        recognized_text=recognized_text,
-                        mapping_id=mapping_id,
-                        match_score=match_score or 100.0,
-                        user_confirmed=1
+                    mapping = mapping_result.scalar_one_or_none()
+                    
+                    if not mapping:
+                        errors.append(f"Строка {row_idx}: сопоставление с ID {mapping_id} не найдено")
+                        continue
+                    
+                    # Создаем или обновляем подтверждение
+                    existing = await db.execute(
+                        select(ConfirmedMapping).where(
+                            ConfirmedMapping.recognized_text == recognized_text,
+                            ConfirmedMapping.mapping_id == mapping_id
+                        )
                     )
-                    db.add(confirmed)
-                
-                confirmed_count += 1
-                
-            except Exception as e:
-                errors.append(f"Строка {row_idx}: ошибка обработки - {str(e)}")
-                continue
-        
+                    confirmed = existing.scalar_one_or_none()
+                    
+                    if confirmed:
+                        confirmed.user_confirmed += 1
+                        if match_score is not None:
+                            confirmed.match_score = match_score
+                        confirmed.updated_at = datetime.utcnow()
+                    else:
+                        confirmed = ConfirmedMapping(
+                            recognized_text=recognized_text,
+                            mapping_id=mapping_id,
+                            match_score=match_score or 100.0,
+                            user_confirmed=1
+                        )
+                        db.add(confirmed)
+                    
+                    confirmed_rows.append(confirmed)
+                    confirmed_count += 1
+                    
+                except Exception as e:
+                    errors.append(f"Строка {row_idx}: ошибка обработки - {str(e)}")
+                    continue
+            
+        version_before = mapping_catalog.data_version
         await db.commit()
+        for confirmed in confirmed_rows:
+            confirmed_index.update(confirmed)
+        # Каждое подтверждение файла - одна запись в confirmed_mappings (изменения строки
+        # сбрасываются в БД до запросов следующей строки)
+        await catalog_written(db, version_before, confirmed_count)
         
         return {
             "message": f"Обработано подтверждений: {confirmed_count}",
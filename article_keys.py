@@ -0,0 +1,114 @@
+"""
+Нормализованные ключи артикулов для точного поиска.
+
+"RH 560-3", "rh560/3" и "RН 560-3" (с кириллической "Н") дают один ключ
+"rh5603", который хранится в индексированной таблице mapping_article_keys.
+Поиск по ключу - один запрос по индексу, без нечеткого перебора.
+"""
+import re
+from typing import List, Optional, Tuple
+
+from sqlalchemy import delete, select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from database import MappingArticleKey, ProductMapping
+
+# Поля с артикулами и кодами, для которых строятся ключи (плюс значения конкурентов)
+ARTICLE_KEY_FIELDS = [
+    'article_bl',
+    'article_agb',
+    'code',
+    'variant_1',
+    'variant_2',
+    'variant_3',
+    'variant_4',
+    'variant_5',
+    'variant_6',
+    'variant_7',
+    'variant_8',
+    'epiroc',
+    'bortlanger',
+    'code_1c',
+]
+
+# Кириллические буквы, совпадающие по начертанию с латинскими (после приведения к нижнему регистру)
+_HOMOGLYPHS = str.maketrans({
+    'а': 'a',
+    'в': 'b',
+    'е': 'e',
+    'ё': 'e',
+    'і': 'i',
+    'к': 'k',
+    'м': 'm',
+    'н': 'h',
+    'о': 'o',
+    'р': 'p',
+    'с': 'c',
+    'т': 't',
+    'у': 'y',
+    'х': 'x',
+})
+
+_SEPARATORS_RE = re.compile(r'[\W_]+')
+
+def normalize_article_key(value) -> Optional[str]:
+    """Ключ артикула: нижний регистр, без разделителей, кириллические двойники заменены латиницей"""
+    if value is None:
+        return None
+    key = _SEPARATORS_RE.sub('', str(value).casefold().translate(_HOMOGLYPHS))
+    return key or None
+
+def mapping_article_keys(mapping) -> List[Tuple[str, str]]:
+    """Пары (поле, ключ) для записи таблицы соответствий"""
+    values = [(field, getattr(mapping, field)) for field in ARTICLE_KEY_FIELDS]
+    if mapping.competitors:
+        values.extend(mapping.competitors.items())
+
+    keys = []
+    for field, value in values:
+        key = normalize_article_key(value)
+        if key:
+            keys.append((field, key))
+    return keys
+
+async def replace_mapping_keys(db: AsyncSession, mapping: ProductMapping):
+    """Пересчитывает ключи записи (вызывать после создания/изменения, коммит - на вызывающей стороне)"""
+    await db.execute(delete(MappingArticleKey).where(MappingArticleKey.mapping_id == mapping.id))
+    for field, key in mapping_article_keys(mapping):
+        db.add(MappingArticleKey(mapping_id=mapping.id, field=field, key=key))
+
+async def delete_mapping_keys(db: AsyncSession, mapping_id: int):
+    """Удаляет ключи записи"""
+    await db.execute(delete(MappingArticleKey).where(MappingArticleKey.mapping_id == mapping_id))
+
+async def rebuild_article_keys(db: AsyncSession) -> int:
+    """Полностью перестраивает таблицу ключей по product_mappings, возвращает число ключей"""
+    await db.execute(delete(MappingArticleKey))
+    result = await db.execute(select(ProductMapping))
+    count = 0
+    for mapping in result.scalars().all():
+        for field, key in mapping_article_keys(mapping):
+            db.add(MappingArticleKey(mapping_id=mapping.id, field=field, key=key))
+            count += 1
+    await db.commit()
+    return count
+
+async def ensure_article_keys(db: AsyncSession):
+    """Заполняет таблицу ключей, если она пуста, а таблица соответствий - нет"""
+    has_keys = await db.scalar(select(MappingArticleKey.id).limit(1))
+    has_mappings = await db.scalar(select(ProductMapping.id).limit(1))
+    if has_mappings and not has_keys:
+        count = await rebuild_article_keys(db)
+        print(f"Построены ключи артикулов: {count}")
+
+async def lookup_article_key(db: AsyncSession, text: str) -> List[Tuple[int, str]]:
+    """Точный поиск по нормализованному ключу: список (mapping_id, поле) по возрастанию ID"""
+    key = normalize_article_key(text)
+    if not key:
+        return []
+    result = await db.execute(
+        select(MappingArticleKey.mapping_id, MappingArticleKey.field)
+        .where(MappingArticleKey.key == key)
+        .order_by(MappingArticleKey.mapping_id, MappingArticleKey.id)
+    )
+    return [(row[0], row[1]) for row in result.all()]
@@ -0,0 +1,255 @@
+#!/usr/bin/env python3
+"""
+Замер AI-пути загрузки файла без обращения к OpenAI.
+
+Файл загружается через /api/mappings/upload (FastAPI TestClient, как запрос
+мини-приложения), вместо модели работает локальная замена (AI_PROVIDER=fake)
+с заданной задержкой, долей ошибок и ответов 429. Скрипт выводит пропускную
+способность загрузки, статистику этапов сопоставления, перцентили задержки
+запросов к модели и строк на этапе AI, расход токенов. Загрузки идут в копию
+SQLite-базы во временном каталоге (рабочая БД не меняется), там же - файлы
+загрузок и результатов; кэши ответов AI и результатов сопоставления без
+--cache отключены.
+
+Примеры:
+    python benchmark_ai.py --rows 500 --latency-ms 800 --concurrency 8 --batch-size 20
+    python benchmark_ai.py --file "КП БИ+Химия.xlsx" --stages ai --rate-limit-rate 0.1
+"""
+import argparse
+import atexit
+import json
+import mimetypes
+import os
+import random
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+from typing import Dict, List
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Замер AI-пути загрузки файла с локальной заменой модели")
+    parser.add_argument("--file", help="Файл для загрузки (по умолчанию - сгенерированный Excel из таблицы соответствий)")
+    parser.add_argument("--rows", type=int, default=300, help="Строк в сгенерированном файле")
+    parser.add_argument("--repeat", type=int, default=1, help="Сколько раз загрузить файл")
+    parser.add_argument("--stages", help="Этапы сопоставления (MATCH_STAGES), например 'ai' - все строки через AI")
+    parser.add_argument("--latency-ms", type=float, default=800, help="Средняя задержка ответа модели, мс")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Доля ответов с ошибкой сервера (0-1)")
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0, help="Доля ответов 429 (0-1)")
+    parser.add_argument("--retry-base-delay", type=float, default=0.2, help="Начальная задержка повтора при 429, сек")
+    parser.add_argument("--concurrency", type=int, help="AI_CONCURRENCY")
+    parser.add_argument("--batch-size", type=int, help="AI_BATCH_SIZE")
+    parser.add_argument("--rpm", type=int, help="OPENAI_REQUESTS_PER_MINUTE")
+    parser.add_argument("--cache", action="store_true", help="Не отключать кэш ответов AI и кэш результатов сопоставления")
+    parser.add_argument("--seed", type=int, default=0, help="Зерно замены модели и генератора файла")
+    return parser.parse_args()
+
+def use_database_copy() -> str:
+    """Подменяет DATABASE_URL копией SQLite-базы во временном каталоге (удаляется при выходе),
+    возвращает этот каталог"""
+    from dotenv import load_dotenv
+    from sqlalchemy.engine import make_url
+
+    load_dotenv()
+    url = make_url(os.getenv("DATABASE_URL", "sqlite+aiosqlite:///./data/database.db"))
+    if url.get_backend_name() != "sqlite" or not url.database or url.database == ":memory:":
+        print(f"Замер работает только с файловой SQLite-базой, DATABASE_URL: {url}")
+        sys.exit(1)
+    if not os.path.exists(url.database):
+        print(f"База данных не найдена: {url.database} (задайте DATABASE_URL)")
+        sys.exit(1)
+
+    temp_dir = tempfile.mkdtemp(prefix="benchmark_ai_")
+    atexit.register(shutil.rmtree, temp_dir, True)
+    copy_path = os.path.join(temp_dir, "database.db")
+    # backup - согласованная копия, даже если база сейчас открыта API
+    source, copy = sqlite3.connect(url.database), sqlite3.connect(copy_path)
+    try:
+        source.backup(copy)
+    finally:
+        source.close()
+        copy.close()
+    os.environ["DATABASE_URL"] = url.set(database=copy_path).render_as_string(hide_password=False)
+    return temp_dir
+
+def configure_environment(args):
+    """Настройки читаются config.py при импорте - задаем их до импорта API"""
+    temp_dir = use_database_copy()
+    os.environ["AI_PROVIDER"] = "fake"
+    os.environ["AI_FAKE_LATENCY_MS"] = str(args.latency_ms)
+    os.environ["AI_FAKE_ERROR_RATE"] = str(args.error_rate)
+    os.environ["AI_FAKE_RATE_LIMIT_RATE"] = str(args.rate_limit_rate)
+    os.environ["AI_FAKE_SEED"] = str(args.seed)
+    os.environ["OPENAI_RETRY_BASE_DELAY"] = str(args.retry_base_delay)
+    if not args.cache:
+        os.environ["LLM_CACHE_MAX_ENTRIES"] = "0"
+        os.environ["MATCH_CACHE_MAX_ENTRIES"] = "0"
+    if args.stages:
+        os.environ["MATCH_STAGES"] = args.stages
+    if args.concurrency is not None:
+        os.environ["AI_CONCURRENCY"] = str(args.concurrency)
+    if args.batch_size is not None:
+        os.environ["AI_BATCH_SIZE"] = str(args.batch_size)
+    if args.rpm is not None:
+        os.environ["OPENAI_REQUESTS_PER_MINUTE"] = str(args.rpm)
+
+    # Загруженный файл, сгенерированный Excel и results_*.json - во временном каталоге, а не в uploads/ и temp/
+    from config import Config
+    Config.UPLOAD_DIR = os.path.join(temp_dir, "uploads")
+    Config.TEMP_DIR = os.path.join(temp_dir, "temp")
+
+def percentile(values: List[float], percent: float) -> float:
+    """Перцентиль (ближайший ранг)"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, int(round(percent / 100 * len(ordered) + 0.5)) - 1))
+    return ordered[index]
+
+def format_latencies(values: List[float]) -> str:
+    return " ".join(f"p{p}={percentile(values, p) * 1000:.0f}мс" for p in (50, 90, 99))
+
+def generate_file(path: str, mappings, rows: int, seed: int):
+    """Excel в формате поставщика: артикулы как в базе, с опечатками и незнакомые позиции"""
+    import openpyxl
+
+    rng = random.Random(seed)
+    workbook = openpyxl.Workbook()
+    sheet = workbook.active
+    sheet.append(["Артикул", "Наименование", "Кол-во"])
+    for _ in range(rows):
+        mapping = rng.choice(mappings)
+        name = mapping.nomenclature_agb or mapping.article_agb or "позиция"
+        kind = rng.random()
+        if kind < 0.3:
+            article = mapping.article_agb or mapping.article_bl
+        elif kind < 0.6:
+            article = None
+            position = rng.randrange(len(name))
+            name = name[:position] + name[position + 1:]
+        else:
+            article = None
+            name = f"{rng.choice(name.split() or ['позиция'])} {rng.randint(100, 99999)}"
+        sheet.append([article, name, rng.randint(1, 20)])
+    workbook.save(path)
+
+def main():
+    args = parse_args()
+    configure_environment(args)
+
+    import logging
+    logging.disable(logging.CRITICAL)
+
+    import database
+    database.engine.echo = False
+
+    from fastapi.testclient import TestClient
+
+    import api
+    from ai_client import get_ai_client, set_ai_client
+    from ai_providers import LLMProvider
+
+    class RecordingProvider(LLMProvider):
+        """Обертка поставщика: время, токены и исход каждого запроса"""
+
+        name = "recording"
+
+        def __init__(self, inner: LLMProvider):
+            self.inner = inner
+            self.calls: List[Dict] = []
+            self.started = time.perf_counter()
+
+        async def complete(self, **kwargs):
+            started = time.perf_counter()
+            call = {"rows": 0, "prompt_tokens": 0, "completion_tokens": 0}
+            try:
+                response = await self.inner.complete(**kwargs)
+            except Exception as e:
+                call.update(status=type(e).__name__, latency=time.perf_counter() - started)
+                self.calls.append(call)
+                raise
+            finished = time.perf_counter()
+            try:
+                content = json.loads(response.choices[0].message.content)
+            except ValueError:
+                content = None
+            # Строк в ответе: массив - пакет строк, объект с mapping_id - одна строка, иначе - структура таблицы
+            if isinstance(content, list):
+                call["rows"] = len(content)
+            elif isinstance(content, dict) and "mapping_id" in content:
+                call["rows"] = 1
+            call.update(
+                status="ok",
+                latency=finished - started,
+                finished=finished - self.started,
+                prompt_tokens=response.usage.prompt_tokens if response.usage else 0,
+                completion_tokens=response.usage.completion_tokens if response.usage else 0,
+            )
+            self.calls.append(call)
+            return response
+
+        async def close(self):
+            await self.inner.close()
+
+    with TestClient(api.app) as client:
+        provider = RecordingProvider(get_ai_client())
+        set_ai_client(provider)
+
+        file_path = args.file
+        if not file_path:
+            os.makedirs(api.Config.TEMP_DIR, exist_ok=True)
+            file_path = os.path.join(api.Config.TEMP_DIR, "benchmark_ai.xlsx")
+            generate_file(file_path, api.mapping_catalog.all(), args.rows, args.seed)
+
+        print(f"Файл: {file_path}; модель: задержка {args.latency_ms:.0f} мс, ошибки {args.error_rate:.0%}, 429 {args.rate_limit_rate:.0%}")
+        print(f"AI_CONCURRENCY={api.Config.AI_CONCURRENCY} AI_BATCH_SIZE={api.Config.AI_BATCH_SIZE} "
+              f"MATCH_STAGES={api.Config.MATCH_STAGES} кэши {'включены' if args.cache else 'отключены'}")
+
+        content_type = mimetypes.guess_type(file_path)[0] or "application/octet-stream"
+        for run in range(1, args.repeat + 1):
+            provider.calls = []
+            with open(file_path, "rb") as upload:
+                provider.started = time.perf_counter()
+                response = client.post(
+                    "/api/mappings/upload",
+                    files={"file": (os.path.basename(file_path), upload, content_type)},
+                )
+                elapsed = time.perf_counter() - provider.started
+            if response.status_code != 200:
+                print(f"Ошибка загрузки: {response.status_code} {response.text[:300]}")
+                sys.exit(1)
+            result = response.json()
+
+            rows = result["recognized_count"]
+            print(f"\nЗагрузка {run}: {rows} строк (уникальных {result.get('unique_count', rows)}) за {elapsed:.2f} с "
+                  f"({rows / elapsed:.1f} строк/с), найдено {result['matches_count']}")
+            for stage in result.get("match_stages", []):
+                print(f"  {stage['stage']:<10} строк {stage['rows']:>5}  решено {stage['resolved']:>5} "
+                      f"({stage['hit_rate']:>5.1f}%)  {stage['time_ms']:>9.1f} мс")
+
+            calls = provider.calls
+            ok_calls = [call for call in calls if call["status"] == "ok"]
+            failed = {}
+            for call in calls:
+                if call["status"] != "ok":
+                    failed[call["status"]] = failed.get(call["status"], 0) + 1
+            print(f"  Запросов к модели: {len(calls)} (успешно {len(ok_calls)}"
+                  + "".join(f", {status} {count}" for status, count in failed.items()) + ")")
+            if ok_calls:
+                print(f"  Задержка запроса: {format_latencies([call['latency'] for call in ok_calls])}")
+                row_latencies = [call["finished"] for call in ok_calls for _ in range(call["rows"])]
+                if row_latencies:
+                    print(f"  Строка получила ответ AI через (от начала загрузки): {format_latencies(row_latencies)}")
+                prompt_tokens = sum(call["prompt_tokens"] for call in ok_calls)
+                completion_tokens = sum(call["completion_tokens"] for call in ok_calls)
+                ai_rows = sum(call["rows"] for call in ok_calls)
+                print(f"  Токены: промпт {prompt_tokens}, ответ {completion_tokens}, всего {prompt_tokens + completion_tokens}"
+                      + (f" ({(prompt_tokens + completion_tokens) / ai_rows:.0f} на строку AI)" if ai_rows else ""))
+            usage = result.get("ai_usage")
+            if usage:
+                outcomes = ", ".join(f"{outcome} {count}" for outcome, count in usage["outcomes"].items())
+                print(f"  Стоимость: ${usage['cost_usd']:.4f}; исходы: {outcomes or '-'}")
+
+if __name__ == "__main__":
+    main()
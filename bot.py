@@ -180,10 +180,8 @@ async def handle_file(message: Message, state: FSMContext):
         
         # Формируем правильный URL для API
         api_base = Config.API_URL.rstrip('/')
-        if api_base.endswith('/api'):
-            api_url = f"{api_base}/mappings/upload"
-        else:
-            api_url = f"{api_base}/api/mappings/upload"
+        if not api_base.endswith('/api'):
+            api_base = f"{api_base}/api"
         form_data = aiohttp.FormData()
         form_data.add_field('file', 
                           io.BytesIO(file_bytes),
@@ -191,7 +189,37 @@ async def handle_file(message: Message, state: FSMContext):
                           content_type=file_type)
         
         async with aiohttp.ClientSession() as session:
-            async with session.post(api_url, data=form_data, timeout=aiohttp.ClientTimeout(total=300)) as resp:
+            # Файл обрабатывается в фоне: ставим задачу и опрашиваем ее состояние
+            async with session.post(f"{api_base}/mappings/upload/jobs", data=form_data, timeout=aiohttp.ClientTimeout(total=60)) as resp:
+                if resp.status not in (200, 202):
+                    error_text = await resp.text()
+                    await processing_msg.edit_text(f"❌ Ошибка API: {error_text}")
+                    return
+                
+                job = await resp.json()
+            
+            job_url = f"{api_base}/mappings/upload/jobs/{job['job_id']}"
+            last_progress = None
+            while job['status'] not in ('done', 'error'):
+                await asyncio.sleep(2)
+                async with session.get(job_url, timeout=aiohttp.ClientTimeout(total=30)) as resp:
+                    if resp.status != 200:
+                        error_text = await resp.text()
+                        await processing_msg.edit_text(f"❌ Ошибка API: {error_text}")
+                        return
+                    
+                    job = await resp.json()
+                
+                progress = (job['processed'], job['total'])
+                if job['status'] == 'processing' and job['total'] and progress != last_progress:
+                    await processing_msg.edit_text(f"🔍 Обработано строк: {job['processed']} из {job['total']}")
+                    last_progress = progress
+            
+            if job['status'] == 'error':
+                await processing_msg.edit_text(f"❌ Ошибка API: {job['error']}")
+                return
+            
+            async with session.get(f"{api_base}/mappings/upload/results/{job['session_id']}", timeout=aiohttp.ClientTimeout(total=60)) as resp:
                 if resp.status != 200:
                     error_text = await resp.text()
                     await processing_msg.edit_text(f"❌ Ошибка API: {error_text}")
@@ -0,0 +1,190 @@
+"""
+Снимок таблицы соответствий в памяти процесса.
+
+Поиск и сопоставление загруженных файлов читают записи из снимка, а не из БД:
+строки product_mappings загружаются один раз (без ORM-объектов), строки
+интернируются, поля для поиска заранее разбиты на слова. Запись через API
+обновляет снимок и увеличивает его версию. Снимок помнит версию данных БД
+(data_version), по которой построен: изменения, сделанные другими процессами
+(скрипты импорта, другие uvicorn workers), меняют ее, и API перезагружает
+снимок при следующем запросе.
+"""
+import sys
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from article_keys import mapping_article_keys, normalize_article_key
+from database import ProductMapping
+from search_index import MappingSearchIndex, mapping_search_fields, tokenize
+
+# Колонки product_mappings, которые хранятся в снимке
+MAPPING_COLUMNS = tuple(column.name for column in ProductMapping.__table__.columns)
+
+# Сколько ID записей читается из БД одним запросом
+LOAD_BY_IDS_CHUNK = 500
+
+# Поля, по которым подбирается короткий список похожих записей (для промпта AI)
+SHORTLIST_FIELDS = {
+    'article_bl',
+    'article_agb',
+    'code',
+    'variant_1',
+    'variant_2',
+    'variant_3',
+    'variant_4',
+    'variant_5',
+    'variant_6',
+    'variant_7',
+    'variant_8',
+    'nomenclature_agb',
+}
+
+def _intern(value):
+    """Интернирует строки (повторяющиеся значения хранятся в одном экземпляре)"""
+    if isinstance(value, str):
+        return sys.intern(value)
+    if isinstance(value, dict):
+        return {_intern(key): _intern(item) for key, item in value.items()}
+    return value
+
+class MappingRecord:
+    """Копия строки product_mappings только для чтения (без сессии и identity map)"""
+
+    __slots__ = MAPPING_COLUMNS + ('search_fields', 'field_words')
+
+    def __init__(self, values):
+        for name in MAPPING_COLUMNS:
+            setattr(self, name, _intern(values[name]))
+        # Непустые поля для поиска и их слова
+        self.search_fields: Dict[str, str] = {
+            _intern(name): _intern(value) for name, value in mapping_search_fields(self).items()
+        }
+        self.field_words = {
+            name: frozenset(sys.intern(word) for word in tokenize(value))
+            for name, value in self.search_fields.items()
+        }
+
+    @classmethod
+    def from_mapping(cls, mapping) -> 'MappingRecord':
+        """Снимок ORM-объекта ProductMapping"""
+        return cls({name: getattr(mapping, name) for name in MAPPING_COLUMNS})
+
+class MappingCatalog:
+    """Записи таблицы соответствий, ключи артикулов и поисковый индекс по ним"""
+
+    def __init__(self):
+        self.records: Dict[int, MappingRecord] = {}
+        self.index = MappingSearchIndex()
+        self._keys: Dict[str, List[Tuple[int, str]]] = {}
+        self._ordered: Optional[List[MappingRecord]] = None
+        self.loaded = False
+        # Увеличивается при каждом изменении снимка
+        self.version = 0
+        # Версия данных БД (data_version), по которой построен снимок
+        self.data_version: Optional[str] = None
+
+    def __len__(self) -> int:
+        return len(self.records)
+
+    async def load(self, db: AsyncSession):
+        """Полная загрузка снимка из product_mappings"""
+        result = await db.execute(select(*ProductMapping.__table__.columns).order_by(ProductMapping.id))
+        self.build(MappingRecord(row._mapping) for row in result)
+
+    def build(self, records: Iterable[MappingRecord]):
+        """Строит снимок заново по списку записей"""
+        self.records = {}
+        self._keys = {}
+        for record in records:
+            self.records[record.id] = record
+            self._add_keys(record)
+        self.index.build(self.records.values())
+        self._ordered = None
+        self.loaded = True
+        self.version += 1
+
+    async def load_by_ids(self, db: AsyncSession, mapping_ids: Iterable[int]) -> Dict[int, MappingRecord]:
+        """Записи по ID прямо из product_mappings (без загрузки снимка)"""
+        mapping_ids = list(dict.fromkeys(mapping_ids))
+        records = {}
+        # Частями: число параметров запроса в SQLite ограничено
+        for start in range(0, len(mapping_ids), LOAD_BY_IDS_CHUNK):
+            result = await db.execute(
+                select(*ProductMapping.__table__.columns)
+                .where(ProductMapping.id.in_(mapping_ids[start:start + LOAD_BY_IDS_CHUNK]))
+            )
+            records.update((row.id, MappingRecord(row._mapping)) for row in result)
+        return records
+
+    def add(self, mapping) -> MappingRecord:
+        """Добавляет или обновляет запись (ORM-объект копируется в снимок; до загрузки снимка - только копия)"""
+        record = mapping if isinstance(mapping, MappingRecord) else MappingRecord.from_mapping(mapping)
+        if not self.loaded:
+            return record
+        self._remove_keys(record.id)
+        self.records[record.id] = record
+        self._add_keys(record)
+        self.index.add(record)
+        self._ordered = None
+        self.version += 1
+        return record
+
+    def remove(self, mapping_id: int):
+        """Удаляет запись из снимка"""
+        if mapping_id not in self.records:
+            return
+        # Ключи записи находятся по ее полям - до удаления записи
+        self._remove_keys(mapping_id)
+        del self.records[mapping_id]
+        self.index.remove(mapping_id)
+        self._ordered = None
+        self.version += 1
+
+    def _add_keys(self, record: MappingRecord):
+        for field, key in mapping_article_keys(record):
+            entries = self._keys.setdefault(sys.intern(key), [])
+            entries.append((record.id, field))
+            # Порядок как в lookup_article_key: по ID записи, внутри записи - по порядку полей
+            if len(entries) > 1 and entries[-2][0] > record.id:
+                entries.sort(key=lambda entry: entry[0])
+
+    def _remove_keys(self, mapping_id: int):
+        record = self.records.get(mapping_id)
+        if record is None:
+            return
+        for _, key in mapping_article_keys(record):
+            entries = self._keys.get(key)
+            if entries is None:
+                continue
+            entries[:] = [entry for entry in entries if entry[0] != mapping_id]
+            if not entries:
+                del self._keys[key]
+
+    def get(self, mapping_id: int) -> Optional[MappingRecord]:
+        """Запись по ID"""
+        return self.records.get(mapping_id)
+
+    def all(self) -> List[MappingRecord]:
+        """Все записи по возрастанию ID"""
+        if self._ordered is None:
+            self._ordered = [self.records[mapping_id] for mapping_id in sorted(self.records)]
+        return self._ordered
+
+    def lookup_key(self, text: str) -> List[Tuple[int, str]]:
+        """Точный поиск по нормализованному ключу артикула: список (mapping_id, поле) по возрастанию ID"""
+        key = normalize_article_key(text)
+        if not key:
+            return []
+        return list(self._keys.get(key, ()))
+
+    def shortlist(self, text: str, limit: int) -> List[MappingRecord]:
+        """Короткий список похожих записей: сначала точные совпадения по ключу артикула,
+        затем записи с наибольшим числом общих (или похожих) слов в артикулах, вариантах и номенклатуре"""
+        mapping_ids = list(dict.fromkeys(mapping_id for mapping_id, _ in self.lookup_key(text)))
+        if len(mapping_ids) < limit:
+            for mapping_id in self.index.top_candidates(text, limit, SHORTLIST_FIELDS):
+                if mapping_id not in mapping_ids:
+                    mapping_ids.append(mapping_id)
+        return [self.records[mapping_id] for mapping_id in mapping_ids[:limit] if mapping_id in self.records]
@@ -10,6 +10,21 @@ class Config:
     # Database
     DATABASE_URL = os.getenv("DATABASE_URL", "sqlite+aiosqlite:///./data/database.db")
     
+    # Search
+    SEARCH_BACKEND = os.getenv("SEARCH_BACKEND", "memory")  # memory - индекс в памяти процесса, fts5 - SQLite FTS5
+    FTS_CANDIDATE_LIMIT = int(os.getenv("FTS_CANDIDATE_LIMIT", "500"))  # Сколько записей FTS5 отдает на дооценку
+    
+    # Matching
+    MATCH_PROCESSES = int(os.getenv("MATCH_PROCESSES", "0"))  # Процессов для сопоставления файлов: 0 - по числу ядер, 1 - без пула
+    MATCH_PARALLEL_MIN_ROWS = int(os.getenv("MATCH_PARALLEL_MIN_ROWS", "200"))  # С какого числа уникальных строк включается пул
+    MATCH_STAGES = os.getenv("MATCH_STAGES", "confirmed,key,fuzzy,ai")  # Этапы сопоставления строк файла по порядку
+    MATCH_FUZZY_STOP_SCORE_EXCEL = float(os.getenv("MATCH_FUZZY_STOP_SCORE_EXCEL", "80"))  # Оценка нечеткого поиска, при которой строка Excel не идет в AI
+    MATCH_FUZZY_STOP_SCORE_TEXT = float(os.getenv("MATCH_FUZZY_STOP_SCORE_TEXT", "50"))  # То же для текста из PDF/изображений/Word
+    MATCH_AI_STOP_SCORE = float(os.getenv("MATCH_AI_STOP_SCORE", "50"))  # Уверенность AI, при которой строка не идет на следующие этапы
+    UPLOAD_JOB_WORKERS = int(os.getenv("UPLOAD_JOB_WORKERS", "2"))  # Сколько файлов фоновых загрузок обрабатывается одновременно
+    UPLOAD_JOB_QUEUE_SIZE = int(os.getenv("UPLOAD_JOB_QUEUE_SIZE", "100"))  # Сколько файлов может ждать в очереди
+    UPLOAD_JOB_KEEP_FINISHED = int(os.getenv("UPLOAD_JOB_KEEP_FINISHED", "500"))  # Сколько завершенных задач хранится для опроса
+    
     # Web App
     WEB_APP_URL = os.getenv("WEB_APP_URL", "http://localhost:3000")
     API_URL = os.getenv("API_URL", "http://localhost:8000")
@@ -34,5 +49,29 @@ class Config:
     
     # AI Settings
     OPENAI_API_KEY = os.getenv("OPENAI_API_KEY", "")
+    AI_PROVIDER = os.getenv("AI_PROVIDER", "openai")  # openai или fake - локальная замена модели для замеров без сети
     OPENAI_MODEL = os.getenv("OPENAI_MODEL", "gpt-3.5-turbo")  # Используем недорогую модель
+    OPENAI_TIMEOUT = float(os.getenv("OPENAI_TIMEOUT", "30"))  # Таймаут запроса к модели, сек
+    OPENAI_CONNECT_TIMEOUT = float(os.getenv("OPENAI_CONNECT_TIMEOUT", "5"))  # Таймаут установки соединения, сек
+    OPENAI_MAX_RETRIES = int(os.getenv("OPENAI_MAX_RETRIES", "2"))  # Повторы при сетевых ошибках, таймаутах и 5xx (без 429)
+    OPENAI_MAX_CONNECTIONS = int(os.getenv("OPENAI_MAX_CONNECTIONS", "20"))  # Размер пула HTTP-соединений
+    OPENAI_KEEPALIVE_EXPIRY = float(os.getenv("OPENAI_KEEPALIVE_EXPIRY", "60"))  # Сколько держать простаивающее соединение, сек
+    OPENAI_REQUESTS_PER_MINUTE = int(os.getenv("OPENAI_REQUESTS_PER_MINUTE", "500"))  # Квота запросов в минуту (0 - без ограничения)
+    OPENAI_RATE_LIMIT_RETRIES = int(os.getenv("OPENAI_RATE_LIMIT_RETRIES", "5"))  # Повторы при 429 (rate limit)
+    OPENAI_RETRY_BASE_DELAY = float(os.getenv("OPENAI_RETRY_BASE_DELAY", "1"))  # Начальная задержка повтора при 429 и ошибках, сек
+    AI_CONCURRENCY = int(os.getenv("AI_CONCURRENCY", "8"))  # Сколько запросов к AI при сопоставлении файла выполняется одновременно
+    AI_BATCH_SIZE = int(os.getenv("AI_BATCH_SIZE", "1"))  # Строк файла в одном промпте (1 - по одной строке, пакеты включаются явно)
+    AI_CONTEXT_TOKENS = int(os.getenv("AI_CONTEXT_TOKENS", "16385"))  # Контекстное окно модели (промпт + ответ), токенов
+    AI_SHORTLIST_SIZE = int(os.getenv("AI_SHORTLIST_SIZE", "10"))  # Сколько похожих записей базы отправляется в промпт на строку
+    OPENAI_PROMPT_PRICE_PER_1K = float(os.getenv("OPENAI_PROMPT_PRICE_PER_1K", "0.0005"))  # Цена 1000 токенов промпта, USD (для учета расходов)
+    OPENAI_COMPLETION_PRICE_PER_1K = float(os.getenv("OPENAI_COMPLETION_PRICE_PER_1K", "0.0015"))  # Цена 1000 токенов ответа, USD
+    AI_FILE_TOKEN_BUDGET = int(os.getenv("AI_FILE_TOKEN_BUDGET", "0"))  # Лимит токенов на обработку одного файла (0 - без ограничения)
+    AI_FAKE_LATENCY_MS = float(os.getenv("AI_FAKE_LATENCY_MS", "800"))  # Средняя задержка ответа замены модели, мс
+    AI_FAKE_ERROR_RATE = float(os.getenv("AI_FAKE_ERROR_RATE", "0"))  # Доля ответов с ошибкой сервера (0-1)
+    AI_FAKE_RATE_LIMIT_RATE = float(os.getenv("AI_FAKE_RATE_LIMIT_RATE", "0"))  # Доля ответов 429 (0-1)
+    AI_FAKE_SEED = int(os.getenv("AI_FAKE_SEED", "0"))  # Зерно случайных чисел замены модели
+    LLM_CACHE_TTL_DAYS = float(os.getenv("LLM_CACHE_TTL_DAYS", "30"))  # Сколько дней хранится ответ AI в кэше (0 - без ограничения)
+    LLM_CACHE_MAX_ENTRIES = int(os.getenv("LLM_CACHE_MAX_ENTRIES", "50000"))  # Максимум ответов AI в кэше (0 - кэш отключен)
+    MATCH_CACHE_TTL_DAYS = float(os.getenv("MATCH_CACHE_TTL_DAYS", "30"))  # Сколько дней хранится результат сопоставления строки (0 - без ограничения)
+    MATCH_CACHE_MAX_ENTRIES = int(os.getenv("MATCH_CACHE_MAX_ENTRIES", "100000"))  # Максимум строк в кэше результатов (0 - кэш отключен)
 
@@ -0,0 +1,119 @@
+"""
+Подтвержденные сопоставления в памяти процесса.
+
+Таблица confirmed_mappings загружается при запуске API в словарь
+нормализованный текст -> лучшее подтверждение, поэтому проверка строки файла -
+поиск по словарю, а не запрос к БД. Рядом хранится набор примеров для промпта
+AI (few-shot), который пересчитывается только после изменений. Подтверждения
+через API обновляют словарь сразу; изменения из скриптов миграции и других
+процессов подхватываются вместе со снимком таблицы соответствий - API
+перезагружает оба, когда меняется версия данных (data_version).
+"""
+from datetime import datetime
+from typing import Dict, List, Optional
+
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from catalog import MappingCatalog
+from database import ConfirmedMapping
+
+# Сколько подтверждений отправляется в промпт AI как примеры
+LEARNING_EXAMPLES_LIMIT = 5
+
+def normalize_confirmed_text(text: str) -> str:
+    """Нормализованный текст подтверждения: без регистра и лишних пробелов.
+
+    Так же нормализуются строки файла при объединении повторов (api.normalize_search_value),
+    поэтому подтверждение находится для любого написания строки из группы повторов.
+    """
+    return " ".join(text.casefold().split())
+
+class ConfirmedEntry:
+    """Копия строки confirmed_mappings"""
+
+    __slots__ = ('id', 'recognized_text', 'mapping_id', 'user_confirmed', 'updated_at')
+
+    def __init__(self, confirmed: ConfirmedMapping):
+        self.id = confirmed.id
+        self.recognized_text = confirmed.recognized_text
+        self.mapping_id = confirmed.mapping_id
+        self.user_confirmed = confirmed.user_confirmed or 0
+        self.updated_at = confirmed.updated_at or datetime.min
+
+    @property
+    def rank(self):
+        """Порядок подтверждений: больше подтверждений, затем более свежее"""
+        return (self.user_confirmed, self.updated_at)
+
+class ConfirmedMappingIndex:
+    """Нормализованный текст -> лучшее подтверждение; примеры для промпта AI"""
+
+    def __init__(self, catalog: MappingCatalog):
+        self.catalog = catalog
+        self._entries: Dict[int, ConfirmedEntry] = {}
+        self._best: Dict[str, ConfirmedEntry] = {}
+        self._examples: Optional[List[Dict]] = None
+        self._examples_version = None
+        self.loaded = False
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    async def load(self, db: AsyncSession):
+        """Полная загрузка из confirmed_mappings"""
+        result = await db.execute(select(ConfirmedMapping))
+        self._entries = {}
+        self._best = {}
+        for confirmed in result.scalars():
+            self._add(ConfirmedEntry(confirmed))
+        self._examples = None
+        self.loaded = True
+
+    def update(self, confirmed: ConfirmedMapping):
+        """Добавляет или обновляет подтверждение (после коммита)"""
+        self._add(ConfirmedEntry(confirmed))
+        self._examples = None
+
+    def _add(self, entry: ConfirmedEntry):
+        # Текст подтверждения не меняется, а число подтверждений и дата только растут,
+        # поэтому лучшее подтверждение для текста можно обновлять без пересчета
+        self._entries[entry.id] = entry
+        text = normalize_confirmed_text(entry.recognized_text)
+        best = self._best.get(text)
+        if best is None or best.id == entry.id or entry.rank > best.rank:
+            self._best[text] = entry
+
+    def lookup(self, recognized_text: str) -> Optional[ConfirmedEntry]:
+        """Лучшее подтверждение для точно такого же текста (без регистра и крайних пробелов)"""
+        return self._best.get(normalize_confirmed_text(recognized_text))
+
+    def learning_examples(self) -> List[Dict]:
+        """Примеры подтвержденных сопоставлений для промпта AI (few-shot learning).
+
+        Пересчитываются только после изменения подтверждений или таблицы соответствий.
+        """
+        if self._examples is not None and self._examples_version == self.catalog.version:
+            return self._examples
+
+        examples = []
+        for entry in sorted(self._entries.values(), key=lambda entry: entry.rank, reverse=True):
+            mapping = self.catalog.get(entry.mapping_id)
+            if mapping is None:
+                continue
+            examples.append({
+                'запрос': entry.recognized_text,
+                'результат': {
+                    'id': mapping.id,
+                    'артикул_АГБ': mapping.article_agb or '',
+                    'номенклатура_АГБ': mapping.nomenclature_agb or '',
+                    'артикул_BL': mapping.article_bl or '',
+                    'код': mapping.code or '',
+                }
+            })
+            if len(examples) >= LEARNING_EXAMPLES_LIMIT:
+                break
+
+        self._examples = examples
+        self._examples_version = self.catalog.version
+        return examples
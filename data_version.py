@@ -0,0 +1,63 @@
+"""
+Версия данных, от которых зависят результаты сопоставления.
+
+Счетчик в таблице data_versions увеличивается триггерами при любой записи в
+product_mappings и confirmed_mappings - в том числе из скриптов импорта и
+других процессов. Кэши, в ключ которых входит версия, при изменении базы
+соответствий или подтверждений перестают находить старые записи сами.
+"""
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from database import engine
+
+VERSION_TABLE = "data_versions"
+CATALOG_VERSION = "catalog"
+
+# Таблицы, изменение которых меняет версию каталога
+CATALOG_TABLES = ["product_mappings", "confirmed_mappings"]
+
+def _trigger_statements():
+    statements = []
+    for table in CATALOG_TABLES:
+        for operation in ("INSERT", "UPDATE", "DELETE"):
+            statements.append(
+                f"""CREATE TRIGGER IF NOT EXISTS {table}_version_{operation.lower()} AFTER {operation} ON {table} BEGIN
+                    UPDATE {VERSION_TABLE} SET version = version + 1 WHERE name = '{CATALOG_VERSION}';
+                END"""
+            )
+    return statements
+
+def version_triggers_enabled() -> bool:
+    """Версия ведется триггерами только в SQLite"""
+    return engine.dialect.name == "sqlite"
+
+async def init_data_version():
+    """Создает таблицу версий и триггеры (после создания таблиц)"""
+    if not version_triggers_enabled():
+        return
+    async with engine.begin() as conn:
+        await conn.execute(text(
+            f"CREATE TABLE IF NOT EXISTS {VERSION_TABLE} (name VARCHAR PRIMARY KEY, version INTEGER NOT NULL)"
+        ))
+        await conn.execute(text(
+            f"INSERT OR IGNORE INTO {VERSION_TABLE}(name, version) VALUES ('{CATALOG_VERSION}', 0)"
+        ))
+        for statement in _trigger_statements():
+            await conn.execute(text(statement))
+
+async def get_catalog_version(db: AsyncSession) -> str:
+    """Текущая версия таблицы соответствий и подтвержденных сопоставлений"""
+    if version_triggers_enabled():
+        version = await db.scalar(
+            text(f"SELECT version FROM {VERSION_TABLE} WHERE name = :name"),
+            {"name": CATALOG_VERSION},
+        )
+        return str(version)
+
+    # Без триггеров - по числу записей и времени последнего изменения
+    row = (await db.execute(text(
+        "SELECT (SELECT count(*) FROM product_mappings), (SELECT max(updated_at) FROM product_mappings), "
+        "(SELECT count(*) FROM confirmed_mappings), (SELECT max(updated_at) FROM confirmed_mappings)"
+    ))).one()
+    return ":".join(str(value) for value in row)
@@ -75,6 +75,15 @@ class ProductMapping(Base):
     created_at = Column(DateTime, default=datetime.utcnow)
     updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
 
+class MappingArticleKey(Base):
+    """Нормализованный ключ артикула для точного поиска по таблице соответствий"""
+    __tablename__ = "mapping_article_keys"
+    
+    id = Column(Integer, primary_key=True, index=True)
+    mapping_id = Column(Integer, nullable=False, index=True)  # ID из product_mappings
+    field = Column(String, nullable=False)  # Поле, из которого получен ключ (article_agb, variant_1, имя конкурента...)
+    key = Column(String, nullable=False, index=True)  # Нормализованный артикул (без регистра, разделителей и кириллических двойников)
+
 class ConfirmedMapping(Base):
     """Модель для сохранения подтвержденных сопоставлений"""
     __tablename__ = "confirmed_mappings"
@@ -87,6 +96,56 @@ class ConfirmedMapping(Base):
     created_at = Column(DateTime, default=datetime.utcnow)
     updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
 
+class LLMCacheEntry(Base):
+    """Сохраненный ответ AI (кэш запросов к OpenAI)"""
+    __tablename__ = "llm_cache"
+    
+    id = Column(Integer, primary_key=True, index=True)
+    cache_key = Column(String, unique=True, index=True, nullable=False)  # Хэш вида запроса, текста, шаблона промпта и версии данных
+    kind = Column(String, nullable=False)  # Вид запроса: match, excel_structure
+    response = Column(Text, nullable=False)  # Разобранный ответ AI (JSON)
+    hits = Column(Integer, default=0)  # Сколько раз ответ взят из кэша
+    created_at = Column(DateTime, default=datetime.utcnow)
+    last_used_at = Column(DateTime, default=datetime.utcnow, index=True)
+
+class MatchCacheEntry(Base):
+    """Сохраненный результат сопоставления строки файла (кэш между загрузками)"""
+    __tablename__ = "match_cache"
+    
+    id = Column(Integer, primary_key=True, index=True)
+    cache_key = Column(String, unique=True, index=True, nullable=False)  # Хэш нормализованной строки, настроек сопоставления и версии данных
+    result = Column(Text, nullable=False)  # Лучший результат строки (JSON, null - не найдено)
+    hits = Column(Integer, default=0)  # Сколько раз результат взят из кэша
+    created_at = Column(DateTime, default=datetime.utcnow)
+    last_used_at = Column(DateTime, default=datetime.utcnow, index=True)
+
+class UploadJobRecord(Base):
+    """Состояние фоновой обработки загруженного файла (видно всем процессам API)"""
+    __tablename__ = "upload_jobs"
+    
+    id = Column(String, primary_key=True)  # id задачи (uuid)
+    status = Column(String, nullable=False, index=True)  # queued, processing, done, error
+    filename = Column(String, nullable=True)
+    total = Column(Integer, default=0)  # Распознанных строк файла
+    processed = Column(Integer, default=0)  # Строк с окончательным результатом
+    session_id = Column(String, nullable=True)  # Результаты обработки (GET /api/mappings/upload/results/{session_id})
+    summary = Column(JSON, nullable=True)  # Сводка ответа загрузки без строк
+    error = Column(Text, nullable=True)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    started_at = Column(DateTime, nullable=True)
+    finished_at = Column(DateTime, nullable=True, index=True)
+
+class ExcelLayout(Base):
+    """Известная структура Excel-шаблона (определена AI, находится по отпечатку строки заголовков)"""
+    __tablename__ = "excel_layouts"
+    
+    id = Column(Integer, primary_key=True, index=True)
+    fingerprint = Column(String, unique=True, index=True, nullable=False)  # Хэш номера строки заголовков, ее ячеек и их столбцов
+    article_column = Column(Integer, nullable=True)  # Столбец с артикулом (с 1)
+    nomenclature_column = Column(Integer, nullable=True)  # Столбец с номенклатурой (с 1)
+    header_row = Column(Integer, nullable=False)  # Строка с заголовками (с 1)
+    created_at = Column(DateTime, default=datetime.utcnow)
+
 # Создание движка и сессии
 engine = create_async_engine(Config.DATABASE_URL, echo=True)
 async_session_maker = async_sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
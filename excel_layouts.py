@@ -0,0 +1,98 @@
+"""
+Известные структуры Excel-шаблонов.
+
+Клиенты присылают файлы по одним и тем же шаблонам. Структура, определенная
+AI (столбцы артикула и номенклатуры, строка заголовков), запоминается по
+отпечатку строки заголовков: ее номер, непустые ячейки и их столбцы. Для файла
+с известным отпечатком структура берется из памяти, без запроса к модели.
+Отпечатки хранятся в таблице excel_layouts и загружаются при запуске API.
+"""
+import hashlib
+import json
+from typing import Dict, List, Optional
+
+from sqlalchemy import select
+from sqlalchemy.exc import IntegrityError
+
+from database import ExcelLayout, async_session_maker
+
+# Минимум непустых ячеек в строке заголовков (строка с одним названием таблицы шаблон не определяет)
+MIN_HEADER_CELLS = 2
+
+def header_fingerprint(row_number: int, values: List[str]) -> Optional[str]:
+    """Отпечаток строки заголовков: номер строки, непустые ячейки (без регистра и лишних пробелов) и их столбцы"""
+    cells = [
+        (col_idx, " ".join(value.casefold().split()))
+        for col_idx, value in enumerate(values, start=1)
+        if value and value.strip()
+    ]
+    if len(cells) < MIN_HEADER_CELLS:
+        return None
+    payload = json.dumps([row_number, cells], ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+def _valid_column(value) -> bool:
+    return isinstance(value, int) and not isinstance(value, bool) and value > 0
+
+class ExcelLayoutCache:
+    """Отпечаток строки заголовков -> структура таблицы"""
+
+    def __init__(self):
+        self._layouts: Dict[str, Dict] = {}
+
+    def __len__(self) -> int:
+        return len(self._layouts)
+
+    async def load(self, db):
+        """Загружает известные структуры из excel_layouts"""
+        result = await db.execute(select(ExcelLayout))
+        self._layouts = {layout.fingerprint: self._structure(layout) for layout in result.scalars()}
+
+    @staticmethod
+    def _structure(layout: ExcelLayout) -> Dict:
+        return {
+            'article_column': layout.article_column,
+            'nomenclature_column': layout.nomenclature_column,
+            'header_row': layout.header_row,
+            'reasoning': 'Известный шаблон файла',
+        }
+
+    def lookup(self, sample_data: List[Dict]) -> Optional[Dict]:
+        """Структура по первым строкам файла ([{'row', 'values'}]), если одна из них - известная строка заголовков"""
+        for sample_row in sample_data:
+            fingerprint = header_fingerprint(sample_row['row'], sample_row['values'])
+            if fingerprint in self._layouts:
+                return dict(self._layouts[fingerprint])
+        return None
+
+    async def remember(self, sample_data: List[Dict], structure: Dict):
+        """Запоминает структуру, определенную AI (если в ней есть строка заголовков и хотя бы один столбец)"""
+        header_row = structure.get('header_row')
+        article_column = structure.get('article_column')
+        nomenclature_column = structure.get('nomenclature_column')
+        if not _valid_column(header_row):
+            return
+        if not _valid_column(article_column) and not _valid_column(nomenclature_column):
+            return
+
+        header = next((sample_row for sample_row in sample_data if sample_row['row'] == header_row), None)
+        if header is None:
+            return
+        fingerprint = header_fingerprint(header_row, header['values'])
+        if fingerprint is None or fingerprint in self._layouts:
+            return
+
+        layout = ExcelLayout(
+            fingerprint=fingerprint,
+            article_column=article_column if _valid_column(article_column) else None,
+            nomenclature_column=nomenclature_column if _valid_column(nomenclature_column) else None,
+            header_row=header_row,
+        )
+        async with async_session_maker() as session:
+            session.add(layout)
+            try:
+                await session.commit()
+            except IntegrityError:
+                # Тот же шаблон уже сохранен другим процессом
+                await session.rollback()
+        self._layouts[fingerprint] = self._structure(layout)
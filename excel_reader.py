@@ -0,0 +1,60 @@
+"""
+Потоковое чтение Excel-файлов.
+
+Книга открывается в режиме openpyxl read-only: строки листа читаются из
+архива по мере обхода и не хранятся в памяти, поэтому большой прайс-лист
+обрабатывается за один проход с постоянным расходом памяти. Первые строки
+листа (заголовки) читаются заранее и доступны до обхода остальных - по ним
+определяется структура таблицы, после чего обход продолжается с той же
+позиции без повторного разбора файла.
+"""
+from contextlib import contextmanager
+from itertools import chain, islice
+from typing import Dict, Iterator, List, Tuple
+
+import openpyxl
+
+# Строк в начале листа, доступных до обхода (выборка для определения структуры)
+SAMPLE_ROWS = 10
+# Столбцов строки в выборке для определения структуры
+SAMPLE_COLUMNS = 20
+
+@contextmanager
+def open_workbook(file_path: str):
+    """Книга в режиме только для чтения (значения формул - последние сохраненные); файл закрывается при выходе"""
+    workbook = openpyxl.load_workbook(file_path, read_only=True, data_only=True)
+    try:
+        yield workbook
+    finally:
+        workbook.close()
+
+class SheetRows:
+    """Строки листа за один проход: первые sample_rows строк прочитаны заранее (head)"""
+
+    def __init__(self, sheet, sample_rows: int = SAMPLE_ROWS):
+        self.title = sheet.title
+        self._rows = sheet.iter_rows(values_only=True)
+        self.head: List[Tuple] = list(islice(self._rows, sample_rows))
+        self._consumed = False
+
+    def __iter__(self) -> Iterator[Tuple[int, Tuple]]:
+        """(номер строки с 1, значения ячеек) - начиная с первой строки листа; обойти можно один раз"""
+        if self._consumed:
+            raise RuntimeError(f"Строки листа '{self.title}' уже прочитаны")
+        self._consumed = True
+        return enumerate(chain(self.head, self._rows), start=1)
+
+    def sample_data(self) -> List[Dict]:
+        """Первые строки листа для определения структуры: [{'row': номер, 'values': [текст ячеек]}]"""
+        return [
+            {
+                'row': row_idx,
+                'values': [str(cell) if cell is not None else '' for cell in row][:SAMPLE_COLUMNS]
+            }
+            for row_idx, row in enumerate(self.head, start=1)
+        ]
+
+def iter_sheets(workbook, sample_rows: int = SAMPLE_ROWS) -> Iterator[SheetRows]:
+    """Листы книги с таблицами (листы-диаграммы пропускаются) по порядку"""
+    for sheet in workbook.worksheets:
+        yield SheetRows(sheet, sample_rows)
@@ -2,7 +2,8 @@ import os
 import re
 import json
 import aiofiles
-from typing import List, Dict, Optional
+from collections import deque
+from typing import List, Dict, Optional, Tuple
 from pathlib import Path
 import pytesseract
 from pdf2image import convert_from_path
@@ -24,6 +25,154 @@ except Exception as e:
     print(f"EasyOCR не доступен, будет использован Tesseract: {e}")
     reader = None
 
+class _Automaton:
+    """Автомат Ахо-Корасик над набором строк-шаблонов"""
+    
+    def __init__(self):
+        self.goto: List[Dict[str, int]] = [{}]
+        self.fail: List[int] = [0]
+        self.output: List[List[int]] = [[]]
+        self.lengths: Dict[int, int] = {}
+    
+    def add(self, pattern: str, pattern_id: int):
+        """Добавление шаблона в бор (до вызова build)"""
+        state = 0
+        for char in pattern:
+            next_state = self.goto[state].get(char)
+            if next_state is None:
+                next_state = len(self.goto)
+                self.goto[state][char] = next_state
+                self.goto.append({})
+                self.fail.append(0)
+                self.output.append([])
+            state = next_state
+        self.output[state].append(pattern_id)
+        self.lengths[pattern_id] = len(pattern)
+    
+    def build(self):
+        """Построение суффиксных ссылок обходом в ширину"""
+        queue = deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, next_state in self.goto[state].items():
+                queue.append(next_state)
+                fail_state = self.fail[state]
+                while fail_state and char not in self.goto[fail_state]:
+                    fail_state = self.fail[fail_state]
+                self.fail[next_state] = self.goto[fail_state].get(char, 0)
+                if self.fail[next_state] == next_state:
+                    self.fail[next_state] = 0
+                self.output[next_state] = self.output[next_state] + self.output[self.fail[next_state]]
+    
+    def step(self, state: int, char: str) -> int:
+        """Переход автомата по символу"""
+        while state and char not in self.goto[state]:
+            state = self.fail[state]
+        return self.goto[state].get(char, 0)
+
+class ArticleMatcher:
+    """Поиск всех артикулов в тексте за один проход (вместо поиска каждого артикула по отдельности)"""
+    
+    def __init__(self, articles: List[str]):
+        self.articles = list(articles)
+        # Точные вхождения артикула
+        self._exact = _Automaton()
+        # Артикулы с цифрами без пробелов: ищутся в тексте с пропуском пробельных символов,
+        # пробелы в тексте допускаются только там, где они есть в самом артикуле
+        self._compact = _Automaton()
+        self._compact_gaps: Dict[int, set] = {}
+        
+        for article_id, article in enumerate(self.articles):
+            article_lower = article.lower().strip()
+            if not article_lower:
+                continue
+            self._exact.add(article_lower, article_id)
+            if any(char.isdigit() for char in article_lower):
+                compact = []
+                gaps = set()
+                for char in article_lower:
+                    if char.isspace():
+                        gaps.add(len(compact))
+                    else:
+                        compact.append(char)
+                self._compact.add(''.join(compact), article_id)
+                self._compact_gaps[article_id] = gaps
+        
+        self._exact.build()
+        self._compact.build()
+    
+    def _gaps_allowed(self, article_id: int, first: int, compact_gaps: List[int]) -> bool:
+        """Проверка, что пробелы внутри найденного вхождения стоят там же, где в артикуле"""
+        allowed = self._compact_gaps[article_id]
+        for gap in reversed(compact_gaps):
+            if gap <= first:
+                break
+            if gap - first not in allowed:
+                return False
+        return True
+    
+    def find(self, text: str) -> List[Dict]:
+        """Точные (первое вхождение) и частичные (все вхождения без учета пробелов) совпадения"""
+        text_lower = text.lower()
+        exact_first: Dict[int, int] = {}
+        compact_found: Dict[int, List[Tuple[int, int]]] = {}
+        compact_last_end: Dict[int, int] = {}
+        compact_positions: List[int] = []  # позиция в тексте для каждого непробельного символа
+        compact_gaps: List[int] = []  # номера непробельных символов, перед которыми в тексте был пробел
+        
+        exact_state = 0
+        compact_state = 0
+        after_space = False
+        for index, char in enumerate(text_lower):
+            exact_state = self._exact.step(exact_state, char)
+            for article_id in self._exact.output[exact_state]:
+                if article_id not in exact_first:
+                    exact_first[article_id] = index + 1 - self._exact.lengths[article_id]
+            
+            if char.isspace():
+                after_space = True
+                continue
+            if after_space and compact_positions:
+                compact_gaps.append(len(compact_positions))
+            after_space = False
+            compact_positions.append(index)
+            compact_state = self._compact.step(compact_state, char)
+            for article_id in self._compact.output[compact_state]:
+                first = len(compact_positions) - self._compact.lengths[article_id]
+                start = compact_positions[first]
+                # Как и re.finditer - только непересекающиеся вхождения
+                if start < compact_last_end.get(article_id, 0):
+                    continue
+                if not self._gaps_allowed(article_id, first, compact_gaps):
+                    continue
+                compact_last_end[article_id] = index + 1
+                compact_found.setdefault(article_id, []).append((start, index + 1))
+        
+        matches = []
+        for article_id, article in enumerate(self.articles):
+            if article_id in exact_first:
+                index = exact_first[article_id]
+                article_lower = article.lower().strip()
+                start = max(0, index - 50)
+                end = min(len(text), index + len(article_lower) + 50)
+                matches.append({
+                    "article": article,
+                    "found_text": text[start:end],
+                    "confidence": 1.0,
+                    "match_type": "exact"
+                })
+            else:
+                for match_start, match_end in compact_found.get(article_id, []):
+                    start = max(0, match_start - 50)
+                    end = min(len(text), match_end + 50)
+                    matches.append({
+                        "article": article,
+                        "found_text": text[start:end],
+                        "confidence": 0.8,
+                        "match_type": "partial"
+                    })
+        return matches
+
 class FileProcessor:
     """Класс для обработки различных типов файлов и извлечения текста"""
     
@@ -32,6 +181,8 @@ class FileProcessor:
         self.temp_dir = Path(Config.TEMP_DIR)
         self.upload_dir.mkdir(parents=True, exist_ok=True)
         self.temp_dir.mkdir(parents=True, exist_ok=True)
+        self._article_matcher: Optional[ArticleMatcher] = None
+        self.articles_version = None
     
     async def save_file(self, file_data: bytes, filename: str) -> str:
         """Сохранение файла на диск"""
@@ -90,9 +241,9 @@ class FileProcessor:
     async def extract_text_from_excel(self, excel_path: str) -> str:
         """Извлечение текста из Excel файла"""
         try:
-            # Пробуем открыть как Excel
+            # Пробуем открыть как Excel (потоково: строки не загружаются в память целиком)
             try:
-                workbook = openpyxl.load_workbook(excel_path, data_only=True)
+                workbook = openpyxl.load_workbook(excel_path, read_only=True, data_only=True)
             except:
                 # Если не Excel, пробуем как CSV
                 import csv
@@ -111,12 +262,14 @@ class FileProcessor:
             
             text_parts = []
             
-            for sheet_name in workbook.sheetnames:
-                sheet = workbook[sheet_name]
-                for row in sheet.iter_rows(values_only=True):
-                    row_text = " ".join([str(cell) if cell else "" for cell in row])
-                    if row_text.strip():
-                        text_parts.append(row_text)
+            try:
+                for sheet in workbook.worksheets:
+                    for row in sheet.iter_rows(values_only=True):
+                        row_text = " ".join([str(cell) if cell else "" for cell in row])
+                        if row_text.strip():
+                            text_parts.append(row_text)
+            finally:
+                workbook.close()
             
             return "\n".join(text_parts)
         except Exception as e:
@@ -173,49 +326,24 @@ class FileProcessor:
         else:
             raise ValueError(f"Неподдерживаемый тип файла: {file_type}")
     
-    def extract_article_numbers(self, text: str, articles: List[str]) -> List[Dict]:
+    def set_articles(self, articles: List[str], version=None):
+        """Строит автомат поиска артикулов; пересобирается только при изменении списка (или версии)"""
+        if version is not None:
+            if version == self.articles_version and self._article_matcher is not None:
+                return
+        elif self._article_matcher is not None and self._article_matcher.articles == list(articles):
+            return
+        self._article_matcher = ArticleMatcher(articles)
+        self.articles_version = version
+    
+    def extract_article_numbers(self, text: str, articles: Optional[List[str]] = None) -> List[Dict]:
         """Извлечение артикулов из текста и сопоставление с базой"""
-        matches = []
-        text_lower = text.lower()
+        if articles is not None:
+            self.set_articles(articles)
+        if self._article_matcher is None:
+            return []
         
-        for article in articles:
-            article_lower = article.lower().strip()
-            if not article_lower:
-                continue
-            
-            # Поиск точного совпадения
-            if article_lower in text_lower:
-                # Находим контекст вокруг артикула
-                index = text_lower.find(article_lower)
-                start = max(0, index - 50)
-                end = min(len(text), index + len(article_lower) + 50)
-                context = text[start:end]
-                
-                matches.append({
-                    "article": article,
-                    "found_text": context,
-                    "confidence": 1.0,
-                    "match_type": "exact"
-                })
-            
-            # Поиск частичного совпадения (если артикул содержит цифры)
-            elif any(char.isdigit() for char in article_lower):
-                # Ищем паттерны, похожие на артикул
-                pattern = re.escape(article_lower)
-                pattern = pattern.replace("\\ ", "\\s*")
-                regex = re.compile(pattern, re.IGNORECASE)
-                
-                for match in regex.finditer(text):
-                    start = max(0, match.start() - 50)
-                    end = min(len(text), match.end() + 50)
-                    context = text[start:end]
-                    
-                    matches.append({
-                        "article": article,
-                        "found_text": context,
-                        "confidence": 0.8,
-                        "match_type": "partial"
-                    })
+        matches = self._article_matcher.find(text)
         
         # Удаляем дубликаты
         seen = set()
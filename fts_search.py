@@ -0,0 +1,85 @@
+"""
+Полнотекстовый поиск по таблице соответствий на SQLite FTS5.
+
+Виртуальная таблица product_mappings_fts синхронизируется с product_mappings
+триггерами, поэтому индекс общий для всех процессов (uvicorn workers,
+скрипты импорта) и не требует прогрева в памяти.
+"""
+from typing import List, Optional
+
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from config import Config
+from database import engine
+from search_index import MAPPING_SEARCH_FIELDS, tokenize
+
+FTS_TABLE = "product_mappings_fts"
+
+def fts_enabled() -> bool:
+    """Включен ли режим поиска через FTS5 (доступен только для SQLite)"""
+    return Config.SEARCH_BACKEND == "fts5" and engine.dialect.name == "sqlite"
+
+def _body_sql(alias: str) -> str:
+    """SQL-выражение, склеивающее все поля поиска записи (и значения конкурентов) в один текст"""
+    parts = [f"coalesce({alias}.{field}, '')" for field in MAPPING_SEARCH_FIELDS]
+    parts.append(
+        f"coalesce(CASE WHEN json_valid({alias}.competitors) THEN "
+        f"(SELECT group_concat(value, ' ') FROM json_each({alias}.competitors)) END, '')"
+    )
+    return " || ' ' || ".join(parts)
+
+_CREATE_STATEMENTS = [
+    f"""CREATE VIRTUAL TABLE IF NOT EXISTS {FTS_TABLE} USING fts5(
+        body,
+        tokenize = "unicode61 remove_diacritics 0 tokenchars '_'"
+    )""",
+    f"""CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_ai AFTER INSERT ON product_mappings BEGIN
+        INSERT INTO {FTS_TABLE}(rowid, body) VALUES (new.id, {_body_sql('new')});
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_ad AFTER DELETE ON product_mappings BEGIN
+        DELETE FROM {FTS_TABLE} WHERE rowid = old.id;
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_au AFTER UPDATE ON product_mappings BEGIN
+        DELETE FROM {FTS_TABLE} WHERE rowid = old.id;
+        INSERT INTO {FTS_TABLE}(rowid, body) VALUES (new.id, {_body_sql('new')});
+    END""",
+]
+
+async def init_fts():
+    """Создает FTS5-таблицу и триггеры; перестраивает индекс, если он расходится с таблицей"""
+    async with engine.begin() as conn:
+        for statement in _CREATE_STATEMENTS:
+            await conn.execute(text(statement))
+
+        mappings_count = await conn.scalar(text("SELECT count(*) FROM product_mappings"))
+        fts_count = await conn.scalar(text(f"SELECT count(*) FROM {FTS_TABLE}"))
+        if mappings_count != fts_count:
+            print(f"Перестройка FTS-индекса: {fts_count} -> {mappings_count} записей")
+            await conn.execute(text(f"DELETE FROM {FTS_TABLE}"))
+            await conn.execute(text(
+                f"INSERT INTO {FTS_TABLE}(rowid, body) "
+                f"SELECT pm.id, {_body_sql('pm')} FROM product_mappings AS pm"
+            ))
+
+def build_match_query(query: str) -> Optional[str]:
+    """Строит выражение MATCH: любое слово запроса как префикс слова в записи"""
+    tokens = sorted(tokenize(query))
+    if not tokens:
+        return None
+    return " OR ".join(f'"{token}"*' for token in tokens)
+
+async def fts_candidates(db: AsyncSession, query: str, limit: int) -> List[int]:
+    """ID лучших по bm25 записей для запроса"""
+    match_query = build_match_query(query)
+    if not match_query:
+        return []
+
+    result = await db.execute(
+        text(
+            f"SELECT rowid FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH :match "
+            f"ORDER BY bm25({FTS_TABLE}) LIMIT :limit"
+        ),
+        {"match": match_query, "limit": limit},
+    )
+    return [row[0] for row in result.fetchall()]
@@ -4,6 +4,7 @@
 import asyncio
 import openpyxl
 from database import init_db, async_session_maker, ProductMapping
+from article_keys import rebuild_article_keys
 from config import Config
 
 async def import_epiroc_base(file_path: str):
@@ -121,6 +122,9 @@ async def import_epiroc_base(file_path: str):
         # Финальный коммит
         await session.commit()
         
+        # Обновляем ключи артикулов для точного поиска
+        await rebuild_article_keys(session)
+        
         print(f"\n✅ Импорт завершен!")
         print(f"   Импортировано: {imported_count} записей")
         print(f"   Пропущено: {skipped_count} пустых строк")
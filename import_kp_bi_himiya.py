@@ -5,6 +5,7 @@
 import asyncio
 import openpyxl
 from database import init_db, async_session_maker, ProductMapping
+from article_keys import rebuild_article_keys
 from config import Config
 
 def normalize_value(value):
@@ -245,6 +246,9 @@ async def import_kp_bi_himiya(file_path: str):
             total_imported += imported
             total_updated += updated
             total_skipped += skipped
+        
+        # Обновляем ключи артикулов для точного поиска
+        await rebuild_article_keys(session)
     
     print(f"\n✅ Импорт завершен!")
     print(f"📊 Итого: импортировано {total_imported}, обновлено {total_updated}, пропущено {total_skipped}")
@@ -11,6 +11,7 @@ from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession, async_sess
 from sqlalchemy import delete
 from database import ProductMapping, Base
 from config import Config
+from article_keys import rebuild_article_keys
 import openpyxl
 
 async def clear_mappings(session: AsyncSession):
@@ -227,12 +228,18 @@ async def main():
     engine = create_async_engine(Config.DATABASE_URL, echo=False)
     async_session_maker = async_sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
     
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+    
     async with async_session_maker() as session:
         # Очищаем таблицу
         await clear_mappings(session)
         
         # Импортируем данные
         await import_excel_data(session, str(file_path))
+        
+        # Обновляем ключи артикулов для точного поиска
+        await rebuild_article_keys(session)
     
     await engine.dispose()
     print("\n✅ Готово!")
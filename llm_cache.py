@@ -0,0 +1,57 @@
+"""
+Постоянный кэш ответов AI (таблица llm_cache).
+
+Поставщики присылают одни и те же позиции, поэтому разобранный ответ модели
+сохраняется в БД и при повторной загрузке берется оттуда без запроса к OpenAI.
+Ключ - хэш от вида запроса, нормализованного текста, хэша шаблона промпта
+(модель, тексты промптов, настройки) и версии данных (data_version): после
+изменения базы соответствий или подтверждений старые ответы не используются.
+Срок хранения и число записей ограничены LLM_CACHE_TTL_DAYS и
+LLM_CACHE_MAX_ENTRIES (см. persistent_cache).
+"""
+import hashlib
+import json
+from typing import Any, Dict, List, Optional
+
+from database import LLMCacheEntry
+from persistent_cache import PersistentCache
+
+_cache = PersistentCache(LLMCacheEntry, "response", "LLM_CACHE_TTL_DAYS", "LLM_CACHE_MAX_ENTRIES", "кэша AI")
+
+def cache_enabled() -> bool:
+    """Кэш отключается при LLM_CACHE_MAX_ENTRIES = 0"""
+    return _cache.enabled()
+
+def normalize_cache_text(text: str) -> str:
+    """Нормализованный текст запроса: без регистра и лишних пробелов"""
+    return " ".join(str(text).casefold().split())
+
+def template_hash(*parts) -> str:
+    """Хэш шаблона промпта и настроек, от которых зависит ответ"""
+    payload = json.dumps(parts, ensure_ascii=False, default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+def cache_key(kind: str, text: str, template: str, version: str) -> str:
+    """Ключ записи кэша"""
+    payload = "\0".join((kind, template, version, normalize_cache_text(text)))
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+async def get_cached_responses(kind: str, texts: List[str], template: str, version: str) -> Dict[str, Any]:
+    """Сохраненные ответы для нескольких запросов: {текст: ответ} (только найденные)"""
+    return await _cache.get({text: cache_key(kind, text, template, version) for text in texts})
+
+async def get_cached_response(kind: str, text: str, template: str, version: str) -> Optional[Any]:
+    """Сохраненный ответ для запроса или None"""
+    return (await get_cached_responses(kind, [text], template, version)).get(text)
+
+async def store_responses(kind: str, values: Dict[str, Any], template: str, version: str):
+    """Сохраняет ответы {текст: ответ} и удаляет устаревшие и лишние записи"""
+    await _cache.store({cache_key(kind, text, template, version): value for text, value in values.items()}, kind=kind)
+
+async def store_response(kind: str, text: str, template: str, version: str, value: Any):
+    """Сохраняет ответ для запроса"""
+    await store_responses(kind, {text: value}, template, version)
+
+def llm_cache_stats() -> Dict[str, Any]:
+    """Счетчики попаданий и промахов кэша"""
+    return _cache.stats()
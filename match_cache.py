@@ -0,0 +1,38 @@
+"""
+Постоянный кэш результатов сопоставления строк (таблица match_cache).
+
+Одни и те же строки приходят от поставщиков из загрузки в загрузку, поэтому
+окончательный результат строки сохраняется в БД и при повторной загрузке
+берется оттуда без прохода по этапам сопоставления. Ключ - хэш от
+нормализованной строки, хэша настроек сопоставления (этапы, пороги, промпты
+AI) и версии данных (data_version): после изменения базы соответствий или
+подтверждений старые результаты не используются. Срок хранения и число
+записей ограничены MATCH_CACHE_TTL_DAYS и MATCH_CACHE_MAX_ENTRIES (см.
+persistent_cache).
+"""
+from typing import Dict, List, Optional
+
+from database import MatchCacheEntry
+from llm_cache import cache_key
+from persistent_cache import PersistentCache
+
+# Вид записи в ключе (ключи не пересекаются с кэшем ответов AI)
+MATCH_CACHE_KIND = "match_result"
+
+_cache = PersistentCache(MatchCacheEntry, "result", "MATCH_CACHE_TTL_DAYS", "MATCH_CACHE_MAX_ENTRIES", "кэша сопоставлений")
+
+def match_cache_enabled() -> bool:
+    """Кэш отключается при MATCH_CACHE_MAX_ENTRIES = 0"""
+    return _cache.enabled()
+
+async def get_cached_matches(texts: List[str], settings: str, version: str) -> Dict[str, Optional[Dict]]:
+    """Сохраненные результаты строк: {строка: результат или None - не найдено} (только строки из кэша)"""
+    return await _cache.get({text: cache_key(MATCH_CACHE_KIND, text, settings, version) for text in texts})
+
+async def store_matches(matches: Dict[str, Optional[Dict]], settings: str, version: str):
+    """Сохраняет результаты {строка: результат или None} и удаляет устаревшие и лишние записи"""
+    await _cache.store({cache_key(MATCH_CACHE_KIND, text, settings, version): match for text, match in matches.items()})
+
+def match_cache_stats() -> Dict:
+    """Счетчики попаданий и промахов кэша"""
+    return _cache.stats()
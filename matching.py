@@ -0,0 +1,530 @@
+"""
+Нечеткое сопоставление распознанных строк с таблицей соответствий.
+"""
+import asyncio
+import heapq
+import multiprocessing
+import os
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from difflib import SequenceMatcher
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from catalog import MappingCatalog, MappingRecord
+from database import ProductMapping
+from search_index import MappingSearchIndex, tokenize
+
+# NumPy - опционально: без него используется построчный расчет на Python
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# Поля, по которым сопоставляются строки загруженных файлов (в порядке проверки)
+UPLOAD_MATCH_FIELDS = [
+    'article_bl',
+    'article_agb',
+    'variant_1',
+    'variant_2',
+    'variant_3',
+    'variant_4',
+    'variant_5',
+    'variant_6',
+    'variant_7',
+    'variant_8',
+    'code',
+    'nomenclature_agb',
+]
+
+def calculate_similarity(text1: str, text2: str) -> float:
+    """Вычисляет процент совпадения между двумя строками на основе совпадения слов"""
+    if not text1 or not text2:
+        return 0.0
+
+    # Нормализуем тексты: приводим к нижнему регистру и разбиваем на слова
+    return similarity_from_words(text1, tokenize(text1), text2, tokenize(text2))
+
+def similarity_from_words(text1: str, words1: Set[str], text2: str, words2: Set[str]) -> float:
+    """calculate_similarity для заранее разбитых на слова текстов"""
+    if not words1 or not words2:
+        return 0.0
+
+    # Находим точные совпадения слов
+    exact_matches = words1.intersection(words2)
+
+    # Если есть точные совпадения, считаем процент на их основе
+    if exact_matches:
+        # Процент = (количество совпавших слов / количество слов в запросе) * 100
+        # Но также учитываем, сколько слов из текста совпало
+        match_ratio = len(exact_matches) / len(words1)
+        # Дополнительный бонус, если все слова запроса найдены
+        if len(exact_matches) == len(words1):
+            match_ratio = 1.0
+        return match_ratio * 100
+
+    # Если нет точных совпадений, используем частичное совпадение
+    partial_score = partial_word_score(words1, words2)
+    if partial_score > 0:
+        return partial_score
+
+    # Если нет даже частичных совпадений, используем SequenceMatcher как fallback
+    return SequenceMatcher(None, text1.lower(), text2.lower()).ratio() * 100
+
+def similarity_upper_bound(text1: str, words1: Set[str], text2: str, words2: Set[str]) -> Tuple[float, bool]:
+    """Верхняя оценка similarity_from_words без вызова SequenceMatcher и признак того, что она точная.
+
+    При общих словах или частичном совпадении оценка равна результату; иначе это
+    отношение длин строк (real_quick_ratio), больше которого SequenceMatcher не дает.
+    """
+    if not words1 or not words2:
+        return 0.0, True
+
+    exact_count = len(words1.intersection(words2))
+    if exact_count:
+        return (100.0 if exact_count == len(words1) else exact_count / len(words1) * 100), True
+
+    partial_score = partial_word_score(words1, words2)
+    if partial_score > 0:
+        return partial_score, True
+
+    len1, len2 = len(text1.lower()), len(text2.lower())
+    return 2.0 * min(len1, len2) / (len1 + len2) * 100, False
+
+def quick_ratio_score(char_counts: Dict[str, int], text1_len: int, text2: str) -> float:
+    """SequenceMatcher.quick_ratio в процентах (верхняя оценка ratio) по счетчику символов первой строки.
+
+    text2 - уже в нижнем регистре. Вторая строка не индексируется, как в SequenceMatcher.
+    """
+    matches = sum(min(count, text2.count(char)) for char, count in char_counts.items())
+    return 2.0 * matches / (text1_len + len(text2)) * 100
+
+def partial_word_score(words1: Set[str], words2: Set[str]) -> float:
+    """Процент частичного совпадения: слова запроса, входящие в слова текста (или наоборот)"""
+    # Проверяем, содержит ли текст2 слова из text1 (частичное совпадение)
+    partial_score = 0.0
+    for word1 in words1:
+        for word2 in words2:
+            if word1 in word2 or word2 in word1:
+                partial_score += 0.5  # Частичное совпадение дает 50% от полного
+                break
+
+    return (partial_score / len(words1)) * 100
+
+class VectorCatalog:
+    """Колоночный снимок полей таблицы соответствий для векторного расчета совпадения слов.
+
+    Каждая строка снимка - непустое поле записи (записи по возрастанию ID, поля в
+    порядке проверки). Для каждого слова хранится массив номеров строк, где оно
+    встречается, поэтому доля совпавших слов считается для всех строк сразу.
+    """
+
+    def __init__(self, index: MappingSearchIndex, fields: List[str]):
+        self.version = index.version
+        self.fields = fields
+        self.row_mapping: List[int] = []
+        self.row_field: List[str] = []
+        self.row_text: List[str] = []
+        self.row_words: List[Set[str]] = []
+        self.mapping_rows: Dict[int, Tuple[int, int]] = {}
+
+        postings: Dict[str, List[int]] = {}
+        for mapping_id in index.mapping_ids():
+            mapping_fields = index.fields(mapping_id)
+            first_row = len(self.row_text)
+            for field_name in fields:
+                field_text = mapping_fields.get(field_name)
+                if not field_text:
+                    continue
+                row = len(self.row_text)
+                words = tokenize(field_text)
+                self.row_mapping.append(mapping_id)
+                self.row_field.append(field_name)
+                self.row_text.append(field_text)
+                self.row_words.append(words)
+                for word in words:
+                    postings.setdefault(word, []).append(row)
+            self.mapping_rows[mapping_id] = (first_row, len(self.row_text))
+
+        self.row_lower: List[str] = [text.lower() for text in self.row_text]
+        self.row_lower_len = np.array([len(text) for text in self.row_lower], dtype=np.int64)
+        self._postings = {word: np.array(rows, dtype=np.int64) for word, rows in postings.items()}
+
+        # Диапазоны строк снимка для каждой записи (ID по возрастанию)
+        self._mapping_ids = np.array(sorted(self.mapping_rows), dtype=np.int64)
+        self._mapping_first = np.array([self.mapping_rows[m][0] for m in self._mapping_ids.tolist()], dtype=np.int64)
+        self._mapping_last = np.array([self.mapping_rows[m][1] for m in self._mapping_ids.tolist()], dtype=np.int64)
+
+    def _candidate_rows(self, candidate_ids: List[int]):
+        """Номера строк снимка, принадлежащих записям-кандидатам (по возрастанию)"""
+        ids = np.asarray(candidate_ids, dtype=np.int64)
+        positions = np.minimum(np.searchsorted(self._mapping_ids, ids), max(len(self._mapping_ids) - 1, 0))
+        positions = positions[self._mapping_ids[positions] == ids] if len(self._mapping_ids) else positions[:0]
+        first = self._mapping_first[positions]
+        lengths = self._mapping_last[positions] - first
+        if not lengths.sum():
+            return np.empty(0, dtype=np.int64)
+        offsets = np.repeat(first - np.concatenate(([0], np.cumsum(lengths)[:-1])), lengths)
+        return np.arange(int(lengths.sum()), dtype=np.int64) + offsets
+
+    def best(self, text: str, words: Set[str], candidate_ids: List[int]) -> Tuple[int, float]:
+        """Номер лучшей строки снимка и процент совпадения (-1, 0.0 - если совпадений нет).
+
+        Доля совпавших слов считается векторно по всем строкам; частичное совпадение и
+        SequenceMatcher (calculate_similarity) - только для строк записей-кандидатов без
+        общих слов, которые по верхней оценке еще могут обойти лучший результат.
+        """
+        if not text or not words:
+            return -1, 0.0
+
+        best_row, best_score = -1, 0.0
+        overlap_rows = None
+        arrays = [self._postings[word] for word in words if word in self._postings]
+        if arrays:
+            rows, counts = np.unique(np.concatenate(arrays), return_counts=True)
+            scores = counts / len(words) * 100
+            position = int(np.argmax(scores))
+            best_row, best_score = int(rows[position]), float(scores[position])
+            overlap_rows = rows
+
+        # Без общих слов 100% невозможно: строки разные, значит и наборы слов не совпадают
+        if best_score >= 100:
+            return best_row, best_score
+
+        # Строки записей-кандидатов без общих слов, которые по верхней оценке могут обойти лучший результат:
+        # частичное совпадение дает не более 50%, SequenceMatcher - не более real_quick_ratio
+        rows = self._candidate_rows(candidate_ids)
+        if overlap_rows is not None and len(rows):
+            rows = rows[~np.isin(rows, overlap_rows, assume_unique=True)]
+        text_lower = text.lower()
+        text_len = len(text_lower)
+        field_len = self.row_lower_len[rows]
+        bounds = np.maximum(50.0, 2.0 * np.minimum(text_len, field_len) / (text_len + field_len) * 100)
+        rows = rows[(bounds > best_score) | ((bounds == best_score) & (rows < best_row))]
+
+        for row in rows.tolist():
+            partial_score = partial_word_score(words, self.row_words[row])
+            if partial_score > 0:
+                score = partial_score
+            else:
+                matcher = SequenceMatcher(None, text_lower, self.row_lower[row])
+                quick_score = matcher.quick_ratio() * 100
+                if quick_score < best_score or (quick_score == best_score and row > best_row):
+                    continue
+                score = matcher.ratio() * 100
+            if score > best_score or (score == best_score and score > 0 and row < best_row):
+                best_row, best_score = row, score
+        return best_row, best_score
+
+class TopMatches:
+    """Первые limit результатов по убыванию процента, при равном проценте - по позиции.
+
+    Хранит только limit лучших результатов в куче, поэтому не нужно сортировать все
+    совпадения. Позиция - порядковый номер результата в исходном (несортированном)
+    списке, так что результаты можно добавлять в любом порядке.
+    """
+
+    def __init__(self, limit: int):
+        self.limit = max(limit, 0)
+        self._heap: List[Tuple[float, int, Dict]] = []
+
+    def __len__(self) -> int:
+        return len(self._heap)
+
+    @property
+    def full(self) -> bool:
+        return len(self._heap) >= self.limit
+
+    def can_enter(self, score: float, position: int) -> bool:
+        """Попадет ли в выдачу результат с таким процентом и позицией"""
+        if self.limit == 0:
+            return False
+        if not self.full:
+            return True
+        worst_score, worst_position, _ = self._heap[0]
+        return (score, -position) > (worst_score, worst_position)
+
+    def push(self, score: float, position: int, item: Dict):
+        """Добавляет результат, вытесняя худший, если выдача заполнена"""
+        if not self.can_enter(score, position):
+            return
+        entry = (score, -position, item)
+        if self.full:
+            heapq.heapreplace(self._heap, entry)
+        else:
+            heapq.heappush(self._heap, entry)
+
+    def items(self) -> List[Dict]:
+        """Результаты по убыванию процента"""
+        return [item for _, _, item in sorted(self._heap, key=lambda entry: (-entry[0], -entry[1]))]
+
+def search_matched_fields(query: str, record: MappingRecord, min_score: float) -> List[str]:
+    """Поля записи (и конкуренты) с процентом совпадения с запросом не ниже min_score - в порядке проверки"""
+    query_words = tokenize(query)
+    matched_fields = []
+    for field_name, field_value in record.search_fields.items():
+        score = similarity_from_words(query, query_words, field_value, record.field_words[field_name])
+        if score > 0 and score >= min_score:
+            matched_fields.append(field_name)
+    return matched_fields
+
+def rank_search_matches(query: str, candidates: Iterable[Tuple[int, MappingRecord]],
+                        min_score: float, top_matches: TopMatches):
+    """Добавляет в top_matches лучшие записи-кандидаты для поиска (как при полной оценке и сортировке).
+
+    candidates - пары (позиция, запись) в исходном порядке. Записи разбираются по
+    убыванию верхней оценки, которая уточняется по мере надобности: сначала без
+    SequenceMatcher, затем по доле общих символов, затем точный процент. Как только
+    оценка не проходит в выдачу, остальные записи тоже не пройдут - перебор прекращается.
+    Поля с оценкой ниже min_score не оцениваются: они не попадают в matched_fields
+    и не определяют процент записи.
+    """
+    query_words = tokenize(query)
+    query_lower = query.lower()
+    query_chars = Counter(query_lower)
+
+    def field_score(record: MappingRecord, field_name: str) -> float:
+        return similarity_from_words(query, query_words, record.search_fields[field_name], record.field_words[field_name])
+
+    # Очередь: (-оценка, позиция, этап уточнения, запись, {поле: (оценка, точная ли)})
+    queue = []
+    for position, record in candidates:
+        bounds = {}
+        for field_name, field_value in record.search_fields.items():
+            bound, exact = similarity_upper_bound(query, query_words, field_value, record.field_words[field_name])
+            if bound > 0 and bound >= min_score:
+                bounds[field_name] = (bound, exact)
+        if bounds:
+            queue.append((-round(max(bound for bound, _ in bounds.values()), 2), position, 0, record, bounds))
+    heapq.heapify(queue)
+
+    while queue:
+        negative_bound, position, stage, record, bounds = heapq.heappop(queue)
+        if not top_matches.can_enter(-negative_bound, position):
+            break
+
+        if stage == 0:
+            # Уточняем оценки полей без общих слов по доле общих символов
+            refined = {}
+            for field_name, (bound, exact) in bounds.items():
+                if not exact:
+                    bound = quick_ratio_score(query_chars, len(query_lower), record.search_fields[field_name].lower())
+                if bound > 0 and bound >= min_score:
+                    refined[field_name] = (bound, exact)
+            if refined:
+                heapq.heappush(queue, (-round(max(bound for bound, _ in refined.values()), 2), position, 1, record, refined))
+            continue
+
+        if stage == 1:
+            # Точный процент записи: поля по убыванию оценки, пока оценка поля может обойти лучшее
+            scores = {}
+            max_score = 0.0
+            for field_name in sorted(bounds, key=lambda name: bounds[name][0], reverse=True):
+                bound, exact = bounds[field_name]
+                if bound <= max_score:
+                    break
+                scores[field_name] = bound if exact else field_score(record, field_name)
+                max_score = max(max_score, scores[field_name])
+            if max_score > 0 and max_score >= min_score:
+                bounds = {field_name: scores.get(field_name) for field_name in bounds}
+                heapq.heappush(queue, (-round(max_score, 2), position, 2, record, bounds))
+            continue
+
+        # Совпавшие поля (старые и новые) и конкуренты - в порядке проверки
+        matched_fields = []
+        for field_name, score in bounds.items():
+            if score is None:
+                score = field_score(record, field_name)
+            if score > 0 and score >= min_score:
+                matched_fields.append(field_name)
+        top_matches.push(-negative_bound, position, {
+            'mapping_id': record.id,
+            'match_score': -negative_bound,
+            'matched_fields': matched_fields
+        })
+
+_vector_catalogs: Dict[Tuple[int, Tuple[str, ...]], VectorCatalog] = {}
+
+def get_vector_catalog(index: MappingSearchIndex, fields: List[str]) -> Optional[VectorCatalog]:
+    """Снимок для векторного расчета; перестраивается при изменении индекса. None - если нет NumPy"""
+    if np is None or not index.loaded:
+        return None
+    key = (id(index), tuple(fields))
+    catalog = _vector_catalogs.get(key)
+    if catalog is None or catalog.version != index.version:
+        catalog = VectorCatalog(index, fields)
+        _vector_catalogs[key] = catalog
+    return catalog
+
+class MatchingEngine:
+    """Пакетное нечеткое сопоставление всех строк файла с таблицей соответствий.
+
+    Повторяющиеся строки сопоставляются один раз, поля записей разбиваются на
+    слова один раз на весь файл, кандидаты из индекса кэшируются по словам.
+    """
+
+    def __init__(self, mappings: Iterable[ProductMapping], index: MappingSearchIndex,
+                 fields: List[str] = UPLOAD_MATCH_FIELDS):
+        self.mappings_by_id: Dict[int, ProductMapping] = {m.id: m for m in mappings}
+        self.index = index
+        self.fields = fields
+        self.vector_catalog = get_vector_catalog(index, fields)
+        self._field_words: Dict[int, List[Tuple[str, str, Set[str]]]] = {}
+        self._word_candidates: Dict[str, Set[int]] = {}
+
+    def _mapping_fields(self, mapping: ProductMapping) -> List[Tuple[str, str, Set[str]]]:
+        """Непустые поля записи вместе с их словами (кэшируются на время жизни движка)"""
+        fields = self._field_words.get(mapping.id)
+        if fields is None:
+            fields = []
+            for field_name in self.fields:
+                field_value = getattr(mapping, field_name)
+                if field_value:
+                    field_text = str(field_value)
+                    fields.append((field_name, field_text, tokenize(field_text)))
+            self._field_words[mapping.id] = fields
+        return fields
+
+    def _candidates(self, words: Set[str]) -> List[int]:
+        """ID записей-кандидатов для набора слов (по возрастанию ID)"""
+        candidate_ids = set()
+        for word in words:
+            word_ids = self._word_candidates.get(word)
+            if word_ids is None:
+                word_ids = self.index.word_candidates(word)
+                self._word_candidates[word] = word_ids
+            candidate_ids |= word_ids
+        return sorted(candidate_ids)
+
+    def match(self, text: str) -> Optional[Dict]:
+        """Лучшее совпадение для одной строки: mapping, поле, значение и процент"""
+        words = tokenize(text)
+        if self.vector_catalog is not None:
+            row, score = self.vector_catalog.best(text, words, self._candidates(words))
+            if row < 0:
+                return None
+            mapping = self.mappings_by_id.get(self.vector_catalog.row_mapping[row])
+            if mapping:
+                field_name = self.vector_catalog.row_field[row]
+                return {
+                    'mapping': mapping,
+                    'matched_field': field_name,
+                    'matched_value': getattr(mapping, field_name),
+                    'match_score': score,
+                }
+            # Индекс разошелся с загруженными записями - считаем построчно
+
+        best = None
+        best_score = 0.0
+
+        for mapping_id in self._candidates(words):
+            mapping = self.mappings_by_id.get(mapping_id)
+            if not mapping:
+                continue
+            for field_name, field_text, field_words in self._mapping_fields(mapping):
+                score = similarity_from_words(text, words, field_text, field_words)
+                if score > best_score:
+                    best_score = score
+                    best = {
+                        'mapping': mapping,
+                        'matched_field': field_name,
+                        'matched_value': getattr(mapping, field_name),
+                        'match_score': score,
+                    }
+        return best
+
+    def match_all(self, texts: List[str]) -> List[Optional[Dict]]:
+        """Лучшие совпадения для всех строк (в порядке входного списка)"""
+        results: Dict[str, Optional[Dict]] = {}
+        for text in texts:
+            if text not in results:
+                results[text] = self.match(text)
+        return [results[text] for text in texts]
+
+# Движок процесса пула (строится инициализатором по копии снимка)
+_worker_engine: Optional[MatchingEngine] = None
+
+def _init_worker(records, fields: List[str]):
+    """Инициализация процесса пула: снимок, индекс и движок по переданным записям"""
+    global _worker_engine
+    catalog = MappingCatalog()
+    catalog.build(records)
+    _worker_engine = MatchingEngine(catalog.all(), catalog.index, fields)
+
+def _match_shard(texts: List[str]) -> List[Optional[Tuple[int, str, float]]]:
+    """Сопоставляет часть строк в процессе пула: (mapping_id, поле, процент) или None"""
+    return [
+        None if match is None else (match['mapping'].id, match['matched_field'], match['match_score'])
+        for match in _worker_engine.match_all(texts)
+    ]
+
+class MatchingPool:
+    """Пул процессов для сопоставления больших файлов вне event loop.
+
+    Каждый процесс держит свою копию снимка таблицы соответствий; при изменении
+    версии снимка пул пересоздается. Уникальные строки делятся на части,
+    результаты собираются в порядке входного списка.
+    """
+
+    # Частей на процесс: выравнивает нагрузку, если строки сопоставляются за разное время
+    SHARDS_PER_PROCESS = 4
+
+    def __init__(self, processes: int = 0, fields: List[str] = UPLOAD_MATCH_FIELDS):
+        self.processes = processes or os.cpu_count() or 1
+        self.fields = fields
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._version: Optional[int] = None
+
+    @property
+    def enabled(self) -> bool:
+        return self.processes > 1
+
+    def _get_executor(self, catalog: MappingCatalog) -> ProcessPoolExecutor:
+        """Пул процессов с актуальной копией снимка"""
+        if self._executor is None or self._version != catalog.version:
+            # Уже отправленные задачи старого пула доработают со старым снимком
+            self.shutdown()
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.processes,
+                mp_context=multiprocessing.get_context('spawn'),
+                initializer=_init_worker,
+                initargs=(catalog.all(), self.fields),
+            )
+            self._version = catalog.version
+        return self._executor
+
+    async def match_all(self, catalog: MappingCatalog, texts: List[str]) -> List[Optional[Dict]]:
+        """Лучшие совпадения для всех строк (как MatchingEngine.match_all), расчет - в процессах пула"""
+        unique_texts = list(dict.fromkeys(texts))
+        if not unique_texts:
+            return [None for _ in texts]
+
+        executor = self._get_executor(catalog)
+        shard_size = -(-len(unique_texts) // (self.processes * self.SHARDS_PER_PROCESS))
+        shards = [unique_texts[i:i + shard_size] for i in range(0, len(unique_texts), shard_size)]
+        loop = asyncio.get_running_loop()
+        shard_results = await asyncio.gather(
+            *(loop.run_in_executor(executor, _match_shard, shard) for shard in shards)
+        )
+
+        results: Dict[str, Optional[Dict]] = {}
+        for shard, matches in zip(shards, shard_results):
+            for text, match in zip(shard, matches):
+                results[text] = None
+                if match is None:
+                    continue
+                mapping_id, field_name, score = match
+                mapping = catalog.get(mapping_id)
+                if mapping:
+                    results[text] = {
+                        'mapping': mapping,
+                        'matched_field': field_name,
+                        'matched_value': getattr(mapping, field_name),
+                        'match_score': score,
+                    }
+        return [results[text] for text in texts]
+
+    def shutdown(self):
+        """Останавливает процессы пула"""
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
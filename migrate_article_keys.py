@@ -0,0 +1,18 @@
+import asyncio
+from database import init_db, async_session_maker
+from article_keys import rebuild_article_keys
+
+async def migrate_article_keys():
+    """
+    Миграция базы данных: создает таблицу mapping_article_keys и заполняет ее по product_mappings
+    """
+    await init_db()
+    
+    async with async_session_maker() as session:
+        count = await rebuild_article_keys(session)
+        print(f"✅ Построено ключей артикулов: {count}")
+
+if __name__ == "__main__":
+    print("🔄 Начинаю миграцию БД для mapping_article_keys...")
+    asyncio.run(migrate_article_keys())
+    print("✅ Миграция завершена")
@@ -0,0 +1,155 @@
+"""
+Постоянный кэш в таблице БД: общая часть кэша ответов AI (llm_cache) и кэша
+результатов сопоставления (match_cache).
+
+Запись хранит ключ (cache_key), значение в JSON, число попаданий и время
+создания и последнего использования. Записи старше TTL не используются и
+удаляются; если записей больше максимума, удаляются давно не использованные.
+TTL и максимум читаются из настроек при каждом обращении, максимум 0 - кэш
+отключен. Ключи передаются в запросы частями: число параметров запроса в
+SQLite ограничено, а в большом файле уникальных строк - тысячи.
+"""
+import json
+import logging
+from datetime import datetime, timedelta
+from typing import Any, Dict, Iterator, List, Optional
+
+from sqlalchemy import delete, func, select, update
+from sqlalchemy.exc import SQLAlchemyError
+
+from config import Config
+from database import async_session_maker
+
+logger = logging.getLogger(__name__)
+
+# Ключей в одном запросе (IN (...))
+CACHE_KEYS_CHUNK = 500
+
+def key_chunks(keys: List) -> Iterator[List]:
+    """Ключи частями по CACHE_KEYS_CHUNK"""
+    for start in range(0, len(keys), CACHE_KEYS_CHUNK):
+        yield keys[start:start + CACHE_KEYS_CHUNK]
+
+class PersistentCache:
+    """Кэш в таблице model (cache_key, hits, created_at, last_used_at и колонка значения value_column).
+
+    ttl_setting и max_entries_setting - имена настроек Config; title - название
+    кэша в сообщениях об ошибках.
+    """
+
+    def __init__(self, model, value_column: str, ttl_setting: str, max_entries_setting: str, title: str):
+        self.model = model
+        self.value_column = value_column
+        self.ttl_setting = ttl_setting
+        self.max_entries_setting = max_entries_setting
+        self.title = title
+        # Счетчики с момента запуска процесса
+        self._stats = {"hits": 0, "misses": 0, "stores": 0, "evictions": 0}
+
+    @property
+    def max_entries(self) -> int:
+        return getattr(Config, self.max_entries_setting)
+
+    def enabled(self) -> bool:
+        """Кэш отключается при максимуме записей 0"""
+        return self.max_entries > 0
+
+    def _expired_before(self) -> Optional[datetime]:
+        ttl_days = getattr(Config, self.ttl_setting)
+        if ttl_days <= 0:
+            return None
+        return datetime.utcnow() - timedelta(days=ttl_days)
+
+    async def get(self, keys: Dict[str, str]) -> Dict[str, Any]:
+        """Сохраненные значения по ключам {текст: ключ}: {текст: значение} (только найденные)"""
+        if not self.enabled() or not keys:
+            return {}
+
+        texts_by_key: Dict[str, List[str]] = {}
+        for text, key in keys.items():
+            texts_by_key.setdefault(key, []).append(text)
+
+        model = self.model
+        found = {}
+        expired_before = self._expired_before()
+        try:
+            async with async_session_maker() as session:
+                for chunk in key_chunks(list(texts_by_key)):
+                    query = select(model).where(model.cache_key.in_(chunk))
+                    if expired_before is not None:
+                        query = query.where(model.created_at >= expired_before)
+                    entries = (await session.execute(query)).scalars().all()
+
+                    for entry in entries:
+                        value = json.loads(getattr(entry, self.value_column))
+                        for text in texts_by_key[entry.cache_key]:
+                            found[text] = value
+
+                    if entries:
+                        await session.execute(
+                            update(model)
+                            .where(model.id.in_([entry.id for entry in entries]))
+                            .values(hits=model.hits + 1, last_used_at=datetime.utcnow())
+                        )
+                await session.commit()
+        except SQLAlchemyError as e:
+            logger.warning("Ошибка чтения %s (%s ключей): %s", self.title, len(texts_by_key), e)
+            return {}
+
+        self._stats["hits"] += len(found)
+        self._stats["misses"] += len(keys) - len(found)
+        return found
+
+    async def store(self, values: Dict[str, Any], **columns):
+        """Сохраняет значения {ключ: значение} (columns - остальные колонки записей)
+        и удаляет устаревшие и лишние записи"""
+        if not self.enabled() or not values:
+            return
+
+        model = self.model
+        try:
+            async with async_session_maker() as session:
+                for chunk in key_chunks(list(values)):
+                    await session.execute(delete(model).where(model.cache_key.in_(chunk)))
+                session.add_all(
+                    model(cache_key=key, **{self.value_column: json.dumps(value, ensure_ascii=False)}, **columns)
+                    for key, value in values.items()
+                )
+                await session.flush()
+                evicted = await self._evict(session)
+                await session.commit()
+        except SQLAlchemyError as e:
+            logger.warning("Ошибка записи %s (%s ключей): %s", self.title, len(values), e)
+            return
+
+        self._stats["stores"] += len(values)
+        self._stats["evictions"] += evicted
+
+    async def _evict(self, session) -> int:
+        """Удаляет записи старше TTL и давно не использованные сверх максимума"""
+        model = self.model
+        evicted = 0
+        expired_before = self._expired_before()
+        if expired_before is not None:
+            result = await session.execute(delete(model).where(model.created_at < expired_before))
+            evicted += result.rowcount or 0
+
+        max_entries = self.max_entries
+        count = await session.scalar(select(func.count(model.id)))
+        if count > max_entries:
+            stale_ids = (
+                select(model.id)
+                .order_by(model.last_used_at.desc(), model.id.desc())
+                .offset(max_entries)
+            ).scalar_subquery()
+            result = await session.execute(delete(model).where(model.id.in_(stale_ids)))
+            evicted += result.rowcount or 0
+        return evicted
+
+    def stats(self) -> Dict[str, Any]:
+        """Счетчики попаданий и промахов кэша"""
+        lookups = self._stats["hits"] + self._stats["misses"]
+        return {
+            **self._stats,
+            "hit_rate": round(self._stats["hits"] / lookups * 100, 2) if lookups else 0.0,
+        }
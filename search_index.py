@@ -0,0 +1,231 @@
+import heapq
+import re
+from collections import defaultdict
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from database import ProductMapping
+
+# Поля таблицы соответствий, по которым выполняется поиск (в порядке проверки)
+MAPPING_SEARCH_FIELDS = [
+    'code_1c',
+    'bortlanger',
+    'epiroc',
+    'almazgeobur',
+    # Новые базовые поля
+    'article_bl',
+    'article_agb',
+    'variant_1',
+    'variant_2',
+    'variant_3',
+    'variant_4',
+    'variant_5',
+    'variant_6',
+    'variant_7',
+    'variant_8',
+    'unit',
+    'code',
+    'nomenclature_agb',
+    'packaging',
+]
+
+# Минимальная доля общих триграмм (коэффициент Дайса), при которой слово считается опечаткой
+NEAR_MISS_THRESHOLD = 0.5
+
+_WORD_RE = re.compile(r'\w+')
+
+def tokenize(text: Optional[str]) -> Set[str]:
+    """Разбивает текст на нормализованные слова (так же, как calculate_similarity)"""
+    if not text:
+        return set()
+    return set(_WORD_RE.findall(text.lower()))
+
+def trigrams(word: str) -> Set[str]:
+    """Множество символьных триграмм слова"""
+    return {word[i:i + 3] for i in range(len(word) - 2)}
+
+def padded_trigrams(word: str) -> Set[str]:
+    """Триграммы слова с границами (как в pg_trgm): опечатки в начале и конце слова тоже учитываются"""
+    return trigrams(f"  {word} ")
+
+def mapping_search_fields(mapping) -> Dict[str, str]:
+    """Возвращает непустые поля записи для поиска, включая значения конкурентов"""
+    fields_to_check = {name: getattr(mapping, name) for name in MAPPING_SEARCH_FIELDS}
+
+    # Конкуренты добавляются после базовых полей
+    if mapping.competitors:
+        for comp_name, comp_value in mapping.competitors.items():
+            if comp_value:
+                fields_to_check[comp_name] = comp_value
+
+    return {name: str(value) for name, value in fields_to_check.items() if value}
+
+class MappingSearchIndex:
+    """Инвертированный индекс: нормализованное слово -> (mapping_id, поле).
+
+    Дополнительно хранит триграммный индекс по словарю слов, чтобы находить
+    частичные совпадения (подстроки) и опечатки без перебора всей таблицы.
+    """
+
+    def __init__(self):
+        self._postings: Dict[str, Set[Tuple[int, str]]] = defaultdict(set)
+        self._trigrams: Dict[str, Set[str]] = defaultdict(set)
+        self._fields: Dict[int, Dict[str, str]] = {}
+        self.loaded = False
+        # Увеличивается при каждом изменении индекса (для кэшей, построенных поверх него)
+        self.version = 0
+
+    def __len__(self) -> int:
+        return len(self._fields)
+
+    async def load(self, db: AsyncSession):
+        """Полная перестройка индекса по таблице product_mappings"""
+        result = await db.execute(select(ProductMapping))
+        self.build(result.scalars().all())
+
+    def build(self, mappings: Iterable[ProductMapping]):
+        """Строит индекс заново по списку записей"""
+        self._postings = defaultdict(set)
+        self._trigrams = defaultdict(set)
+        self._fields = {}
+        for mapping in mappings:
+            self.add(mapping)
+        self.loaded = True
+
+    def add(self, mapping: ProductMapping):
+        """Добавляет или переиндексирует запись"""
+        self.remove(mapping.id)
+        self.version += 1
+        fields = mapping_search_fields(mapping)
+        self._fields[mapping.id] = fields
+        for field_name, field_value in fields.items():
+            for token in tokenize(field_value):
+                if token not in self._postings:
+                    for trigram in padded_trigrams(token):
+                        self._trigrams[trigram].add(token)
+                self._postings[token].add((mapping.id, field_name))
+
+    def remove(self, mapping_id: int):
+        """Удаляет запись из индекса"""
+        fields = self._fields.pop(mapping_id, None)
+        if not fields:
+            return
+        self.version += 1
+        for field_name, field_value in fields.items():
+            for token in tokenize(field_value):
+                postings = self._postings.get(token)
+                if postings is None:
+                    continue
+                postings.discard((mapping_id, field_name))
+                if not postings:
+                    del self._postings[token]
+                    self._remove_token_trigrams(token)
+
+    def _remove_token_trigrams(self, token: str):
+        """Удаляет слово из триграммного индекса"""
+        for trigram in padded_trigrams(token):
+            tokens = self._trigrams.get(trigram)
+            if tokens is None:
+                continue
+            tokens.discard(token)
+            if not tokens:
+                del self._trigrams[trigram]
+
+    def mapping_ids(self) -> List[int]:
+        """ID всех проиндексированных записей (по возрастанию)"""
+        return sorted(self._fields)
+
+    def fields(self, mapping_id: int) -> Dict[str, str]:
+        """Проиндексированные поля записи"""
+        return self._fields.get(mapping_id, {})
+
+    def postings(self, token: str) -> Set[Tuple[int, str]]:
+        """Список вхождений слова (mapping_id, поле)"""
+        return self._postings.get(token, set())
+
+    def _tokens_containing(self, word: str) -> Set[str]:
+        """Слова словаря, содержащие word как подстроку"""
+        if len(word) < 3:
+            # Для коротких слов триграмм нет - перебираем словарь (а не записи таблицы)
+            return {token for token in self._postings if word in token}
+
+        # Слово-подстрока содержит все свои внутренние триграммы: пересекаем списки, начиная с самого короткого
+        posting_lists = sorted((self._trigrams.get(t, set()) for t in trigrams(word)), key=len)
+        if not posting_lists[0]:
+            return set()
+        found = set(posting_lists[0])
+        for tokens in posting_lists[1:]:
+            found &= tokens
+            if not found:
+                break
+        return {token for token in found if word in token}
+
+    def _tokens_contained_in(self, word: str) -> Set[str]:
+        """Слова словаря, которые являются подстроками word"""
+        found = set()
+        for start in range(len(word)):
+            for end in range(start + 1, len(word) + 1):
+                if word[start:end] in self._postings:
+                    found.add(word[start:end])
+        return found
+
+    def _near_miss_tokens(self, word: str) -> Set[str]:
+        """Слова словаря, похожие на word по доле общих триграмм (опечатки, обрезанные коды)"""
+        word_trigrams = padded_trigrams(word)
+
+        shared = defaultdict(int)
+        for trigram in word_trigrams:
+            for token in self._trigrams.get(trigram, ()):
+                shared[token] += 1
+
+        found = set()
+        for token, count in shared.items():
+            dice = 2 * count / (len(word_trigrams) + len(padded_trigrams(token)))
+            if dice >= NEAR_MISS_THRESHOLD:
+                found.add(token)
+        return found
+
+    def similar_tokens(self, word: str) -> Set[str]:
+        """Слова словаря, совпадающие с word точно, частично (подстрока) или с опечаткой"""
+        found = self._tokens_containing(word)
+        found |= self._tokens_contained_in(word)
+        found |= self._near_miss_tokens(word)
+        return found
+
+    def candidates(self, query: str, fuzzy: bool = True) -> List[int]:
+        """ID записей-кандидатов для запроса (по возрастанию ID).
+
+        Без fuzzy - только записи с общим словом; с fuzzy - также записи,
+        содержащие слова-подстроки и слова с опечатками.
+        """
+        candidate_ids = set()
+        for word in tokenize(query):
+            candidate_ids |= self.word_candidates(word, fuzzy)
+        return sorted(candidate_ids)
+
+    def word_candidates(self, word: str, fuzzy: bool = True) -> Set[int]:
+        """ID записей-кандидатов для одного нормализованного слова"""
+        tokens = self.similar_tokens(word) if fuzzy else {word}
+        return {mapping_id for token in tokens for mapping_id, _ in self.postings(token)}
+
+    def top_candidates(self, query: str, limit: int, fields: Optional[Set[str]] = None) -> List[int]:
+        """ID записей, больше всего похожих на запрос по словам (по убыванию оценки, затем по ID).
+
+        Слово запроса, найденное в записи точно, дает 1, частично или с опечаткой - 0.5;
+        оценка записи - сумма по словам запроса. Если заданы fields, учитываются только эти поля.
+        """
+        scores: Dict[int, float] = defaultdict(float)
+        for word in tokenize(query):
+            word_scores: Dict[int, float] = {}
+            for token in self.similar_tokens(word):
+                weight = 1.0 if token == word else 0.5
+                for mapping_id, field_name in self.postings(token):
+                    if fields is not None and field_name not in fields:
+                        continue
+                    if word_scores.get(mapping_id, 0.0) < weight:
+                        word_scores[mapping_id] = weight
+            for mapping_id, weight in word_scores.items():
+                scores[mapping_id] += weight
+        return heapq.nsmallest(limit, scores, key=lambda mapping_id: (-scores[mapping_id], mapping_id))
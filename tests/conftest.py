@@ -0,0 +1,75 @@
+"""
+Общие настройки тестов: модули проекта импортируются из корня репозитория,
+база данных и каталоги файлов - временные (рабочая БД не используется).
+"""
+import os
+import sys
+import tempfile
+
+import pytest
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TEST_DIR = tempfile.mkdtemp(prefix="tests_")
+
+# Настройки читаются config.py при импорте - задаем их до импорта модулей проекта
+os.environ["DATABASE_URL"] = f"sqlite+aiosqlite:///{os.path.join(TEST_DIR, 'database.db')}"
+os.environ["OPENAI_API_KEY"] = ""
+os.environ["AI_PROVIDER"] = "openai"
+os.environ["SEARCH_BACKEND"] = "memory"
+
+sys.path.insert(0, ROOT_DIR)
+# Каталоги uploads и temp (Config.UPLOAD_DIR, Config.TEMP_DIR) создаются во временном каталоге
+os.chdir(TEST_DIR)
+
+@pytest.fixture(scope="session")
+def client():
+    """Клиент API на временной базе (запуск и остановка - как у uvicorn)"""
+    from fastapi.testclient import TestClient
+
+    import api
+    import database
+    database.engine.echo = False
+
+    with TestClient(api.app) as test_client:
+        yield test_client
+
+@pytest.fixture
+def create_mapping(client):
+    """Создает запись таблицы соответствий через API и возвращает ее ID"""
+    def create(**fields):
+        response = client.post("/api/mappings", json=fields)
+        assert response.status_code == 200, response.text
+        return response.json()["id"]
+    return create
+
+@pytest.fixture
+def scripted_ai(client, monkeypatch):
+    """Включает AI-поиск с локальной заменой модели, которая сначала отвечает ошибками
+    с заданными кодами (429 - rate limit, остальные - ошибка сервера), а затем не находит
+    соответствия ни для одной строки"""
+    import openai
+
+    from ai_client import set_ai_client
+    from ai_providers import FakeLLMProvider
+    from config import Config
+
+    class ScriptedProvider(FakeLLMProvider):
+        def __init__(self, status_codes):
+            super().__init__(latency=0)
+            self.status_codes = list(status_codes)
+
+        async def complete(self, **kwargs):
+            if self.status_codes:
+                status_code = self.status_codes.pop(0)
+                error_class = openai.RateLimitError if status_code == 429 else openai.InternalServerError
+                raise error_class(f"Ошибка {status_code} (тест)", response=self._error_response(status_code), body=None)
+            return await super().complete(**kwargs)
+
+        def _match(self, text, candidate_ids):
+            return {"mapping_id": None, "confidence": 0}
+
+    monkeypatch.setattr(Config, "OPENAI_RETRY_BASE_DELAY", 0.001)
+    monkeypatch.setattr(Config, "OPENAI_MAX_RETRIES", 2)
+    monkeypatch.setattr(Config, "OPENAI_RATE_LIMIT_RETRIES", 2)
+    yield lambda status_codes: set_ai_client(ScriptedProvider(status_codes))
+    set_ai_client(None)
@@ -0,0 +1,31 @@
+"""
+Повторы запросов к модели: повторенные 429 и временные ошибки учитываются как
+попытки, а неудачным запрос считается, только если ответа нет и после повторов.
+"""
+from api import AI_MATCH_CACHE_KIND, ai_interpret_text, ai_match_failed, mapping_catalog
+from ai_usage import start_ai_usage
+from database import async_session_maker
+
+async def interpret(text):
+    """AI-поиск строки как при обработке файла: результат и счетчики AI-поиска"""
+    usage = start_ai_usage()
+    async with async_session_maker() as db:
+        result = await ai_interpret_text(text, mapping_catalog.all(), db)
+    return result, usage.kinds[AI_MATCH_CACHE_KIND], ai_match_failed()
+
+def test_retried_request_is_not_failed(client, create_mapping, scripted_ai):
+    create_mapping(article_bl="RT-5001", nomenclature_agb="повтор запроса коронка")
+    scripted_ai([429, 500])
+
+    _, counters, failed = client.portal.call(interpret, "повтор запроса коронка 1")
+    assert (counters.rate_limited, counters.errors, counters.failed, counters.calls) == (1, 1, 0, 1)
+    assert not failed
+
+def test_request_failed_after_all_retries(client, create_mapping, scripted_ai):
+    create_mapping(article_bl="RT-5002", nomenclature_agb="повтор запроса долото")
+    scripted_ai([500, 500, 500])
+
+    result, counters, failed = client.portal.call(interpret, "повтор запроса долото 2")
+    assert result is None
+    assert (counters.errors, counters.failed, counters.calls) == (3, 1, 0)
+    assert failed
@@ -0,0 +1,104 @@
+"""
+ArticleMatcher (автомат Ахо-Корасик) дает те же совпадения, что прежний поиск
+каждого артикула по отдельности (вхождение строки и регулярное выражение).
+"""
+import random
+import re
+
+import pytest
+
+from file_processor import ArticleMatcher, FileProcessor
+
+def reference_matches(text, articles):
+    """Прежняя реализация FileProcessor.extract_article_numbers (без удаления дубликатов)"""
+    matches = []
+    text_lower = text.lower()
+    for article in articles:
+        article_lower = article.lower().strip()
+        if not article_lower:
+            continue
+
+        if article_lower in text_lower:
+            index = text_lower.find(article_lower)
+            start = max(0, index - 50)
+            end = min(len(text), index + len(article_lower) + 50)
+            matches.append({
+                "article": article,
+                "found_text": text[start:end],
+                "confidence": 1.0,
+                "match_type": "exact"
+            })
+        elif any(char.isdigit() for char in article_lower):
+            pattern = re.escape(article_lower)
+            pattern = pattern.replace("\\ ", "\\s*")
+            regex = re.compile(pattern, re.IGNORECASE)
+            for match in regex.finditer(text):
+                start = max(0, match.start() - 50)
+                end = min(len(text), match.end() + 50)
+                matches.append({
+                    "article": article,
+                    "found_text": text[start:end],
+                    "confidence": 0.8,
+                    "match_type": "partial"
+                })
+    return matches
+
+ARTICLES = [
+    "BL-1234",
+    "bl 12 34",
+    "АГБ 500",
+    "агб500",
+    "Коронка 76 мм",
+    "76",
+    "ABC",
+    "abc 1",
+    "  Z 9 9  ",
+    "",
+    "1234",
+    "12 34 56",
+]
+
+@pytest.mark.parametrize("text", [
+    "Заказ: BL-1234, bl 1234 и BL 12 34; АГБ 500 / агб  500 / АГБ500",
+    "коронка 76мм, Коронка 76 мм и КОРОНКА   76 мм",
+    "abc1 ABC 1 abc  1 z99 Z 9 9 z 99",
+    "12 34 56 123456 12 3456 1234 56",
+    "",
+    "нет артикулов в этой строке",
+])
+def test_known_texts(text):
+    assert ArticleMatcher(ARTICLES).find(text) == reference_matches(text, ARTICLES)
+
+def respace(article, rng):
+    """Артикул с измененными пробелами: убранными, добавленными или замененными на перенос строки"""
+    chars = []
+    for char in article:
+        if char == " ":
+            chars.append(rng.choice(["", " ", "  ", "\n", "\t "]))
+        else:
+            chars.append(char)
+            if rng.random() < 0.1:
+                chars.append(" ")
+    return "".join(chars)
+
+def test_random_texts():
+    rng = random.Random(5)
+    alphabet = "ab12 -Z9агб5"
+    articles = ["".join(rng.choice(alphabet) for _ in range(rng.randint(1, 8))) for _ in range(60)]
+    matcher = ArticleMatcher(articles)
+    for _ in range(300):
+        # Текст из шума и артикулов с измененными пробелами
+        parts = []
+        for _ in range(rng.randint(0, 10)):
+            if rng.random() < 0.5:
+                parts.append(respace(rng.choice(articles), rng))
+            else:
+                parts.append("".join(rng.choice(alphabet + "\n\t") for _ in range(rng.randint(0, 12))))
+        text = "".join(parts)
+        assert matcher.find(text) == reference_matches(text, articles)
+
+def test_extract_article_numbers_rebuilds_on_new_articles():
+    processor = FileProcessor()
+    text = "Позиции: BL-1234 и АГБ 500"
+    assert [m["article"] for m in processor.extract_article_numbers(text, ["BL-1234"])] == ["BL-1234"]
+    assert [m["article"] for m in processor.extract_article_numbers(text, ["АГБ 500"])] == ["АГБ 500"]
@@ -0,0 +1,45 @@
+"""
+Снимок каталога после записи через API: изменения уже внесены на месте, поэтому
+снимок помечается актуальным и не перезагружается при следующем обращении.
+"""
+import io
+
+from openpyxl import Workbook
+
+from api import mapping_catalog
+from data_version import get_catalog_version
+from database import async_session_maker
+
+async def database_version():
+    async with async_session_maker() as db:
+        return await get_catalog_version(db)
+
+def confirmations_file(rows):
+    workbook = Workbook()
+    sheet = workbook.active
+    sheet.append(["Распознанный текст", "ID соответствия", "Процент совпадения"])
+    for row in rows:
+        sheet.append(row)
+    content = io.BytesIO()
+    workbook.save(content)
+    return content.getvalue()
+
+def test_confirmations_upload_keeps_snapshot_current(client, create_mapping):
+    mapping_id = create_mapping(article_bl="CV-6001", nomenclature_agb="версия каталога коронка")
+    other_id = create_mapping(article_bl="CV-6002", nomenclature_agb="версия каталога долото")
+    assert mapping_catalog.data_version == client.portal.call(database_version)
+
+    # Повтор строки обновляет созданное в этом же файле подтверждение, неверный ID пропускается
+    content = confirmations_file([
+        ["версия коронка", mapping_id, 95],
+        ["версия долото", other_id, 90],
+        ["версия коронка", mapping_id, 97],
+        ["версия пропуск", 999999, 50],
+    ])
+    response = client.post("/api/mappings/upload-confirmations", files={
+        "file": ("confirmations.xlsx", content, "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"),
+    })
+    assert response.status_code == 200, response.text
+    assert response.json()["confirmed_count"] == 3
+
+    assert mapping_catalog.data_version == client.portal.call(database_version)
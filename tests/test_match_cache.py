@@ -0,0 +1,85 @@
+"""
+Кэш результатов сопоставления (match_cache): повторная загрузка берет строки из
+кэша, а после изменения записи или подтверждения старые результаты не используются.
+"""
+import pytest
+
+from ai_usage import start_ai_usage
+from api import match_recognized_rows, mapping_catalog
+from match_cache import get_cached_matches, match_cache_enabled, store_matches
+from persistent_cache import CACHE_KEYS_CHUNK
+
+pytestmark = pytest.mark.skipif(not match_cache_enabled(), reason="Кэш результатов отключен")
+
+async def upload_rows(rows):
+    """Сопоставление строк как при обработке файла (с учетом запросов к AI)"""
+    start_ai_usage()
+    return await match_recognized_rows(rows, 80.0, mapping_catalog.all())
+
+def match_rows(client, rows):
+    items, stage_stats = client.portal.call(upload_rows, rows)
+    stages = {stage['stage']: stage for stage in stage_stats}
+    return items, stages
+
+def test_repeated_upload_uses_cache(client, create_mapping):
+    mapping_id = create_mapping(article_bl="MC-8001", nomenclature_agb="кэш переходник резьбовой")
+    rows = ["кэш переходник резьбовой", "qqqzzzww"]
+
+    items, stages = match_rows(client, rows)
+    assert stages['cache']['resolved'] == 0
+    assert [item['mapping_id'] for item in items] == [mapping_id, None]
+
+    cached_items, stages = match_rows(client, rows)
+    assert stages['cache']['resolved'] == 2
+    assert [item['mapping_id'] for item in cached_items] == [mapping_id, None]
+    assert cached_items[0]['match_score'] == items[0]['match_score']
+
+def test_unresolved_rows_are_cached_after_retried_ai_request(client, scripted_ai):
+    # Первый запрос к модели получает ошибку сервера и повторяется - ответ на строку все же есть
+    scripted_ai([500])
+    rows = ["жжжщщщ ыыыъъ"]
+
+    items, stages = match_rows(client, rows)
+    assert stages['ai']['rows'] == 1
+    assert items[0]['mapping_id'] is None
+
+    assert match_rows(client, rows)[1]['cache']['resolved'] == 1
+
+def test_mapping_edit_invalidates_cache(client, create_mapping):
+    mapping_id = create_mapping(article_bl="MC-8002", nomenclature_agb="кэш смазка резьбовая")
+    rows = ["кэш смазка резьбовая"]
+    match_rows(client, rows)
+    assert match_rows(client, rows)[1]['cache']['resolved'] == 1
+
+    response = client.put(f"/api/mappings/{mapping_id}", json={"article_bl": "MC-8002", "nomenclature_agb": "кэш глина"})
+    assert response.status_code == 200, response.text
+
+    items, stages = match_rows(client, rows)
+    assert stages['cache']['resolved'] == 0
+    assert items[0]['matched_value'] != "кэш смазка резьбовая"
+
+def test_confirmation_invalidates_cache(client, create_mapping):
+    create_mapping(article_bl="MC-8003", nomenclature_agb="кэш долото алмазное")
+    confirmed_id = create_mapping(article_bl="MC-8004", nomenclature_agb="кэш другое долото")
+    rows = ["кэш долото алмазное"]
+    match_rows(client, rows)
+    assert match_rows(client, rows)[1]['cache']['resolved'] == 1
+
+    response = client.post("/api/mappings/confirm", params={
+        "recognized_text": rows[0], "mapping_id": confirmed_id, "match_score": 100,
+    })
+    assert response.status_code == 200, response.text
+
+    items, stages = match_rows(client, rows)
+    assert stages['cache']['resolved'] == 0
+    assert items[0]['mapping_id'] == confirmed_id
+    assert items[0]['is_confirmed']
+
+def test_cache_handles_more_keys_than_one_query(client):
+    texts = [f"кэш строка {i}" for i in range(CACHE_KEYS_CHUNK * 2 + 10)]
+    matches = {text: ({"mapping_id": i} if i % 3 else None) for i, text in enumerate(texts)}
+    client.portal.call(store_matches, matches, "test-settings", "test-version")
+
+    found = client.portal.call(get_cached_matches, texts, "test-settings", "test-version")
+    assert found == matches
+    assert client.portal.call(get_cached_matches, texts, "test-settings", "other-version") == {}
@@ -0,0 +1,172 @@
+"""
+Нечеткое сопоставление (matching.py) дает те же результаты, что прежний
+построчный расчет calculate_similarity по записям-кандидатам.
+"""
+import random
+
+import pytest
+
+import matching
+from catalog import MAPPING_COLUMNS, MappingCatalog, MappingRecord
+from matching import (
+    UPLOAD_MATCH_FIELDS, MatchingEngine, TopMatches, calculate_similarity, get_vector_catalog, rank_search_matches
+)
+from search_index import tokenize
+
+WORDS = [
+    "коронка", "буровая", "долото", "штанга", "переходник", "смазка", "резьбовая",
+    "алмазная", "импрегнированная", "полимер", "глина", "мм", "кг", "hq", "nq", "pq",
+    "t45", "r32", "76", "89", "112", "bl", "agb", "epiroc", "boart",
+]
+
+requires_numpy = pytest.mark.skipif(matching.np is None, reason="NumPy не установлен")
+
+def make_record(mapping_id, **fields):
+    values = {name: None for name in MAPPING_COLUMNS}
+    values.update(id=mapping_id, **fields)
+    return MappingRecord(values)
+
+def random_phrase(rng):
+    return " ".join(rng.choice(WORDS) for _ in range(rng.randint(1, 4)))
+
+def random_article(rng):
+    return f"{rng.choice(['BL', 'AGB', 'R'])}-{rng.randint(100, 9999)}"
+
+def mutate(text, rng):
+    """Строка файла, похожая на значение поля: пропущенное или лишнее слово, опечатка, склейка"""
+    words = text.split()
+    action = rng.randrange(5)
+    if action == 0 and len(words) > 1:
+        words.pop(rng.randrange(len(words)))
+    elif action == 1:
+        words.insert(rng.randrange(len(words) + 1), rng.choice(WORDS))
+    elif action == 2:
+        word = words[rng.randrange(len(words))]
+        position = rng.randrange(len(word))
+        words[words.index(word)] = word[:position] + rng.choice("абвxyz01") + word[position + 1:]
+    elif action == 3 and len(words) > 1:
+        words = ["".join(words)]
+    return " ".join(words)
+
+@pytest.fixture(scope="module")
+def catalog():
+    rng = random.Random(6)
+    records = []
+    for mapping_id in range(1, 301):
+        fields = {"article_bl": random_article(rng), "nomenclature_agb": random_phrase(rng)}
+        for field_name in rng.sample(UPLOAD_MATCH_FIELDS, rng.randint(0, 4)):
+            fields[field_name] = random_phrase(rng) if rng.random() < 0.7 else random_article(rng)
+        if rng.random() < 0.2:
+            fields["competitors"] = {"Конкурент": random_article(rng)}
+        records.append(make_record(mapping_id, **fields))
+    mapping_catalog = MappingCatalog()
+    mapping_catalog.build(records)
+    return mapping_catalog
+
+@pytest.fixture(scope="module")
+def texts(catalog):
+    rng = random.Random(60)
+    values = [value for record in catalog.all() for value in record.search_fields.values()]
+    texts = [mutate(rng.choice(values), rng) for _ in range(400)]
+    texts += [random_phrase(rng) for _ in range(50)]
+    texts += ["", "!!!", "zzzz qqqq"]
+    # Повторы строк - как в файлах поставщиков
+    return texts + rng.sample(texts, 100)
+
+def reference_match(catalog, text):
+    """Прежний расчет: записи-кандидаты по возрастанию ID, поля по порядку, строго лучший процент"""
+    candidate_ids = set()
+    for word in tokenize(text):
+        candidate_ids |= catalog.index.word_candidates(word)
+
+    best, best_score = None, 0.0
+    for mapping_id in sorted(candidate_ids):
+        mapping = catalog.get(mapping_id)
+        for field_name in UPLOAD_MATCH_FIELDS:
+            field_value = getattr(mapping, field_name)
+            if not field_value:
+                continue
+            score = calculate_similarity(text, str(field_value))
+            if score > best_score:
+                best, best_score = (mapping_id, field_name, score), score
+    return best
+
+def summary(match):
+    return None if match is None else (match['mapping'].id, match['matched_field'], match['match_score'])
+
+def scalar_engine(catalog):
+    engine = MatchingEngine(catalog.all(), catalog.index)
+    engine.vector_catalog = None
+    return engine
+
+def test_match_all_equals_single_matches(catalog, texts):
+    batch = [summary(match) for match in scalar_engine(catalog).match_all(texts)]
+    single = [summary(scalar_engine(catalog).match(text)) for text in texts]
+    assert batch == single
+    assert batch == [reference_match(catalog, text) for text in texts]
+    assert sum(match is not None for match in batch) > len(texts) // 2
+
+@requires_numpy
+def test_vector_catalog_matches_scalar_scoring(catalog, texts):
+    engine = MatchingEngine(catalog.all(), catalog.index)
+    assert engine.vector_catalog is not None
+    vector = [summary(match) for match in engine.match_all(texts)]
+    assert vector == [summary(match) for match in scalar_engine(catalog).match_all(texts)]
+
+@requires_numpy
+def test_vector_catalog_follows_index_changes():
+    mapping_catalog = MappingCatalog()
+    mapping_catalog.build([make_record(1, nomenclature_agb="коронка алмазная 76")])
+    vector_catalog = get_vector_catalog(mapping_catalog.index, UPLOAD_MATCH_FIELDS)
+    assert get_vector_catalog(mapping_catalog.index, UPLOAD_MATCH_FIELDS) is vector_catalog
+
+    mapping_catalog.add(make_record(2, nomenclature_agb="штанга буровая"))
+    assert get_vector_catalog(mapping_catalog.index, UPLOAD_MATCH_FIELDS) is not vector_catalog
+    match = MatchingEngine(mapping_catalog.all(), mapping_catalog.index).match("штанга буровая")
+    assert summary(match) == (2, "nomenclature_agb", 100.0)
+
+    mapping_catalog.remove(2)
+    assert MatchingEngine(mapping_catalog.all(), mapping_catalog.index).match("штанга буровая") is None
+
+def reference_search(catalog, query, candidate_ids, min_score, limit):
+    """Прежний поиск: оценка всех кандидатов, сортировка по проценту и первые limit результатов"""
+    results = []
+    for mapping_id in candidate_ids:
+        record = catalog.get(mapping_id)
+        scores = []
+        matched_fields = []
+        for field_name, field_value in record.search_fields.items():
+            score = calculate_similarity(query, field_value)
+            if score > 0:
+                scores.append(score)
+                if score >= min_score:
+                    matched_fields.append(field_name)
+        if scores and max(scores) >= min_score:
+            results.append({
+                'mapping_id': mapping_id,
+                'match_score': round(max(scores), 2),
+                'matched_fields': matched_fields
+            })
+    results.sort(key=lambda item: item['match_score'], reverse=True)
+    return results[:limit]
+
+@pytest.mark.parametrize("min_score", [0, 30, 50, 80])
+@pytest.mark.parametrize("limit", [1, 5, 20, 1000])
+def test_top_k_search_equals_full_sort(catalog, texts, min_score, limit):
+    for query in texts[:80]:
+        candidate_ids = catalog.index.candidates(query)
+        top_matches = TopMatches(limit)
+        rank_search_matches(query, (
+            (position, catalog.get(mapping_id)) for position, mapping_id in enumerate(candidate_ids)
+        ), min_score, top_matches)
+        assert top_matches.items() == reference_search(catalog, query, candidate_ids, min_score, limit)
+
+def test_top_matches_keeps_best_by_score_then_position():
+    rng = random.Random(10)
+    items = [{'position': position, 'score': rng.choice([0.0, 25.0, 50.0, 66.67, 100.0])} for position in range(200)]
+    for limit in (0, 1, 7, 200, 300):
+        top_matches = TopMatches(limit)
+        for item in rng.sample(items, len(items)):
+            top_matches.push(item['score'], item['position'], item)
+        expected = sorted(items, key=lambda item: -item['score'])[:limit]
+        assert top_matches.items() == expected
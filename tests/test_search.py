@@ -0,0 +1,65 @@
+"""
+Поиск по таблице соответствий (/api/mappings/search) в сравнении с прежним
+полным перебором: оценка calculate_similarity всех полей всех записей.
+"""
+from api import mapping_catalog
+from matching import calculate_similarity
+
+def full_scan_fields(record, query, min_score):
+    """Прежняя оценка полей записи: проценты полей и совпавшие поля (не ниже min_score)"""
+    scores = []
+    matched_fields = []
+    for field_name, field_value in record.search_fields.items():
+        score = calculate_similarity(query, field_value)
+        if score > 0:
+            scores.append(score)
+            if score >= min_score:
+                matched_fields.append(field_name)
+    return scores, matched_fields
+
+def full_scan_search(query, min_score, limit):
+    """Прежний поиск: все записи по возрастанию ID, сортировка по проценту, первые limit"""
+    results = []
+    for record in mapping_catalog.all():
+        scores, matched_fields = full_scan_fields(record, query, min_score)
+        if scores and max(scores) >= min_score:
+            results.append((record.id, round(max(scores), 2), matched_fields))
+    results.sort(key=lambda item: item[1], reverse=True)
+    return results[:limit]
+
+def search(client, query, min_score, limit=20):
+    response = client.get("/api/mappings/search", params={"query": query, "min_score": min_score, "limit": limit})
+    assert response.status_code == 200, response.text
+    return [(item['mapping']['id'], item['match_score'], item['matched_fields']) for item in response.json()]
+
+def test_search_scans_all_records_without_word_candidates(client, create_mapping):
+    # Общих слов, подстрок и опечаток с запросом нет - совпадение только по SequenceMatcher
+    fallback_id = create_mapping(nomenclature_agb="x8 y9 z7")
+    query = "x7 y8 z9"
+    assert not mapping_catalog.index.candidates(query)
+
+    expected = full_scan_search(query, 50, 20)
+    assert fallback_id in [mapping_id for mapping_id, _, _ in expected]
+    assert search(client, query, 50) == expected
+
+def test_search_with_word_candidates_skips_whole_string_matches(client, create_mapping):
+    fallback_id = create_mapping(nomenclature_agb="q6 r5 s4")
+    word_id = create_mapping(nomenclature_agb="поисковая фреза q5")
+    query = "q5 r6 s3"
+    candidate_ids = mapping_catalog.index.candidates(query)
+    assert word_id in candidate_ids and fallback_id not in candidate_ids
+
+    # Полный перебор нашел бы и запись, похожую только целой строкой; поиск оценивает
+    # только записи с общими словами - в остальном результаты те же
+    expected = full_scan_search(query, 30, 20)
+    assert fallback_id in [mapping_id for mapping_id, _, _ in expected]
+    assert search(client, query, 30) == [item for item in expected if item[0] in candidate_ids]
+
+def test_key_hit_reports_fields_like_scored_search(client, create_mapping):
+    mapping_id = create_mapping(article_bl="KH-9001", nomenclature_agb="ключевая коронка KH-9001", unit="шт")
+    record = mapping_catalog.get(mapping_id)
+    # Ключ артикула совпадает после нормализации: запись - 100%, поля - как при оценке остальных записей
+    for min_score, expected_fields in ((50, ["article_bl", "nomenclature_agb"]), (60, [])):
+        assert full_scan_fields(record, "kh9001", min_score)[1] == expected_fields
+        results = {item[0]: item for item in search(client, "kh9001", min_score)}
+        assert results[mapping_id] == (mapping_id, 100.0, expected_fields)
@@ -0,0 +1,47 @@
+"""
+Повторы строк загруженного файла: строки, совпадающие после нормализации
+(регистр, пробелы), сопоставляются один раз, а подтверждение находится для
+любого написания строки.
+"""
+from api import match_recognized_rows, mapping_catalog, normalize_search_value
+from confirmed import normalize_confirmed_text
+
+def match_rows(client, rows, on_resolved=None):
+    return client.portal.call(match_recognized_rows, rows, 80.0, mapping_catalog.all(), on_resolved)
+
+def test_confirmed_and_search_normalization_agree():
+    for text in ["Коронка 76", "  коронка\t76 ", "КОРОНКА  76", "Straße 1"]:
+        assert normalize_confirmed_text(text) == normalize_search_value(text)
+    assert normalize_search_value("Коронка  76") == normalize_search_value("коронка 76")
+
+def test_repeated_rows_are_matched_once(client, create_mapping):
+    mapping_id = create_mapping(article_bl="GRP-7001", nomenclature_agb="коронка группа тест")
+    rows = ["Коронка группа тест", "коронка  группа тест", "нет такой строки", "КОРОНКА ГРУППА ТЕСТ ", "Коронка группа тест"]
+
+    resolved = {}
+    items, stage_stats = match_rows(client, rows, resolved.update)
+
+    assert [item['recognized_text'] for item in items] == rows
+    assert [item['mapping_id'] for item in items] == [mapping_id, mapping_id, None, mapping_id, mapping_id]
+    # Этапы получают по одной строке на группу повторов
+    first_stage = stage_stats[0]
+    assert first_stage['rows'] == 2
+    # Результат сообщается для каждого написания строки
+    assert set(resolved) == set(rows)
+    assert all(resolved[text]['mapping_id'] == mapping_id for text in rows if text != "нет такой строки")
+
+def test_confirmation_of_any_spelling_applies_to_group(client, create_mapping):
+    create_mapping(article_bl="GRP-7002", nomenclature_agb="долото группа тест")
+    confirmed_id = create_mapping(article_bl="GRP-7003", nomenclature_agb="штанга группа")
+    # Подтверждение сохранено под написанием, которое в файле идет не первым
+    response = client.post("/api/mappings/confirm", params={
+        "recognized_text": "ДОЛОТО  группа тест", "mapping_id": confirmed_id, "match_score": 100,
+    })
+    assert response.status_code == 200, response.text
+
+    rows = ["долото группа тест", "Долото группа тест", "ДОЛОТО  группа тест"]
+    items, _ = match_rows(client, rows)
+
+    assert [item['mapping_id'] for item in items] == [confirmed_id] * 3
+    assert all(item['is_confirmed'] for item in items)
+    assert [item['recognized_text'] for item in items] == rows
@@ -0,0 +1,251 @@
+"""
+Фоновая обработка загруженных файлов.
+
+Запрос загрузки сохраняет файл, ставит задачу в очередь и сразу возвращает ее
+id; файлы обрабатывают UPLOAD_JOB_WORKERS задач-обработчиков в event loop API
+(тяжелые части - сопоставление в пуле процессов и запросы к AI - и так
+асинхронные). Задачу обрабатывает процесс, который ее принял, а ее состояние
+записывается в таблицу upload_jobs (прогресс - не чаще раза в
+PROGRESS_SAVE_INTERVAL секунд), поэтому опрашивать задачу можно через любой
+процесс API. Файл задачи удаляется после обработки.
+"""
+import asyncio
+import logging
+import os
+import uuid
+from collections import OrderedDict
+from datetime import datetime
+from typing import Awaitable, Callable, Dict, List, Optional
+
+from fastapi import HTTPException
+from sqlalchemy import delete, select, update
+from sqlalchemy.exc import SQLAlchemyError
+
+from database import UploadJobRecord, async_session_maker
+
+logger = logging.getLogger(__name__)
+
+# Как часто прогресс обрабатываемой задачи записывается в БД (секунды)
+PROGRESS_SAVE_INTERVAL = 1.0
+
+class UploadQueueFull(Exception):
+    """В очереди уже UPLOAD_JOB_QUEUE_SIZE файлов"""
+
+class UploadJob:
+    """Задача обработки одного загруженного файла"""
+
+    def __init__(self, file_path: str, filename: Optional[str], content_type: Optional[str]):
+        self.id = str(uuid.uuid4())
+        self.file_path = file_path
+        self.filename = filename
+        self.content_type = content_type
+        self.status = "queued"  # queued, processing, done, error
+        self.total = 0  # Распознанных строк файла
+        self.processed = 0  # Строк с окончательным результатом
+        self.session_id: Optional[str] = None
+        self.summary: Optional[Dict] = None
+        self.error: Optional[str] = None
+        self.created_at = datetime.utcnow()
+        self.started_at: Optional[datetime] = None
+        self.finished_at: Optional[datetime] = None
+        self._row_counts: Dict[str, int] = {}
+
+    @property
+    def finished(self) -> bool:
+        return self.status in ("done", "error")
+
+    def set_rows(self, rows: List[str]):
+        """Распознанные строки файла (до сопоставления)"""
+        self.total = len(rows)
+        self._row_counts = {}
+        for text in rows:
+            self._row_counts[text] = self._row_counts.get(text, 0) + 1
+
+    def add_resolved(self, items: Dict[str, Dict]):
+        """Строки, получившие окончательный результат (повторы строки в файле - все сразу)"""
+        self.processed += sum(self._row_counts.get(text, 0) for text in items)
+
+    def as_dict(self) -> Dict:
+        return job_dict(self)
+
+    def record_values(self) -> Dict:
+        """Поля строки upload_jobs"""
+        return {
+            "status": self.status,
+            "filename": self.filename,
+            "total": self.total,
+            "processed": self.processed,
+            "session_id": self.session_id,
+            "summary": self.summary,
+            "error": self.error,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+        }
+
+def job_dict(job) -> Dict:
+    """Ответ о состоянии задачи (job - UploadJob или строка upload_jobs)"""
+    return {
+        "job_id": job.id,
+        "status": job.status,
+        "filename": job.filename,
+        "total": job.total or 0,
+        "processed": job.processed or 0,
+        "session_id": job.session_id,
+        "summary": job.summary,
+        "error": job.error,
+        "created_at": job.created_at.isoformat() if job.created_at else None,
+        "started_at": job.started_at.isoformat() if job.started_at else None,
+        "finished_at": job.finished_at.isoformat() if job.finished_at else None,
+    }
+
+class UploadJobQueue:
+    """Очередь файлов на обработку с ограниченным числом одновременно обрабатываемых.
+
+    handler(job) обрабатывает файл (обновляя job.total/job.processed) и возвращает
+    ответ загрузки; из него в задаче остаются session_id и сводка без строк.
+    """
+
+    def __init__(self, handler: Callable[[UploadJob], Awaitable[Dict]], workers: int = 2,
+                 max_queued: int = 100, keep_finished: int = 500):
+        self.handler = handler
+        self.workers = max(workers, 1)
+        self.max_queued = max_queued
+        self.keep_finished = keep_finished
+        self._jobs: "OrderedDict[str, UploadJob]" = OrderedDict()
+        self._queue: Optional[asyncio.Queue] = None
+        self._tasks: List[asyncio.Task] = []
+
+    def start(self):
+        """Запускает обработчики (при запуске API)"""
+        if self._tasks:
+            return
+        self._queue = asyncio.Queue(maxsize=self.max_queued)
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self):
+        """Останавливает обработчики (при остановке API); необработанные задачи завершаются с ошибкой"""
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        self._queue = None
+
+        for job in self._jobs.values():
+            if not job.finished:
+                job.status = "error"
+                job.error = "Обработка прервана остановкой сервера, загрузите файл снова"
+                job.finished_at = datetime.utcnow()
+                await self._save(job)
+                self._remove_file(job)
+
+    async def submit(self, file_path: str, filename: Optional[str], content_type: Optional[str]) -> UploadJob:
+        """Ставит файл в очередь (UploadQueueFull - если очередь заполнена)"""
+        if self._queue is None:
+            self.start()
+        if self._queue.full():
+            raise UploadQueueFull(f"В очереди уже {self.max_queued} файлов")
+        job = UploadJob(file_path, filename, content_type)
+        # Задача записывается до постановки в очередь: опрос через другой процесс сразу ее найдет
+        await self._save(job, created=True)
+        self._queue.put_nowait(job)
+        self._jobs[job.id] = job
+        self._forget_finished()
+        return job
+
+    async def get(self, job_id: str) -> Optional[Dict]:
+        """Состояние задачи: своей - из памяти, принятой другим процессом - из БД"""
+        job = self._jobs.get(job_id)
+        if job is not None:
+            return job.as_dict()
+        try:
+            async with async_session_maker() as session:
+                record = await session.get(UploadJobRecord, job_id)
+        except SQLAlchemyError as e:
+            logger.warning("Ошибка чтения задачи загрузки %s: %s", job_id, e)
+            return None
+        return job_dict(record) if record is not None else None
+
+    def stats(self) -> Dict:
+        statuses: Dict[str, int] = {}
+        for job in self._jobs.values():
+            statuses[job.status] = statuses.get(job.status, 0) + 1
+        return {"workers": self.workers, "queued": self._queue.qsize() if self._queue else 0, "jobs": statuses}
+
+    def _forget_finished(self):
+        """Хранит не больше keep_finished завершенных задач (самые старые удаляются)"""
+        finished = [job_id for job_id, job in self._jobs.items() if job.finished]
+        for job_id in finished[:max(len(finished) - self.keep_finished, 0)]:
+            del self._jobs[job_id]
+
+    async def _save(self, job: UploadJob, created: bool = False):
+        """Записывает состояние задачи в БД; после завершения удаляет завершенные сверх keep_finished"""
+        try:
+            async with async_session_maker() as session:
+                if created:
+                    session.add(UploadJobRecord(id=job.id, **job.record_values()))
+                else:
+                    await session.execute(
+                        update(UploadJobRecord).where(UploadJobRecord.id == job.id).values(**job.record_values())
+                    )
+                if job.finished:
+                    stale_ids = (
+                        select(UploadJobRecord.id)
+                        .where(UploadJobRecord.finished_at.is_not(None))
+                        .order_by(UploadJobRecord.finished_at.desc())
+                        .offset(self.keep_finished)
+                    ).scalar_subquery()
+                    await session.execute(delete(UploadJobRecord).where(UploadJobRecord.id.in_(stale_ids)))
+                await session.commit()
+        except SQLAlchemyError as e:
+            # Задача обрабатывается и без записи: ее состояние остается доступно через этот процесс
+            logger.warning("Ошибка записи задачи загрузки %s: %s", job.id, e)
+
+    async def _save_progress(self, job: UploadJob):
+        """Записывает прогресс задачи, пока она обрабатывается"""
+        saved = None
+        while True:
+            await asyncio.sleep(PROGRESS_SAVE_INTERVAL)
+            progress = (job.total, job.processed)
+            if progress != saved:
+                await self._save(job)
+                saved = progress
+
+    def _remove_file(self, job: UploadJob):
+        try:
+            os.remove(job.file_path)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logger.warning("Не удалось удалить файл задачи %s: %s", job.file_path, e)
+
+    async def _worker(self):
+        while True:
+            job = await self._queue.get()
+            job.status = "processing"
+            job.started_at = datetime.utcnow()
+            await self._save(job)
+            progress_task = asyncio.create_task(self._save_progress(job))
+            try:
+                result = await self.handler(job)
+                job.session_id = result.get("session_id")
+                job.summary = {key: value for key, value in result.items() if key != "results"}
+                job.processed = job.total
+                job.status = "done"
+            except asyncio.CancelledError:
+                raise
+            except HTTPException as e:
+                job.error = str(e.detail)
+                job.status = "error"
+            except Exception as e:
+                import traceback
+                traceback.print_exc()
+                job.error = f"Ошибка при обработке файла: {str(e)}"
+                job.status = "error"
+            finally:
+                progress_task.cancel()
+                job.finished_at = datetime.utcnow() if job.finished else None
+                if job.finished:
+                    await self._save(job)
+                    self._remove_file(job)
+                self._queue.task_done()
@@ -5,6 +5,7 @@ import './UploadPage.css'
 
 function UploadPage({ userId }) {
   const [uploading, setUploading] = useState(false)
+  const [progress, setProgress] = useState(null)
   const [result, setResult] = useState(null)
   const [error, setError] = useState(null)
   const [recognitionResults, setRecognitionResults] = useState([])
@@ -24,33 +25,90 @@ function UploadPage({ userId }) {
     setResult(null)
     setRecognitionResults([])
     setSessionId(null)
+    setProgress(null)
 
     try {
       const formData = new FormData()
       formData.append('file', file)
 
-      const response = await axios.post('/api/mappings/upload', formData, {
-        headers: {
-          'Content-Type': 'multipart/form-data',
-        },
-        timeout: 300000,
+      // Результаты приходят потоком (NDJSON) по мере сопоставления строк
+      const response = await fetch(`${axios.defaults.baseURL || ''}/api/mappings/upload/stream`, {
+        method: 'POST',
+        body: formData,
       })
+      if (!response.ok) {
+        const errorData = await response.json().catch(() => null)
+        throw new Error(
+          typeof errorData?.detail === 'string' ? errorData.detail : `Ошибка API: ${response.status}`
+        )
+      }
 
-      const allResults = response.data.results || []
-      console.log('Все результаты:', allResults)
+      const items = []
+      // Готовые строки в порядке поступления (для показа во время обработки)
+      const received = []
+      let total = 0
+      let processed = 0
+      let shown = 0
+      let shownAt = 0
+      let summary = null
+      let streamError = null
+
+      const handleEvent = (event) => {
+        if (event.event === 'rows') {
+          total = event.total
+        } else if (event.event === 'item') {
+          items[event.index] = event.item
+          received.push(event.item)
+          processed += 1
+        } else if (event.event === 'summary') {
+          summary = event
+        } else if (event.event === 'error') {
+          streamError = event.detail
+        }
+      }
+
+      const reader = response.body.getReader()
+      const decoder = new TextDecoder()
+      let buffer = ''
+      while (true) {
+        const { done, value } = await reader.read()
+        if (done) break
+        buffer += decoder.decode(value, { stream: true })
+        const lines = buffer.split('\n')
+        buffer = lines.pop()
+        lines.filter(line => line.trim()).forEach(line => handleEvent(JSON.parse(line)))
+
+        // Показываем уже готовые строки, не дожидаясь остальных (не чаще раза в 300 мс);
+        // в порядке файла строки выстраиваются после окончания обработки
+        if (processed > shown && Date.now() - shownAt >= 300) {
+          setRecognitionResults(received.slice())
+          setShowRecognitionModal(true)
+          shown = processed
+          shownAt = Date.now()
+        }
+        if (total) {
+          setProgress({ processed, total })
+        }
+      }
+      if (buffer.trim()) {
+        handleEvent(JSON.parse(buffer))
+      }
+
+      if (streamError || !summary) {
+        throw new Error(streamError || 'Обработка файла прервана')
+      }
+
+      const allResults = items.filter(Boolean)
       console.log('Количество результатов:', allResults.length)
       
       // Сохраняем все результаты (включая "не найдено")
       setRecognitionResults(allResults)
-      setSessionId(response.data.session_id)
+      setSessionId(summary.session_id)
       
       // Всегда открываем модальное окно, если есть результаты
-      if (allResults.length > 0) {
-        console.log('Открываю модальное окно со всеми результатами')
-        setShowRecognitionModal(true)
-      } else {
+      if (allResults.length === 0) {
         // Нет результатов вообще
-        const message = `✅ ${response.data.message}\nОбработано строк: ${response.data.recognized_count}`
+        const message = `✅ ${summary.message}\nОбработано строк: ${summary.recognized_count}`
         console.log('Нет результатов, показываю alert:', message)
         alert(message)
       }
@@ -83,6 +141,7 @@ function UploadPage({ userId }) {
       setError(errorMessage)
     } finally {
       setUploading(false)
+      setProgress(null)
     }
   }, [])
 
@@ -341,7 +400,11 @@ function UploadPage({ userId }) {
           {uploading ? (
             <div className="loading">
               <p>⏳ Обработка файла...</p>
-              <p className="upload-hint">Извлечение текста и поиск артикулов</p>
+              <p className="upload-hint">
+                {progress
+                  ? `Обработано строк: ${progress.processed} из ${progress.total}`
+                  : 'Извлечение текста и поиск артикулов'}
+              </p>
             </div>
           ) : (
             <div>